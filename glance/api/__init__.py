@@ -25,16 +25,27 @@ logger = logging.getLogger('glance.api')
 
 
 class BaseController(object):
-    def get_image_meta_or_404(self, request, id):
+
+    # A `glance.api.metadata_cache.ImageMetaCache`, if the controller has one
+    meta_cache = None
+
+    def get_image_meta_or_404(self, request, id, cached=False):
         """
         Grabs the image metadata for an image with a supplied
         identifier or raises an HTTPNotFound (404) response
 
         :param request: The WSGI/Webob Request object
         :param id: The opaque image identifier
+        :param cached: Whether metadata from the controller's metadata cache
+                       will do
 
         :raises HTTPNotFound if image does not exist
         """
+        if cached and self.meta_cache is not None:
+            return self.meta_cache.get(
+                request.context, id,
+                lambda: self.get_image_meta_or_404(request, id))
+
         context = request.context
         try:
             return registry.get_image_metadata(self.options, context, id)
@@ -49,12 +60,12 @@ class BaseController(object):
             raise webob.exc.HTTPForbidden(msg, request=request,
                                 content_type='text/plain')
 
-    def get_active_image_meta_or_404(self, request, id):
+    def get_active_image_meta_or_404(self, request, id, cached=False):
         """
         Same as get_image_meta_or_404 except that it will raise a 404 if the
         image isn't 'active'.
         """
-        image = self.get_image_meta_or_404(request, id)
+        image = self.get_image_meta_or_404(request, id, cached)
         if image['status'] != 'active':
             msg = _("Image %s is not active") % id
             logger.debug(msg)
@@ -75,10 +75,18 @@ class Controller(api.BaseController):
             return dict(num_purged=num_purged)
 
     def update(self, req, id):
-        """PUT /cached_images/1 is used to prefetch an image into the cache"""
+        """
+        PUT /cached_images/1 is used to prefetch an image into the cache
+        PUT /cached_images/1?priority=10 - Prefetch before lower priorities
+        """
         image_meta = self.get_active_image_meta_or_404(req, id)
         try:
-            self.cache.queue_prefetch(image_meta)
+            priority = int(req.str_params.get('priority', 0))
+        except ValueError:
+            raise webob.exc.HTTPBadRequest(
+                explanation=_("priority must be an integer"))
+        try:
+            self.cache.queue_prefetch(image_meta, priority)
         except exception.Invalid, e:
             raise webob.exc.HTTPBadRequest(explanation="%s" % e)
 
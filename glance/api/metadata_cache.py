@@ -0,0 +1,156 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process cache of image metadata fetched from the registry
+"""
+import collections
+import copy
+import logging
+import time
+
+import eventlet
+
+from glance.common import config
+
+logger = logging.getLogger('glance.api.metadata_cache')
+
+
+class ImageMetaCache(object):
+    """
+    A TTL and LRU bounded cache of the image metadata the API server reads
+    from the registry.
+
+    Whether an image is visible depends on who asks, so entries are keyed
+    by the image id along with the requester's auth token, owner and admin
+    flag. Entries are fresh for `ttl` seconds. For a further `stale_ttl`
+    seconds an entry is still returned, but the first request to see it
+    stale refreshes it from the registry in a green thread.
+
+    All of an image's entries are dropped by `invalidate`, which the API
+    calls whenever it changes an image. Changes made by any other process
+    are only seen once the entries expire; until then the cache can go on
+    serving an image to a requester who has lost access to it. So the
+    cache is only ever used by a single API server running without worker
+    processes, see `get_metadata_cache`.
+    """
+
+    def __init__(self, max_size, ttl, stale_ttl=0):
+        """
+        :param max_size: Maximum number of entries
+        :param ttl: Seconds for which an entry is fresh
+        :param stale_ttl: Seconds past `ttl` for which an entry is returned
+                          while it is refreshed
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = collections.OrderedDict()
+        self.keys_by_image = {}
+        self.generations = {}
+        self.refreshing = set()
+
+    @staticmethod
+    def make_key(context, image_id):
+        return (str(image_id), context.auth_tok, context.owner,
+                context.is_admin, context.show_deleted)
+
+    def get(self, context, image_id, fetch):
+        """
+        Returns the metadata of an image, calling `fetch()` to read it from
+        the registry unless a usable entry is cached. Exceptions raised by
+        `fetch` are not cached.
+        """
+        key = self.make_key(context, image_id)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            image_meta, fetched_at = entry
+            age = time.time() - fetched_at
+            if age < self.ttl + self.stale_ttl:
+                self.entries[key] = entry
+                if age >= self.ttl and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    eventlet.spawn_n(self._refresh, key, fetch,
+                                     self.generations.get(key[0], 0))
+                return copy.deepcopy(image_meta)
+            self._forget(key)
+
+        generation = self.generations.get(key[0], 0)
+        image_meta = fetch()
+        self._store(key, image_meta, generation)
+        return copy.deepcopy(image_meta)
+
+    def _refresh(self, key, fetch, generation):
+        try:
+            image_meta = fetch()
+        except Exception, e:
+            # The next request past the TTL fetches it again itself
+            logger.debug(_("Failed to refresh cached metadata of image "
+                           "%(image_id)s: %(e)s") % dict(image_id=key[0],
+                                                         e=e))
+            self._forget(key)
+        else:
+            self._store(key, image_meta, generation)
+        finally:
+            self.refreshing.discard(key)
+
+    def _store(self, key, image_meta, generation):
+        # Don't store metadata read before the image was last invalidated
+        if generation != self.generations.get(key[0], 0):
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (copy.deepcopy(image_meta), time.time())
+        self.keys_by_image.setdefault(key[0], set()).add(key)
+        while len(self.entries) > self.max_size:
+            oldest, unused = self.entries.popitem(last=False)
+            self._forget(oldest)
+
+    def _forget(self, key):
+        self.entries.pop(key, None)
+        keys = self.keys_by_image.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_image[key[0]]
+
+    def invalidate(self, image_id):
+        """Drops every cached entry for an image"""
+        image_id = str(image_id)
+        self.generations[image_id] = self.generations.get(image_id, 0) + 1
+        for key in self.keys_by_image.pop(image_id, ()):
+            self.entries.pop(key, None)
+
+
+def get_metadata_cache(options):
+    """Returns an `ImageMetaCache` configured by the `image_meta_cache_*`
+    options, or None if `image_meta_cache_size` is 0 or the server runs
+    worker processes, which could not invalidate each other's caches
+    """
+    max_size = config.get_option(options, 'image_meta_cache_size',
+                                 type='int', default=0)
+    if max_size <= 0:
+        return None
+    if config.get_option(options, 'workers', type='int', default=0):
+        logger.warn(_("Not caching image metadata: the cache cannot be "
+                      "invalidated across worker processes, so set "
+                      "workers = 0 to use image_meta_cache_size"))
+        return None
+    ttl = config.get_option(options, 'image_meta_cache_ttl', type='int',
+                            default=5)
+    stale_ttl = config.get_option(options, 'image_meta_cache_stale_ttl',
+                                  type='int', default=0)
+    return ImageMetaCache(max_size, ttl, stale_ttl)
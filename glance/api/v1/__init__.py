@@ -36,6 +36,8 @@ class API(wsgi.Router):
         mapper.resource("image", "images", controller=resource,
                         collection={'detail': 'GET'})
         mapper.connect("/", controller=resource, action="index")
+        mapper.connect("/images/bulk-get", controller=resource,
+                       action="bulk_get", conditions=dict(method=["POST"]))
         mapper.connect("/images/{id}", controller=resource,
                        action="meta", conditions=dict(method=["HEAD"]))
         mapper.connect("/shared-images/{member}",
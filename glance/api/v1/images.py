@@ -19,6 +19,7 @@
 /images endpoint for Glance v1 API
 """
 
+import hashlib
 import httplib
 import json
 import logging
@@ -27,13 +28,17 @@ import traceback
 
 import webob
 from webob.exc import (HTTPNotFound,
+                       HTTPNotModified,
                        HTTPConflict,
                        HTTPBadRequest,
                        HTTPForbidden,
+                       HTTPRequestRangeNotSatisfiable,
                        HTTPUnauthorized)
 
 from glance import api
+from glance.api import metadata_cache
 from glance import image_cache
+from glance.common import config
 from glance.common import exception
 from glance.common import notifier
 from glance.common import wsgi
@@ -56,7 +61,10 @@ logger = logging.getLogger('glance.api.v1.images')
 SUPPORTED_FILTERS = ['name', 'status', 'container_format', 'disk_format',
                      'size_min', 'size_max', 'is_public']
 
-SUPPORTED_PARAMS = ('limit', 'marker', 'sort_key', 'sort_dir')
+SUPPORTED_PARAMS = ('limit', 'marker', 'sort_key', 'sort_dir', 'cursor')
+
+# Block size requested from wsgi.file_wrapper when serving cache hits
+CACHE_HIT_BLOCK_SIZE = 1024 * 1024
 
 
 class Controller(api.BaseController):
@@ -82,6 +90,32 @@ class Controller(api.BaseController):
         self.options = options
         glance.store.create_stores(options)
         self.notifier = notifier.Notifier(options)
+        self.meta_cache = metadata_cache.get_metadata_cache(options)
+        self.listing_batch_size = config.get_option(
+                options, 'listing_batch_size', type='int', default=200)
+        self.api_limit_max = config.get_option(
+                options, 'api_limit_max', type='int', default=1000)
+        self.checksum_algorithms = self._get_checksum_algorithms(options)
+
+    @staticmethod
+    def _get_checksum_algorithms(options):
+        """
+        Returns the hashlib algorithms named by the `checksum_algorithms`
+        option, whose digests are computed for each uploaded image
+
+        :raises `glance.common.exception.InvalidChecksumAlgorithm` if
+                hashlib does not provide one of them
+        """
+        names = config.get_option(options, 'checksum_algorithms',
+                                  type='str', default='')
+        algorithms = [name.strip().lower() for name in names.split(',')
+                      if name.strip()]
+        for algorithm in algorithms:
+            try:
+                hashlib.new(algorithm)
+            except ValueError:
+                raise exception.InvalidChecksumAlgorithm(algorithm=algorithm)
+        return algorithms
 
     def index(self, req):
         """
@@ -104,16 +138,13 @@ class Controller(api.BaseController):
                  'container_format': <DISK_FORMAT>,
                  'checksum': <CHECKSUM>
                  'size': <SIZE>}, ...
-            ]}
-        """
-        params = self._get_query_params(req)
-        try:
-            images = registry.get_images_list(self.options, req.context,
-                                              **params)
-        except exception.Invalid, e:
-            raise HTTPBadRequest(explanation="%s" % e)
+            ],
+             'next_cursor': <CURSOR>}
 
-        return dict(images=images)
+            next_cursor is only present if the page is full, and is passed
+            as the cursor query param to fetch the next page
+        """
+        return self._get_images_page(req)
 
     def detail(self, req):
         """
@@ -135,12 +166,83 @@ class Controller(api.BaseController):
                  'updated_at': <TIMESTAMP>,
                  'deleted_at': <TIMESTAMP>|<NONE>,
                  'properties': {'distro': 'Ubuntu 10.04 LTS', ...}}, ...
-            ]}
+            ],
+             'next_cursor': <CURSOR>}
+
+            next_cursor is as for `index`
+        """
+        return self._get_images_page(req, detailed=True)
+
+    def _get_images_page(self, req, detailed=False):
+        """
+        Returns a page of images from the registry.
+
+        Pages of more than `listing_batch_size` images are fetched from the
+        registry that many at a time, and streamed to the client as they
+        arrive rather than built whole in memory.
         """
         params = self._get_query_params(req)
         try:
-            images = registry.get_images_detail(self.options, req.context,
-                                                **params)
+            limit = min(int(params['limit']), self.api_limit_max)
+        except (KeyError, ValueError):
+            # The registry applies its default or rejects the limit
+            limit = None
+
+        def get_page(**params):
+            try:
+                return registry.get_images_page(self.options, req.context,
+                                                detailed=detailed, **params)
+            except exception.Invalid, e:
+                raise HTTPBadRequest(explanation="%s" % e)
+
+        if limit is None or limit <= self.listing_batch_size:
+            return get_page(**params)
+
+        params['limit'] = self.listing_batch_size
+        page = get_page(**params)
+        params.pop('marker', None)
+        read = dict(next_cursor=None)
+
+        def images(page):
+            count = 0
+            while True:
+                for image in page['images']:
+                    yield image
+                count += len(page['images'])
+                read['next_cursor'] = page.get('next_cursor')
+                if read['next_cursor'] is None or count >= limit:
+                    return
+                params.update(cursor=read['next_cursor'],
+                              limit=min(self.listing_batch_size,
+                                        limit - count))
+                page = get_page(**params)
+
+        # Called by the serializer once every image has been written
+        def next_cursor():
+            return read['next_cursor']
+
+        return dict(images=images(page), next_cursor=next_cursor)
+
+    def bulk_get(self, req, body=None):
+        """
+        Returns detailed information for each of a list of images, fetched
+        from the registry in a single request
+
+        :param req: The WSGI/Webob Request object
+        :param body: Mapping of the form {'ids': [<ID>, ...]}
+        :retval The response body is a mapping of the same form as `detail`
+                returns, holding the images in the order they were asked
+                for. Images that don't exist or aren't visible to the user
+                are left out.
+        """
+        image_ids = body.get('ids') if isinstance(body, dict) else None
+        if not isinstance(image_ids, list):
+            msg = _("The request body must be a mapping with a list of "
+                    "image ids under 'ids'")
+            raise HTTPBadRequest(explanation=msg)
+        try:
+            images = registry.get_images_metadata(self.options, req.context,
+                                                  image_ids)
         except exception.Invalid, e:
             raise HTTPBadRequest(explanation="%s" % e)
         return dict(images=images)
@@ -184,31 +286,98 @@ class Controller(api.BaseController):
         :raises HTTPNotFound if image metadata is not available to user
         """
         return {
-            'image_meta': self.get_image_meta_or_404(req, id),
+            'image_meta': self.get_image_meta_or_404(req, id, cached=True),
         }
 
+    def _get_byte_range(self, req, image):
+        """
+        Returns the (offset, length) of the part of an image's data asked
+        for by the `Range` header of the request, or None if the whole image
+        should be returned.
+
+        Only single byte ranges are served; a multi-range request, or one
+        whose `If-Range` validator no longer matches the image's checksum,
+        gets the whole image.
+
+        :param req: The WSGI/Webob Request object
+        :param image: Mapping of image metadata
+
+        :raises HTTPRequestRangeNotSatisfiable if the range lies outside
+                the image data
+        """
+        size = image['size']
+        if req.range is None or not size or len(req.range.ranges) != 1:
+            return None
+
+        if not req.if_range.match(etag=image['checksum']):
+            return None
+
+        byte_range = req.range.range_for_length(size)
+        if byte_range is None:
+            msg = (_("Requested range not satisfiable for image %s")
+                   % image['id'])
+            logger.debug(msg)
+            raise HTTPRequestRangeNotSatisfiable(
+                    msg, request=req, content_type='text/plain',
+                    headers={'Content-Range': 'bytes */%d' % size})
+
+        start, stop = byte_range
+        return start, stop - start
+
     def show(self, req, id):
         """
         Returns an iterator that can be used to retrieve an image's
         data along with the image metadata.
 
+        A `Range` header asking for a single byte range is honoured, as are
+        the `If-Range` and `If-None-Match` conditions, both of which are
+        validated against the image's checksum.
+
         :param req: The WSGI/Webob Request object
         :param id: The opaque image identifier
 
         :raises HTTPNotFound if image is not available to user
+        :raises HTTPNotModified if `If-None-Match` matches the checksum
+        :raises HTTPRequestRangeNotSatisfiable if the range is invalid
         """
-        image = self.get_active_image_meta_or_404(req, id)
+        image = self.get_active_image_meta_or_404(req, id, cached=True)
 
-        def get_from_store(image):
+        checksum = image['checksum']
+        if checksum and checksum in req.if_none_match:
+            raise HTTPNotModified(request=req, headers={'ETag': checksum})
+
+        byte_range = self._get_byte_range(req, image)
+
+        def get_from_store(image, offset=0, length=None):
             """Called if caching disabled"""
             try:
-                image = get_from_backend(image['location'])
+                image = get_from_backend(image['location'], offset=offset,
+                                         length=length)
             except exception.NotFound, e:
                 raise HTTPNotFound(explanation="%s" % e)
             return image
 
+        def get_range_from_cache(image, cache, offset, length):
+            """Called if cache hit for part of an image"""
+            with cache.open(image, "rb") as cache_file:
+                cache_file.seek(offset)
+                chunks = utils.chunkslice(utils.chunkiter(cache_file),
+                                          length=length)
+                for chunk in chunks:
+                    yield chunk
+
         def get_from_cache(image, cache):
             """Called if cache hit"""
+            file_wrapper = req.environ.get('wsgi.file_wrapper')
+            if file_wrapper:
+                # The server writes the file out itself, with sendfile(2)
+                # where it can and otherwise in large blocks
+                cache_file = cache.open_for_transmit(image)
+                return file_wrapper(cache_file, CACHE_HIT_BLOCK_SIZE)
+            return get_from_cache_chunked(image, cache)
+
+        def get_from_cache_chunked(image, cache):
+            """Called if cache hit and the server has no file_wrapper"""
             with cache.open(image, "rb") as cache_file:
                 chunks = utils.chunkiter(cache_file)
                 for chunk in chunks:
@@ -216,14 +385,46 @@ class Controller(api.BaseController):
 
         def get_from_store_tee_into_cache(image, cache):
             """Called if cache miss"""
-            with cache.open(image, "wb") as cache_file:
-                chunks = get_from_store(image)
-                for chunk in chunks:
-                    cache_file.write(chunk)
+            try:
+                with cache.open(image, "wb") as cache_file:
+                    chunks = get_from_store(image)
+                    for chunk in chunks:
+                        cache_file.write(chunk)
+                        yield chunk
+            except (exception.ImageCacheFull, exception.ImageCacheBusy), e:
+                # Raised before anything was read from the store
+                logger.debug(_("%s Not tee'ing into the cache"), e)
+                for chunk in get_from_store(image):
+                    yield chunk
+
+        def get_from_cache_behind_writer(image, cache):
+            """Called if cache miss while another request is caching"""
+            bytes_sent = 0
+            try:
+                for chunk in cache.follow_incomplete(image):
+                    bytes_sent += len(chunk)
+                    yield chunk
+            except exception.ImageCacheFillFailed, e:
+                logger.warn(_("%(e)s Resuming image '%(image_id)s' from the "
+                              "store at byte %(bytes_sent)d"),
+                            dict(e=e, image_id=image['id'],
+                                 bytes_sent=bytes_sent))
+                # The client already has the first bytes_sent bytes
+                for chunk in get_from_store(image, offset=bytes_sent):
                     yield chunk
 
         cache = image_cache.ImageCache(self.options)
-        if cache.enabled:
+        if byte_range is not None:
+            # Part of an image can't be used to fill the cache, so only a
+            # cache hit avoids going to the store
+            offset, length = byte_range
+            if cache.enabled and cache.hit(id):
+                logger.debug(_("image '%s' is a cache HIT"), id)
+                image_iterator = get_range_from_cache(image, cache,
+                                                      offset, length)
+            else:
+                image_iterator = get_from_store(image, offset, length)
+        elif cache.enabled:
             if cache.hit(id):
                 # hit
                 logger.debug(_("image '%s' is a cache HIT"), id)
@@ -233,13 +434,16 @@ class Controller(api.BaseController):
                 logger.debug(_("image '%s' is a cache MISS"), id)
 
                 # Make sure we're not already prefetching or caching the image
-                # that just generated the miss
-                if cache.is_image_currently_prefetching(id):
-                    logger.debug(_("image '%s' is already being prefetched,"
-                                 " not tee'ing into the cache"), id)
-                    image_iterator = get_from_store(image)
-                elif cache.is_image_currently_being_written(id):
+                # that just generated the miss. If another request is already
+                # writing it into the cache, read behind that writer instead
+                # of pulling a second copy from the store.
+                if cache.is_image_currently_being_written(id):
                     logger.debug(_("image '%s' is already being cached,"
+                                 " following the cache writer"), id)
+                    image_iterator = get_from_cache_behind_writer(image,
+                                                                  cache)
+                elif cache.is_image_currently_prefetching(id):
+                    logger.debug(_("image '%s' is already being prefetched,"
                                  " not tee'ing into the cache"), id)
                     image_iterator = get_from_store(image)
                 else:
@@ -261,6 +465,7 @@ class Controller(api.BaseController):
         return {
             'image_iterator': image_iterator,
             'image_meta': image,
+            'image_range': byte_range,
         }
 
     def _reserve(self, req, image_meta):
@@ -343,31 +548,57 @@ class Controller(api.BaseController):
         try:
             logger.debug(_("Uploading image data for image %(image_id)s "
                          "to %(store_name)s store"), locals())
+            image_file = utils.ChecksummingReader(req.body_file,
+                                                  self.checksum_algorithms)
             location, size, checksum = store.add(image_meta['id'],
-                                                 req.body_file)
-
-            # Verify any supplied checksum value matches checksum
-            # returned from store when adding image
-            supplied_checksum = image_meta.get('checksum')
-            if supplied_checksum and supplied_checksum != checksum:
-                msg = _("Supplied checksum (%(supplied_checksum)s) and "
-                       "checksum generated from uploaded image "
-                       "(%(checksum)s) did not match. Setting image "
-                       "status to 'killed'.") % locals()
+                                                 image_file)
+
+            # The other digests are kept as checksum_<algorithm>
+            # properties, while an MD5 computed here checks the one
+            # returned from the store
+            digests = image_file.hexdigests()
+            md5 = digests.pop('md5', None)
+            if md5 and md5 != checksum:
+                msg = _("Checksum returned from store (%(checksum)s) and "
+                        "checksum generated from uploaded image "
+                        "(%(md5)s) did not match. Setting image status "
+                        "to 'killed'.") % locals()
                 logger.error(msg)
                 self._safe_kill(req, image_id)
                 raise HTTPBadRequest(msg, content_type="text/plain",
                                      request=req)
 
+            properties = dict(('checksum_%s' % algorithm, digest)
+                              for algorithm, digest in digests.items())
+
+            # Verify any supplied checksum values match those
+            # generated from the uploaded image
+            supplied = dict(image_meta.get('properties', {}),
+                            checksum=image_meta.get('checksum'))
+            generated = dict(properties, checksum=checksum)
+            for key, generated_checksum in generated.items():
+                supplied_checksum = supplied.get(key)
+                if supplied_checksum and \
+                        supplied_checksum != generated_checksum:
+                    msg = _("Supplied %(key)s (%(supplied_checksum)s) and "
+                            "%(key)s generated from uploaded image "
+                            "(%(generated_checksum)s) did not match. "
+                            "Setting image status to 'killed'.") % locals()
+                    logger.error(msg)
+                    self._safe_kill(req, image_id)
+                    raise HTTPBadRequest(msg, content_type="text/plain",
+                                         request=req)
+
             # Update the database with the checksum returned
             # from the backend store
             logger.debug(_("Updating image %(image_id)s data. "
                          "Checksum set to %(checksum)s, size set "
                          "to %(size)d"), locals())
+            update = {'checksum': checksum, 'size': size}
+            if properties:
+                update['properties'] = properties
             registry.update_image_metadata(self.options, req.context,
-                                           image_id,
-                                           {'checksum': checksum,
-                                            'size': size})
+                                           image_id, update)
             self.notifier.info('image.upload', image_meta)
 
             return location
@@ -412,10 +643,13 @@ class Controller(api.BaseController):
         image_meta = {}
         image_meta['location'] = location
         image_meta['status'] = 'active'
-        return registry.update_image_metadata(self.options,
-                                       req.context,
-                                       image_id,
-                                       image_meta)
+        try:
+            return registry.update_image_metadata(self.options,
+                                                  req.context,
+                                                  image_id,
+                                                  image_meta)
+        finally:
+            self._invalidate_meta(image_id)
 
     def _kill(self, req, image_id):
         """
@@ -424,10 +658,13 @@ class Controller(api.BaseController):
         :param req: The WSGI/Webob Request object
         :param image_id: Opaque image identifier
         """
-        registry.update_image_metadata(self.options,
-                                       req.context,
-                                       image_id,
-                                       {'status': 'killed'})
+        try:
+            registry.update_image_metadata(self.options,
+                                           req.context,
+                                           image_id,
+                                           {'status': 'killed'})
+        finally:
+            self._invalidate_meta(image_id)
 
     def _safe_kill(self, req, image_id):
         """
@@ -553,6 +790,8 @@ class Controller(api.BaseController):
             raise HTTPBadRequest(msg, request=req, content_type="text/plain")
         else:
             self.notifier.info('image.update', image_meta)
+        finally:
+            self._invalidate_meta(id)
 
         return {'image_meta': image_meta}
 
@@ -583,9 +822,17 @@ class Controller(api.BaseController):
         if image['location']:
             schedule_delete_from_backend(image['location'], self.options,
                                          req.context, id)
-        registry.delete_image_metadata(self.options, req.context, id)
+        try:
+            registry.delete_image_metadata(self.options, req.context, id)
+        finally:
+            self._invalidate_meta(id)
         self.notifier.info('image.delete', id)
 
+    def _invalidate_meta(self, image_id):
+        """Drops an image from the metadata cache, if there is one"""
+        if self.meta_cache is not None:
+            self.meta_cache.invalidate(image_id)
+
     def members(self, req, image_id):
         """
         Return a list of dictionaries indicating the members of the
@@ -685,6 +932,8 @@ class Controller(api.BaseController):
             logger.debug(msg)
             raise HTTPNotFound(msg, request=req, content_type='text/plain')
 
+        # The image's members decide who may see it
+        self._invalidate_meta(image_id)
         return HTTPNoContent()
 
     def add_member(self, req, image_id, member, body=None):
@@ -722,6 +971,8 @@ class Controller(api.BaseController):
             logger.debug(msg)
             raise HTTPNotFound(msg, request=req, content_type='text/plain')
 
+        # The image's members decide who may see it
+        self._invalidate_meta(image_id)
         return HTTPNoContent()
 
     def delete_member(self, req, image_id, member):
@@ -745,6 +996,8 @@ class Controller(api.BaseController):
             logger.debug(msg)
             raise HTTPNotFound(msg, request=req, content_type='text/plain')
 
+        # The image's members decide who may see it
+        self._invalidate_meta(image_id)
         return HTTPNoContent()
 
 
@@ -775,6 +1028,15 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
     def _inject_checksum_header(self, response, image_meta):
         response.headers['ETag'] = image_meta['checksum']
 
+    def _inject_checksum_property_headers(self, response, image_meta):
+        """
+        Injects the image's checksum_<algorithm> properties as headers into
+        responses that do not carry the rest of its metadata as headers
+        """
+        for key, value in image_meta.get('properties', {}).items():
+            if key.startswith('checksum_'):
+                response.headers['x-image-meta-property-%s' % key] = value
+
     def _inject_image_meta_headers(self, response, image_meta):
         """
         Given a response and mapping of image metadata, injects
@@ -805,11 +1067,20 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
 
     def show(self, response, result):
         image_meta = result['image_meta']
+        image_range = result.get('image_range')
 
         response.app_iter = result['image_iterator']
         # Using app_iter blanks content-length, so we set it here...
-        response.headers['Content-Length'] = image_meta['size']
+        if image_range is None:
+            response.headers['Content-Length'] = image_meta['size']
+        else:
+            offset, length = image_range
+            response.status = httplib.PARTIAL_CONTENT
+            response.headers['Content-Length'] = length
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    offset, offset + length - 1, image_meta['size'])
         response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
 
         self._inject_image_meta_headers(response, image_meta)
         self._inject_location_header(response, image_meta)
@@ -823,6 +1094,7 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         response.headers['Content-Type'] = 'application/json'
         self._inject_location_header(response, image_meta)
         self._inject_checksum_header(response, image_meta)
+        self._inject_checksum_property_headers(response, image_meta)
         return response
 
     def create(self, response, result):
@@ -832,6 +1104,7 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         response.body = self.to_json(dict(image=image_meta))
         self._inject_location_header(response, image_meta)
         self._inject_checksum_header(response, image_meta)
+        self._inject_checksum_property_headers(response, image_meta)
         return response
 
 
@@ -62,14 +62,13 @@ class V1Client(base_client.BaseClient):
         :param filters: dictionary of attributes by which the resulting
                         collection of images should be filtered
         :param marker: id after which to start the page of images
+        :param cursor: cursor returned with the previous page, after which
+                       to start the page of images
         :param limit: maximum number of items to return
         :param sort_key: results will be ordered by this image attribute
         :param sort_dir: direction in which to to order results (asc, desc)
         """
-        params = self._extract_params(kwargs, v1_images.SUPPORTED_PARAMS)
-        res = self.do_request("GET", "/images", params=params)
-        data = json.loads(res.read())['images']
-        return data
+        return self.get_images_page(**kwargs)['images']
 
     def get_images_detailed(self, **kwargs):
         """
@@ -78,12 +77,54 @@ class V1Client(base_client.BaseClient):
         :param filters: dictionary of attributes by which the resulting
                         collection of images should be filtered
         :param marker: id after which to start the page of images
+        :param cursor: cursor returned with the previous page, after which
+                       to start the page of images
         :param limit: maximum number of items to return
         :param sort_key: results will be ordered by this image attribute
         :param sort_dir: direction in which to to order results (asc, desc)
         """
+        return self.get_images_page(detailed=True, **kwargs)['images']
+
+    def get_images_page(self, detailed=False, **kwargs):
+        """
+        Returns a page of images as a mapping holding the list of images
+        under 'images' and, if the page is full, the cursor of the next page
+        under 'next_cursor'. Takes the same params as `get_images`.
+
+        :param detailed: whether to return detailed image data mappings
+        """
         params = self._extract_params(kwargs, v1_images.SUPPORTED_PARAMS)
-        res = self.do_request("GET", "/images/detail", params=params)
+        action = "/images/detail" if detailed else "/images"
+        res = self.do_request("GET", action, params=params)
+        return json.loads(res.read())
+
+    def iter_images(self, **kwargs):
+        """
+        Yields image id/name mappings of every image matching the params
+        of `get_images`, fetching pages of `limit` images as they are
+        needed
+        """
+        return self._iter_pages(self.get_images_page, kwargs)
+
+    def iter_images_detailed(self, **kwargs):
+        """
+        Yields detailed image data mappings of every image matching the
+        params of `get_images_detailed`, fetching pages of `limit` images as
+        they are needed
+        """
+        kwargs['detailed'] = True
+        return self._iter_pages(self.get_images_page, kwargs)
+
+    def get_images_by_id(self, image_ids):
+        """
+        Returns a list of detailed image data mappings, fetched in a single
+        request. Images that don't exist or aren't visible are left out.
+
+        :param image_ids: list of opaque image identifiers
+        """
+        body = json.dumps(dict(ids=list(image_ids)))
+        headers = {'Content-Type': 'application/json'}
+        res = self.do_request("POST", "/images/bulk-get", body, headers)
         data = json.loads(res.read())['images']
         return data
 
@@ -252,13 +293,16 @@ class V1Client(base_client.BaseClient):
         num_reaped = data['num_reaped']
         return num_reaped
 
-    def prefetch_cache_image(self, image_id):
+    def prefetch_cache_image(self, image_id, priority=None):
         """
         Pre-fetch a specified image from the cache
+
+        :param priority: images with a higher priority are prefetched first
         """
         res = self.do_request("HEAD", "/images/%s" % image_id)
         image = utils.get_image_meta_from_headers(res)
-        self.do_request("PUT", "/cached_images/%s" % image_id)
+        params = {'priority': priority}
+        self.do_request("PUT", "/cached_images/%s" % image_id, params=params)
         return True
 
     def get_prefetching_cache_images(self, **kwargs):
@@ -1,6 +1,8 @@
 import httplib
 import logging
 import socket
+import threading
+import time
 import urllib
 
 # See http://code.google.com/p/python-nose/issues/detail?id=373
@@ -41,12 +43,115 @@ class ImageBodyIterator(object):
                 break
 
 
+class HTTPConnectionPool(object):
+
+    """
+    A pool of keep-alive connections to one server, shared by every client
+    of that server in the process.
+
+    A connection goes back to the pool once the response to its last
+    request has been read to the end; a connection whose response is still
+    being read by the caller is never handed out. Idle connections are
+    closed after `idle_timeout` seconds, and at most `max_size` of them are
+    kept. The pool never blocks: when no idle connection is available a new
+    one is made.
+    """
+
+    def __init__(self, connection_type, host, port, max_size=10,
+                 idle_timeout=30):
+        self.connection_type = connection_type
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.busy = []
+        # Never held across I/O, so it cannot block other green threads
+        self.lock = threading.Lock()
+
+    def create(self):
+        """Returns a new connection to the server"""
+        return self.connection_type(self.host, self.port)
+
+    def get(self):
+        """Returns a tuple of a connection and whether it is being reused"""
+        with self.lock:
+            self._collect()
+            if self.idle:
+                conn, released_at = self.idle.pop()
+                return conn, True
+        return self.create(), False
+
+    def put(self, conn, response=None):
+        """Returns a connection to the pool once `response`, if given, has
+        been read to the end
+        """
+        with self.lock:
+            self.busy.append((conn, response, time.time()))
+            self._collect()
+
+    def _collect(self):
+        now = time.time()
+        busy = []
+        for conn, response, released_at in self.busy:
+            if _response_done(response):
+                self.idle.append((conn, now))
+            elif now - released_at < self.idle_timeout:
+                busy.append((conn, response, released_at))
+            # else the caller never finished reading the response, so the
+            # connection is left for it to close
+        self.busy = busy
+
+        idle = []
+        for conn, released_at in self.idle:
+            if now - released_at < self.idle_timeout:
+                idle.append((conn, released_at))
+            else:
+                conn.close()
+        excess = len(idle) - self.max_size
+        if excess > 0:
+            for conn, released_at in idle[:excess]:
+                conn.close()
+            idle = idle[excess:]
+        self.idle = idle
+
+
+def _response_done(response):
+    """Whether the body of a response has been read to the end"""
+    # Responses other than httplib's (webob's, in tests) are never
+    # tied to the connection
+    isclosed = getattr(response, 'isclosed', None)
+    return isclosed is None or isclosed()
+
+
+# Methods that may safely be sent again after a connection failure
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_connection_pool(connection_type, host, port, max_size=10,
+                        idle_timeout=30):
+    """Returns the process-wide connection pool for a server"""
+    key = (connection_type, host, port)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = HTTPConnectionPool(connection_type, host, port,
+                                             max_size, idle_timeout)
+        return _POOLS[key]
+
+
 class BaseClient(object):
 
     """A base client class"""
 
     CHUNKSIZE = 65536
 
+    # Connections to each server are kept alive and shared between clients
+    POOL_MAX_SIZE = 10
+    POOL_IDLE_TIMEOUT = 30  # seconds
+
     def __init__(self, host, port, use_ssl, auth_tok):
         """
         Creates a new client to some service.
@@ -111,58 +216,108 @@ class BaseClient(object):
             action += '?' + urllib.urlencode(params)
 
         try:
-            connection_type = self.get_connection_type()
             headers = headers or {}
             if 'x-auth-token' not in headers and self.auth_tok:
                 headers['x-auth-token'] = self.auth_tok
-            c = connection_type(self.host, self.port)
-
-            # Do a simple request or a chunked request, depending
-            # on whether the body param is a file-like object and
-            # the method is PUT or POST
-            if hasattr(body, 'read') and method.lower() in ('post', 'put'):
-                # Chunk it, baby...
-                c.putrequest(method, action)
 
-                for header, value in headers.items():
-                    c.putheader(header, value)
-                c.putheader('Transfer-Encoding', 'chunked')
-                c.endheaders()
+            pool = self.get_connection_pool()
+            c, reused = pool.get()
+            sent = False
+            try:
+                self._send_request(c, method, action, body, headers)
+                sent = True
+                res = c.getresponse()
+            except (socket.error, httplib.BadStatusLine):
+                c.close()
+                # The server may have closed a kept-alive connection while
+                # it sat in the pool. Retry on a new one only if the server
+                # cannot have acted on the request already -- it was never
+                # sent in full, or its method is idempotent -- and the body
+                # can be sent again
+                if (not reused or hasattr(body, 'read') or
+                    (sent and method.upper() not in IDEMPOTENT_METHODS)):
+                    raise
+                c = pool.create()
+                try:
+                    self._send_request(c, method, action, body, headers)
+                    res = c.getresponse()
+                except Exception:
+                    c.close()
+                    raise
+            except Exception:
+                c.close()
+                raise
 
-                chunk = body.read(self.CHUNKSIZE)
-                while chunk:
-                    c.send('%x\r\n%s\r\n' % (len(chunk), chunk))
-                    chunk = body.read(self.CHUNKSIZE)
-                c.send('0\r\n\r\n')
-            else:
-                # Simple request...
-                c.request(method, action, body, headers)
-            res = c.getresponse()
             status_code = self.get_status_code(res)
             if status_code in (httplib.OK,
                                httplib.CREATED,
                                httplib.ACCEPTED,
                                httplib.NO_CONTENT):
+                pool.put(c, res)
                 return res
-            elif status_code == httplib.UNAUTHORIZED:
-                raise exception.NotAuthorized(res.read())
+
+            # Read the error body before the connection goes back to the
+            # pool, so that it is idle again rather than left with an
+            # unread response
+            try:
+                msg = res.read()
+            except Exception:
+                c.close()
+                raise
+            pool.put(c, res)
+            if status_code == httplib.UNAUTHORIZED:
+                raise exception.NotAuthorized(msg)
             elif status_code == httplib.FORBIDDEN:
-                raise exception.NotAuthorized(res.read())
+                raise exception.NotAuthorized(msg)
             elif status_code == httplib.NOT_FOUND:
-                raise exception.NotFound(res.read())
+                raise exception.NotFound(msg)
             elif status_code == httplib.CONFLICT:
-                raise exception.Duplicate(res.read())
+                raise exception.Duplicate(msg)
             elif status_code == httplib.BAD_REQUEST:
-                raise exception.Invalid(res.read())
+                raise exception.Invalid(msg)
             elif status_code == httplib.INTERNAL_SERVER_ERROR:
-                raise Exception("Internal Server error: %s" % res.read())
+                raise Exception("Internal Server error: %s" % msg)
             else:
-                raise Exception("Unknown error occurred! %s" % res.read())
+                raise Exception("Unknown error occurred! %s" % msg)
 
         except (socket.error, IOError), e:
             raise exception.ClientConnectionError("Unable to connect to "
                                                   "server. Got error: %s" % e)
 
+    def get_connection_pool(self):
+        """
+        Returns the pool of connections to this client's server
+        """
+        return get_connection_pool(self.get_connection_type(), self.host,
+                                   self.port, self.POOL_MAX_SIZE,
+                                   self.POOL_IDLE_TIMEOUT)
+
+    def _send_request(self, c, method, action, body, headers):
+        """
+        Sends a request on connection `c`; the response is left for the
+        caller to read
+        """
+        # Do a simple request or a chunked request, depending
+        # on whether the body param is a file-like object and
+        # the method is PUT or POST
+        if hasattr(body, 'read') and method.lower() in ('post', 'put'):
+            # Chunk it, baby...
+            c.putrequest(method, action)
+
+            for header, value in headers.items():
+                c.putheader(header, value)
+            c.putheader('Transfer-Encoding', 'chunked')
+            c.endheaders()
+
+            chunk = body.read(self.CHUNKSIZE)
+            while chunk:
+                c.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                chunk = body.read(self.CHUNKSIZE)
+            c.send('0\r\n\r\n')
+        else:
+            # Simple request...
+            c.request(method, action, body, headers)
+
     def get_status_code(self, response):
         """
         Returns the integer status code from the response, which
@@ -195,3 +350,24 @@ class BaseClient(object):
                 result[allowed_param] = actual_params[allowed_param]
 
         return result
+
+    def _iter_pages(self, get_page, params):
+        """
+        Yields every image in a paged listing, following the cursor each
+        page returns until the last page.
+
+        :param get_page: callable taking the listing params as keyword
+                         arguments and returning the page as a mapping
+                         holding 'images' and, if there may be more, a
+                         'next_cursor'
+        :param params: params of the first page; 'limit' sets the page size
+        """
+        params = dict(params)
+        while True:
+            page = get_page(**params)
+            for image in page['images']:
+                yield image
+            if not page['images'] or not page.get('next_cursor'):
+                return
+            params.pop('marker', None)
+            params['cursor'] = page['next_cursor']
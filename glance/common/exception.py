@@ -161,5 +161,36 @@ class StoreAddDisabled(GlanceException):
                "store is disabled.")
 
 
+class ImageCacheFillFailed(GlanceException):
+    message = _("Caching of image %(image_id)s did not complete.")
+
+
 class InvalidNotifierStrategy(GlanceException):
     message = "'%(strategy)s' is not an available notifier strategy."
+
+
+class InvalidNotifierOverflowPolicy(GlanceException):
+    message = "'%(policy)s' is not an available notifier overflow policy."
+
+
+class InvalidCacheEvictionPolicy(GlanceException):
+    message = _("'%(policy)s' is not an available image cache eviction "
+                "policy.")
+
+
+class InvalidChecksumAlgorithm(GlanceException):
+    message = _("'%(algorithm)s' is not an available checksum algorithm.")
+
+
+class InvalidCursor(GlanceException):
+    message = _("The pagination cursor is malformed or has been tampered "
+                "with.")
+
+
+class ImageCacheFull(GlanceException):
+    message = _("Image %(image_id)s does not fit in the image cache.")
+
+
+class ImageCacheBusy(GlanceException):
+    message = _("Image %(image_id)s is already being written to the image "
+                "cache.")
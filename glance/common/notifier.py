@@ -16,15 +16,28 @@
 #    under the License.
 
 import datetime
+import errno
+import fcntl
+import json
 import logging
+import os
 import socket
+import time
 import uuid
 
+import eventlet
+import eventlet.queue
+import eventlet.timeout
+import eventlet.tpool
 import kombu.connection
+import kombu.entity
+import kombu.messaging
 
 from glance.common import config
 from glance.common import exception
 
+logger = logging.getLogger('glance.notifier')
+
 
 class NoopStrategy(object):
     """A notifier that does nothing when called."""
@@ -59,7 +72,27 @@ class LoggingStrategy(object):
 
 
 class RabbitStrategy(object):
-    """A notifier that puts a message on a queue when called."""
+    """
+    A notifier that puts a message on a queue when called.
+
+    Messages are not sent to the broker while the caller waits. They are
+    put on a bounded in-memory queue, and a background green thread
+    publishes them in batches over one long-lived channel, committing each
+    batch in a single AMQP transaction. When the queue is full,
+    `rabbit_overflow_policy` decides what happens to a new message:
+    `drop_new` discards it, `drop_oldest` discards the oldest queued
+    message to make room for it, and `block` makes the caller wait for
+    room. Dropped messages are counted, and logged at most once every
+    `DROP_LOG_INTERVAL` seconds.
+    """
+
+    OVERFLOW_POLICIES = ('drop_new', 'drop_oldest', 'block')
+
+    # Seconds to wait before publishing again after losing the broker
+    RETRY_INTERVAL = 1
+
+    # Least seconds between warnings about dropped messages
+    DROP_LOG_INTERVAL = 60
 
     def __init__(self, options):
         """Initialize the rabbit notification strategy."""
@@ -82,6 +115,26 @@ class RabbitStrategy(object):
                                       'str',
                                       'glance_notifications')
 
+        self.max_queue_size = self._get_option('rabbit_max_queue_size',
+                                               'int', 1000)
+        self.batch_size = self._get_option('rabbit_batch_size', 'int', 100)
+        self.overflow_policy = self._get_option('rabbit_overflow_policy',
+                                                'str', 'drop_new')
+        if self.overflow_policy not in self.OVERFLOW_POLICIES:
+            raise exception.InvalidNotifierOverflowPolicy(
+                policy=self.overflow_policy)
+
+        self.queue = eventlet.queue.Queue(self.max_queue_size)
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        self._dropped_unlogged = 0
+        self._drop_logged_at = None
+        self._publisher = None
+        self._channel = None
+        self._transactional = False
+        self._producers = {}
+
     def _get_option(self, name, datatype, default):
         """Retrieve a configuration option."""
         return config.get_option(self._options,
@@ -89,11 +142,526 @@ class RabbitStrategy(object):
                                  type=datatype,
                                  default=default)
 
+    def get_metrics(self):
+        """
+        Returns the number of messages waiting to be published, the most
+        that may wait, and how many have been published, dropped because
+        the queue was full, or failed to publish since the notifier was
+        created
+        """
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue_size': self.max_queue_size,
+                'published': self.published,
+                'dropped': self.dropped,
+                'failed': self.failed}
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message has been published, or for at
+        most `timeout` seconds. Returns True if the queue was emptied.
+        """
+        with eventlet.timeout.Timeout(timeout, False):
+            self.queue.join()
+            return True
+        return False
+
     def _send_message(self, message, priority):
-        topic = "%s.%s" % (self.topic, priority)
-        queue = self.connection.SimpleQueue(topic)
-        queue.put(message, serializer="json")
-        queue.close()
+        if self._publisher is None:
+            self._publisher = eventlet.spawn(self._publish_forever)
+
+        item = (message, priority)
+        if self.overflow_policy == 'block':
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+            return
+        except eventlet.queue.Full:
+            pass
+
+        if self.overflow_policy == 'drop_oldest':
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait(item)
+        self.dropped += 1
+        self._dropped_unlogged += 1
+        now = time.time()
+        if (self._drop_logged_at is None or
+            now - self._drop_logged_at >= self.DROP_LOG_INTERVAL):
+            logger.warn(_("Notification queue is full, dropped %d "
+                          "message(s) since the last warning") %
+                        self._dropped_unlogged)
+            self._dropped_unlogged = 0
+            self._drop_logged_at = now
+
+    def _publish_forever(self):
+        """Publishes queued messages a batch at a time"""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except eventlet.queue.Empty:
+                    break
+            self._publish_batch(batch)
+
+    def _publish_batch(self, batch):
+        """
+        Publishes a batch of messages in one transaction. After a
+        connection error the channel is opened again and the batch is
+        published again, from the start if the transaction was rolled
+        back; a message that cannot be published for any other reason is
+        logged and dropped.
+        """
+        broker_errors = (self.connection.connection_errors +
+                         self.connection.channel_errors)
+        done = 0
+        failed = 0
+        while True:
+            try:
+                for message, priority in batch[done:]:
+                    try:
+                        self._publish(message, priority)
+                    except broker_errors:
+                        raise
+                    except Exception:
+                        logger.exception(_("Failed to publish notification"))
+                        failed += 1
+                    done += 1
+                self._commit()
+                break
+            except broker_errors, e:
+                logger.error(_("Failed to publish %(count)d notifications, "
+                               "retrying in %(interval)s seconds: %(e)s") %
+                             dict(count=len(batch) - done,
+                                  interval=self.RETRY_INTERVAL, e=e))
+                if self._transactional:
+                    # Nothing since the last commit reached the queues
+                    done = 0
+                    failed = 0
+                self._close_channel()
+                eventlet.sleep(self.RETRY_INTERVAL)
+
+        self.published += len(batch) - failed
+        self.failed += failed
+        for item in batch:
+            self.queue.task_done()
+
+    def publish(self, message, priority):
+        """
+        Publishes a message straight away, for callers that need to know
+        it reached the broker. The channel is opened again on the next
+        call after a connection error.
+        """
+        broker_errors = (self.connection.connection_errors +
+                         self.connection.channel_errors)
+        try:
+            self._publish(message, priority)
+            self._commit()
+        except broker_errors:
+            self._close_channel()
+            raise
+
+    def _publish(self, message, priority):
+        if self._channel is None:
+            self.connection.connect()
+            self._channel = self.connection.channel()
+            # Not every kombu transport has AMQP transactions
+            self._transactional = hasattr(self._channel, 'tx_select')
+            if self._transactional:
+                self._channel.tx_select()
+
+        producer = self._producers.get(priority)
+        if producer is None:
+            topic = "%s.%s" % (self.topic, priority)
+            exchange = kombu.entity.Exchange(topic, 'direct')
+            kombu.entity.Queue(topic, exchange, topic)(self._channel).declare()
+            producer = kombu.messaging.Producer(self._channel, exchange,
+                                                routing_key=topic,
+                                                serializer='json')
+            self._producers[priority] = producer
+        producer.publish(message)
+
+    def _commit(self):
+        """Commits the messages published since the last commit"""
+        if self._transactional and self._channel is not None:
+            self._channel.tx_commit()
+
+    def _close_channel(self):
+        self._producers = {}
+        self._channel = None
+        self._transactional = False
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+    def warn(self, msg):
+        self._send_message(msg, "WARN")
+
+    def info(self, msg):
+        self._send_message(msg, "INFO")
+
+    def error(self, msg):
+        self._send_message(msg, "ERROR")
+
+
+class SpoolingStrategy(object):
+    """
+    A notifier that writes messages to a spool on local disk when called,
+    and sends them on with another strategy in the background.
+
+    Messages are appended to segment files in `notifier_spool_dir`, so the
+    caller only waits for a local write whatever the state of the broker.
+    A background green thread syncs the spool to disk once for all the
+    messages written since it last ran, then delivers them with the
+    `notifier_spool_strategy` strategy and records how far it got.
+    Messages that cannot be delivered stay in the spool and are retried,
+    across restarts too, and segments are removed once all their messages
+    have been delivered. A message that still fails after
+    `notifier_spool_max_attempts` tries is moved to the spool's
+    ``dead-letter`` file so that those behind it can be delivered.
+
+    Each process spools to a numbered subdirectory of `notifier_spool_dir`
+    that it holds a lock on, so that the workers of a server do not share
+    segments and a new worker picks up where a dead one left off. A process
+    also adopts the spools that no process holds when it starts, such as
+    those left behind when a server is restarted with fewer workers, and
+    delivers what remains in them.
+    """
+
+    # Seconds to wait before delivering again after a failed delivery,
+    # doubled after each further failure up to MAX_RETRY_INTERVAL
+    RETRY_INTERVAL = 1
+    MAX_RETRY_INTERVAL = 60
+
+    def __init__(self, options):
+        self.spool_dir = config.get_option(
+            options, 'notifier_spool_dir', type='str',
+            default='/var/lib/glance/notifications')
+        self.segment_size = config.get_option(
+            options, 'notifier_spool_segment_size', type='int',
+            default=1024 * 1024)
+        self.max_attempts = config.get_option(
+            options, 'notifier_spool_max_attempts', type='int', default=10)
+        strategy = config.get_option(options, 'notifier_spool_strategy',
+                                     type='str', default='rabbit')
+        if strategy == 'spool' or strategy not in Notifier.STRATEGIES:
+            raise exception.InvalidNotifierStrategy(strategy=strategy)
+        self.strategy = Notifier.STRATEGIES[strategy](options)
+        self.pid = None
+
+    def _open(self):
+        """Claims a spool directory for this process and starts delivery"""
+        slot = 0
+        while True:
+            path = os.path.join(self.spool_dir, str(slot))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            lock_file = self._lock_spool(path)
+            if lock_file is not None:
+                break
+            slot += 1
+
+        self.pid = os.getpid()
+        self.path = path
+        self._lock_file = lock_file
+        segments = self._get_segments(path)
+        self._position = self._read_position(path, segments)
+        # Messages go to a new segment, after any a crash left incomplete
+        self._open_segment(segments[-1] + 1 if segments else 0)
+        self._unsynced = []
+        # The message that failed last, and how many times it has failed
+        self._failing = (None, 0)
+        self._orphans = self._claim_orphans()
+        self._wake = eventlet.queue.Queue(1)
+        self._wake.put_nowait(True)
+        self._deliverer = eventlet.spawn(self._deliver_forever)
+
+    @staticmethod
+    def _lock_spool(path):
+        """Returns the locked lock file of a spool directory, or None if
+        another process holds it
+        """
+        lock_file = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return lock_file
+
+    def _claim_orphans(self):
+        """
+        Locks the other spool directories that hold segments but that no
+        process has claimed, and returns their paths and lock files
+        """
+        orphans = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if (path == self.path or not name.isdigit() or
+                not self._has_undelivered(path)):
+                continue
+            lock_file = self._lock_spool(path)
+            if lock_file is None:
+                continue
+            if self._has_undelivered(path):
+                logger.info(_("Adopting the orphaned notification spool "
+                              "%s") % path)
+                orphans.append((path, lock_file))
+            else:
+                lock_file.close()
+        return orphans
+
+    def _has_undelivered(self, path):
+        """Whether a spool directory holds messages not yet delivered"""
+        segments = self._get_segments(path)
+        if not segments:
+            return False
+        last = segments[-1]
+        size = os.path.getsize(self._get_segment_path(path, last))
+        return self._read_position(path, segments) != (last, size)
+
+    def close(self):
+        """Stops delivery and releases the spool directory"""
+        if self.pid != os.getpid():
+            return
+        self._deliverer.kill()
+        for segment in self._unsynced:
+            segment.close()
+        self._segment.close()
+        for path, lock_file in self._orphans:
+            lock_file.close()
+        self._lock_file.close()
+        self.pid = None
+
+    @staticmethod
+    def _get_segments(path):
+        return sorted(int(name[:-len('.log')])
+                      for name in os.listdir(path)
+                      if name.endswith('.log'))
+
+    @staticmethod
+    def _get_segment_path(path, number):
+        return os.path.join(path, '%020d.log' % number)
+
+    def _open_segment(self, number):
+        self._segment_number = number
+        self._segment = open(self._get_segment_path(self.path, number), 'a')
+
+    @staticmethod
+    def _read_position(path, segments):
+        """
+        Returns the segment and offset of the first message not yet
+        delivered
+        """
+        if not segments:
+            return 0, 0
+        try:
+            with open(os.path.join(path, 'position')) as f:
+                number, offset = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return segments[0], 0
+        if number < segments[0]:
+            return segments[0], 0
+        if number > segments[-1]:
+            # Only new messages can be written past the last segment
+            return segments[-1] + 1, 0
+        return number, offset
+
+    @staticmethod
+    def _write_position(path, number, offset):
+        path = os.path.join(path, 'position')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([number, offset], f)
+        os.rename(tmp_path, path)
+
+    def _set_position(self, number, offset):
+        self._position = (number, offset)
+        self._write_position(self.path, number, offset)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every spooled message has been delivered, or for at
+        most `timeout` seconds. Returns True if they all were.
+        """
+        if self.pid != os.getpid():
+            return True
+        with eventlet.timeout.Timeout(timeout, False):
+            while (self._orphans or
+                   self._position != (self._segment_number,
+                                      self._segment.tell())):
+                eventlet.sleep(0.01)
+            return True
+        return False
+
+    def _send_message(self, message, priority):
+        if self.pid != os.getpid():
+            self._open()
+
+        record = json.dumps({'priority': priority, 'message': message})
+        try:
+            self._segment.write(record + '\n')
+            self._segment.flush()
+            if self._segment.tell() >= self.segment_size:
+                # The delivery thread syncs and closes the full segment
+                self._unsynced.append(self._segment)
+                self._open_segment(self._segment_number + 1)
+        except (IOError, OSError), e:
+            logger.error(_("Failed to spool notification: %s") % e)
+            return
+
+        try:
+            self._wake.put_nowait(True)
+        except eventlet.queue.Full:
+            pass
+
+    def _deliver_forever(self):
+        interval = self.RETRY_INTERVAL
+        while True:
+            self._wake.get()
+            try:
+                self._sync()
+                self._deliver()
+                self._deliver_orphans()
+                interval = self.RETRY_INTERVAL
+            except Exception, e:
+                logger.error(_("Failed to deliver spooled notifications, "
+                               "retrying in %(interval)s seconds: %(e)s") %
+                             locals())
+                eventlet.sleep(interval)
+                interval = min(interval * 2, self.MAX_RETRY_INTERVAL)
+                try:
+                    self._wake.put_nowait(True)
+                except eventlet.queue.Full:
+                    pass
+
+    def _sync(self):
+        """Syncs the segments written to since the last delivery to disk"""
+        # fsync can take a while, so it is run in a thread rather than
+        # holding up every green thread in the process
+        while self._unsynced:
+            segment = self._unsynced[0]
+            eventlet.tpool.execute(os.fsync, segment.fileno())
+            segment.close()
+            self._unsynced.pop(0)
+        eventlet.tpool.execute(os.fsync, self._segment.fileno())
+
+    def _deliver(self):
+        """Delivers this process' spooled messages"""
+        self._deliver_spool(self.path, self._position, self._segment_number,
+                            self._set_position)
+
+    def _deliver_orphans(self):
+        """Delivers the messages left in adopted spools, then releases them"""
+        while self._orphans:
+            path, lock_file = self._orphans[0]
+            position = self._read_position(path, self._get_segments(path))
+            self._deliver_spool(
+                path, position, None,
+                lambda number, offset: self._write_position(path, number,
+                                                            offset))
+            os.unlink(os.path.join(path, 'position'))
+            lock_file.close()
+            self._orphans.pop(0)
+
+    def _deliver_spool(self, path, position, last, set_position):
+        """
+        Delivers the messages spooled in `path` from `position` on,
+        removing each segment once all of its messages are delivered. The
+        segment numbered `last` is still being written to, so is read to
+        its end but kept; with no `last`, every segment is removed.
+
+        :param set_position: callable taking the segment and offset of the
+                             first message not yet delivered
+        """
+        number, offset = position
+        while True:
+            segment_path = self._get_segment_path(path, number)
+            try:
+                f = open(segment_path)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # The segment is gone, so go on from the next one there is
+                later = [n for n in self._get_segments(path) if n > number]
+                if not later:
+                    return
+                logger.warn(_("Notification spool segment %(segment_path)s "
+                              "is missing, skipping to segment %(next)d")
+                            % dict(segment_path=segment_path, next=later[0]))
+                number, offset = later[0], 0
+                set_position(number, offset)
+                continue
+
+            start = offset
+            f.seek(offset)
+            try:
+                while True:
+                    line = f.readline()
+                    # A line without a newline is either still being
+                    # written or was cut short by a crash
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.error(_("Skipping corrupt notification in "
+                                       "%(segment_path)s at %(offset)d")
+                                     % locals())
+                    else:
+                        self._try_deliver_message(
+                            path, (segment_path, offset), line, record)
+                    offset += len(line)
+            finally:
+                f.close()
+                if offset != start:
+                    set_position(number, offset)
+
+            if number == last:
+                return
+            os.unlink(segment_path)
+            number += 1
+            offset = 0
+            set_position(number, offset)
+
+    def _try_deliver_message(self, path, key, line, record):
+        """
+        Delivers a spooled message, or moves it to the dead-letter file of
+        spool directory `path` once it has failed `max_attempts` times
+
+        :param key: where the message is spooled, so that its failures are
+                    told apart from those of other messages
+        """
+        try:
+            self._deliver_message(record['message'], record['priority'])
+        except Exception, e:
+            failing, attempts = self._failing
+            attempts = attempts + 1 if failing == key else 1
+            self._failing = (key, attempts)
+            if attempts < self.max_attempts:
+                raise
+            dead_letter_path = os.path.join(path, 'dead-letter')
+            logger.error(_("Giving up on notification after %(attempts)d "
+                           "attempts, moving it to %(dead_letter_path)s: "
+                           "%(e)s") % locals())
+            with open(dead_letter_path, 'a') as f:
+                f.write(line)
+                f.flush()
+                eventlet.tpool.execute(os.fsync, f.fileno())
+        self._failing = (None, 0)
+
+    def _deliver_message(self, message, priority):
+        publish = getattr(self.strategy, 'publish', None)
+        if publish is not None:
+            publish(message, priority)
+        else:
+            getattr(self.strategy, priority.lower())(message)
 
     def warn(self, msg):
         self._send_message(msg, "WARN")
@@ -111,6 +679,7 @@ class Notifier(object):
     STRATEGIES = {
         "logging": LoggingStrategy,
         "rabbit": RabbitStrategy,
+        "spool": SpoolingStrategy,
         "noop": NoopStrategy,
         "default": NoopStrategy,
     }
@@ -21,12 +21,22 @@
 Utility methods for working with WSGI servers
 """
 
+import ctypes
+import ctypes.util
+import errno
 import json
 import logging
+import os
+import signal
+import socket
 import sys
 import datetime
+import time
+import types
 
 import eventlet
+import eventlet.greenio
+import eventlet.hubs
 import eventlet.wsgi
 eventlet.patcher.monkey_patch(all=False, socket=True)
 import routes
@@ -55,28 +65,310 @@ def run_server(application, port):
 
 
 class Server(object):
-    """Server class to manage multiple WSGI sockets and applications."""
+    """Server class to manage multiple WSGI sockets and applications.
+
+    With `workers` greater than 0 the server pre-forks: the listening
+    socket is bound once and that many worker processes are forked, each
+    accepting connections on it and serving them with a green pool of its
+    own. The parent process only supervises the workers, restarting any that
+    die, after a growing delay if they keep dying soon after they start. On
+    SIGTERM it kills the workers and exits; on SIGHUP the workers
+    stop accepting connections, finish the requests in progress and exit,
+    and the parent exits once they all have.
+
+    With no workers the requests are served in this process, which drains
+    in the same way on SIGHUP.
+    """
+
+    DRAIN_POLL_INTERVAL = 1  # seconds
+
+    # A worker that dies within MIN_WORKER_LIFETIME seconds of starting is
+    # taken to be crashing, and the next one is started after a delay that
+    # doubles with each such crash, from MIN_RESTART_INTERVAL seconds up to
+    # MAX_RESTART_INTERVAL seconds
+    MIN_WORKER_LIFETIME = 10
+    MIN_RESTART_INTERVAL = 1
+    MAX_RESTART_INTERVAL = 60
 
-    def __init__(self, threads=1000):
+    def __init__(self, threads=1000, workers=0):
+        self.threads = threads
+        self.workers = workers
         self.pool = eventlet.GreenPool(threads)
+        # The start time of each worker, by pid
+        self.children = {}
+        self.restart_interval = 0
+        self.running = True
+        self.logger = logging.getLogger('eventlet.wsgi.server')
 
     def start(self, application, port, host='0.0.0.0', backlog=128):
         """Run a WSGI server with the given application."""
         socket = eventlet.listen((host, port), backlog=backlog)
-        self.pool.spawn_n(self._run, application, socket)
+        self.application = application
+        self.socket = socket
+        if not self.workers:
+            signal.signal(signal.SIGHUP, self._stop_worker)
+            self.server = eventlet.spawn(self._run, application, socket)
+            return
+
+        signal.signal(signal.SIGTERM, self._kill_children)
+        signal.signal(signal.SIGHUP, self._drain_children)
+        self.logger.info(_("Starting %d workers") % self.workers)
+        while len(self.children) < self.workers:
+            self._run_child()
 
     def wait(self):
         """Wait until all servers have completed running."""
+        if self.workers:
+            self._wait_on_children()
+            return
         try:
-            self.pool.waitall()
+            self._drain(self.server)
         except KeyboardInterrupt:
             pass
 
     def _run(self, application, socket):
         """Start a WSGI server in a new green thread."""
-        logger = logging.getLogger('eventlet.wsgi.server')
         eventlet.wsgi.server(socket, application, custom_pool=self.pool,
-                             log=WritableLogger(logger))
+                             log=WritableLogger(self.logger),
+                             protocol=HttpProtocol,
+                             environ={'wsgi.file_wrapper': FileWrapper})
+
+    def _kill_children(self, *args):
+        """SIGTERM handler of the parent process"""
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.running = False
+        self._signal_children(signal.SIGTERM)
+        sys.exit(0)
+
+    def _drain_children(self, *args):
+        """SIGHUP handler of the parent process"""
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.running = False
+        # Let a new server bind the port while the workers finish up
+        self.socket.close()
+        self._signal_children(signal.SIGHUP)
+
+    def _signal_children(self, sig):
+        for pid in self.children:
+            try:
+                os.kill(pid, sig)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _run_child(self):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker()
+            os._exit(0)
+        self.logger.info(_("Started worker %d") % pid)
+        self.children[pid] = time.time()
+
+    def _wait_on_children(self):
+        """Reaps the workers as they exit, starting a new one in place of
+        each worker that dies while the server is running. Workers that
+        crash soon after starting are replaced ever more slowly, so that a
+        server that cannot start does not fork in a tight loop.
+        """
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            except KeyboardInterrupt:
+                self.running = False
+                self._signal_children(signal.SIGTERM)
+                break
+            if pid not in self.children:
+                continue
+            started = self.children.pop(pid)
+            if not self.running:
+                continue
+            if time.time() - started < self.MIN_WORKER_LIFETIME:
+                self.restart_interval = min(
+                    max(self.restart_interval * 2,
+                        self.MIN_RESTART_INTERVAL),
+                    self.MAX_RESTART_INTERVAL)
+            else:
+                self.restart_interval = 0
+            interval = self.restart_interval
+            self.logger.error(_("Worker %(pid)d died with status "
+                                "%(status)d, starting a new one in "
+                                "%(interval)s seconds") % locals())
+            if interval:
+                time.sleep(interval)
+            # A signal during the sleep may have stopped the server
+            if self.running:
+                self._run_child()
+        self.logger.info(_("All workers have exited"))
+
+    def _run_worker(self):
+        """Serves requests in a forked worker until it is told to stop"""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, self._stop_worker)
+        # The parent stops the workers when it is interrupted
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.children = {}
+        self.pool = eventlet.GreenPool(self.threads)
+        self._drain(eventlet.spawn(self._run, self.application, self.socket))
+
+    def _drain(self, server):
+        """Waits until the server green thread is stopped, then for the
+        requests in progress to finish
+        """
+        # The signal handler only clears the flag, since it can interrupt
+        # any green thread; the server is stopped from this one instead
+        while self.running and not server.dead:
+            eventlet.sleep(self.DRAIN_POLL_INTERVAL)
+        self.logger.info(_("Worker %d draining") % os.getpid())
+        server.kill()
+        self.socket.close()
+        self.pool.waitall()
+        self.logger.info(_("Worker %d exiting") % os.getpid())
+
+    def _stop_worker(self, *args):
+        """SIGHUP handler of a worker process, or of the server when it has
+        no workers
+        """
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.running = False
+
+
+def _load_sendfile():
+    """
+    Returns libc's sendfile(2) as a callable taking (out_fd, in_fd, offset,
+    count) and returning the number of bytes sent, or None if it is not
+    available. Python 2 has no os.sendfile, so it is called through ctypes.
+    """
+    # Other platforms' sendfile(2) take different arguments
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, os.strerror(err))
+        return sent
+
+    return sendfile
+
+
+_sendfile = _load_sendfile()
+
+
+class FileWrapper(object):
+    """
+    A PEP 333 `wsgi.file_wrapper` for the eventlet WSGI server.
+
+    When the response has a Content-Length, `HttpProtocol` writes the file
+    to a plain socket with sendfile(2), so that its data never passes
+    through Python. Otherwise the file is read in `blksize` blocks, which
+    are much larger than the chunks applications normally yield.
+    """
+
+    def __init__(self, filelike, blksize=1024 * 1024):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def can_sendfile(self, sock):
+        """Whether the file can be written to `sock` with `sendfile`"""
+        # sendfile(2) would bypass the encryption of an SSL socket
+        return (_sendfile is not None and
+                type(sock) is eventlet.greenio.GreenSocket and
+                hasattr(self.filelike, 'fileno'))
+
+    def sendfile(self, sock, count):
+        """
+        Writes `count` bytes of the file from its current position to a
+        green socket with sendfile(2), waiting on the hub whenever the
+        socket's buffer is full.
+        """
+        out_fd = sock.fileno()
+        in_fd = self.filelike.fileno()
+        offset = self.filelike.tell()
+        while count > 0:
+            try:
+                sent = _sendfile(out_fd, in_fd, offset, count)
+            except socket.error, e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                eventlet.hubs.trampoline(out_fd, write=True,
+                                         timeout=sock.gettimeout(),
+                                         timeout_exc=socket.timeout)
+                continue
+            if not sent:
+                raise IOError(_("File ended %d bytes before the end of the "
+                                "response") % count)
+            offset += sent
+            count -= sent
+        self.filelike.seek(offset)
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    eventlet's HTTP protocol, except that a `FileWrapper` returned by the
+    application with a Content-Length is written with sendfile(2).
+    """
+
+    def handle_one_response(self):
+        application = self.application
+
+        def send_files(environ, start_response):
+            started = []
+
+            def capture_start_response(status, headers, exc_info=None):
+                started[:] = [headers,
+                              start_response(status, headers, exc_info)]
+                return started[1]
+
+            result = application(environ, capture_start_response)
+            if not (started and isinstance(result, FileWrapper) and
+                    result.can_sendfile(self.connection)):
+                return result
+            headers, write = started
+            lengths = [value for name, value in headers
+                       if name.lower() == 'content-length']
+            if not lengths:
+                return result
+            try:
+                # With a Content-Length, an empty write sends just the
+                # headers, after which the body goes straight to the socket
+                write('')
+                result.sendfile(self.connection, int(lengths[0]))
+            finally:
+                result.close()
+            return []
+
+        self.application = send_files
+        eventlet.wsgi.HttpProtocol.handle_one_response(self)
 
 
 class Middleware(object):
@@ -255,6 +547,9 @@ class JSONRequestDeserializer(object):
 
 class JSONResponseSerializer(object):
 
+    # Streamed responses are written in chunks of about this many bytes
+    STREAM_CHUNK_SIZE = 64 * 1024
+
     def to_json(self, data):
         def sanitizer(obj):
             if isinstance(obj, datetime.datetime):
@@ -263,9 +558,69 @@ class JSONResponseSerializer(object):
 
         return json.dumps(data, default=sanitizer)
 
+    @staticmethod
+    def is_streamed(result):
+        """
+        Returns whether a result is a mapping holding a generator, which
+        is to be written out as it produces items rather than all at once
+        """
+        return isinstance(result, dict) and any(
+                isinstance(value, types.GeneratorType)
+                for value in result.itervalues())
+
+    def to_json_chunks(self, result):
+        """
+        Yields the JSON for a streamed result in chunks of about
+        STREAM_CHUNK_SIZE bytes.
+
+        Generators in the mapping are written first, as arrays, one item
+        at a time. Values that are callables are then called, so that they
+        may describe what the generators produced, and written unless they
+        return None. Other values are written as they are.
+        """
+        streams = []
+        values = []
+        for key, value in result.iteritems():
+            if isinstance(value, types.GeneratorType):
+                streams.append((key, value))
+            else:
+                values.append((key, value))
+
+        buf = ['{']
+        size = 1
+        separator = ''
+        for key, stream in streams:
+            buf.append('%s%s: [' % (separator, json.dumps(key)))
+            separator = ', '
+            for j, item in enumerate(stream):
+                chunk = self.to_json(item)
+                if j:
+                    chunk = ', ' + chunk
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= self.STREAM_CHUNK_SIZE:
+                    yield ''.join(buf)
+                    buf = []
+                    size = 0
+            buf.append(']')
+
+        for key, value in values:
+            if callable(value):
+                value = value()
+                if value is None:
+                    continue
+            buf.append('%s%s: %s' % (separator, json.dumps(key),
+                                     self.to_json(value)))
+            separator = ', '
+        buf.append('}')
+        yield ''.join(buf)
+
     def default(self, response, result):
         response.headers.add('Content-Type', 'application/json')
-        response.body = self.to_json(result)
+        if self.is_streamed(result):
+            response.app_iter = self.to_json_chunks(result)
+        else:
+            response.body = self.to_json(result)
 
 
 class Resource(object):
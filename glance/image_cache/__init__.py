@@ -20,14 +20,19 @@ LRU Cache for Image Data
 """
 from contextlib import contextmanager
 import datetime
-import itertools
+import errno
+import fcntl
 import logging
 import os
 import sys
 import time
 
+import eventlet
+
 from glance.common import config
 from glance.common import exception
+from glance.image_cache import index
+from glance.image_cache import policies
 from glance import utils
 
 logger = logging.getLogger('glance.image_cache')
@@ -44,17 +49,41 @@ class ImageCache(object):
     Assumptions
     ===========
 
-        1. Cache data directory exists on a filesytem that updates atime on
-           reads ('noatime' should NOT be set)
+        1. `glance-prune` is scheduled to run as a periodic job via cron, or
+           `image_cache_auto_prune` is enabled. This is needed to run the
+           eviction policy to keep the cache size within the limits set by
+           the config file.
+
+    Cache Index
+    ===========
+
+    The name, size, state, hit count and last access time of each entry,
+    as well as the prefetch queue, are kept in a SQLite database (see
+    `glance.image_cache.index`) which is updated as entries are written,
+    read and purged. Listing, pruning and prefetching therefore don't scan
+    the cache directories, and the cache works on filesystems mounted with
+    'noatime' or without xattr support.
+
+    If the index file is missing (on the first run after an upgrade, say)
+    it is rebuilt from the cache directories and any xattrs left on the
+    files.
+
+    Automatic Pruning
+    =================
+
+    With `image_cache_auto_prune` enabled, each process keeps a running
+    total of the bytes in the cache (see `CacheUsage`). Once it crosses the
+    high watermark, entries are evicted in a background green thread until
+    usage falls to the low watermark, and images whose expected size won't
+    fit in the cache are not admitted at all.
 
-        2. Cache data directory exists on a filesystem that supports xattrs.
-           This is optional, but highly recommended since it allows us to
-           present ops with useful information pertaining to the cache, like
-           human readable filenames and statistics.
+    Concurrent Misses
+    =================
 
-        3. `glance-prune` is scheduled to run as a periodic job via cron. This
-            is needed to run the LRU prune strategy to keep the cache size
-            within the limits set by the config file.
+    Only the first reader to miss on an image tees it into the incomplete
+    directory. Readers that miss while that fill is in progress follow the
+    growing incomplete file behind the writer (see `follow_incomplete`)
+    rather than fetching their own copy from the backend store.
 
 
     Cache Directory Notes
@@ -67,16 +96,19 @@ class ImageCache(object):
     The layout looks like:
 
         image-cache/
+            cache.db
             entry1
             entry2
             ...
             incomplete/
             invalid/
-            prefetch/
-            prefetching/
     """
+
+    FOLLOW_POLL_INTERVAL = 0.1  # seconds
+
     def __init__(self, options):
         self.options = options
+        self._index = None
         self._make_cache_directory_if_needed()
 
     def _make_cache_directory_if_needed(self):
@@ -86,8 +118,7 @@ class ImageCache(object):
 
         # NOTE(sirp): making the incomplete_path will have the effect of
         # creating the main cache path directory as well
-        paths = [self.incomplete_path, self.invalid_path, self.prefetch_path,
-                 self.prefetching_path]
+        paths = [self.incomplete_path, self.invalid_path]
 
         for path in paths:
             if os.path.exists(path):
@@ -101,12 +132,74 @@ class ImageCache(object):
         return config.get_option(
             self.options, 'image_cache_enabled', type='bool', default=False)
 
+    @property
+    def follow_timeout(self):
+        """Number of seconds a reader following an in-progress cache fill
+        will wait for the writer to make progress before giving up
+        """
+        return config.get_option(
+            self.options, 'image_cache_follow_timeout', type='int',
+            default=60)
+
+    @property
+    def max_size(self):
+        """Number of bytes the cache may hold"""
+        default = 1 * 1024 * 1024 * 1024  # 1 GB
+        return config.get_option(
+            self.options, 'image_cache_max_size_bytes',
+            type='int', default=default)
+
+    @property
+    def auto_prune(self):
+        """Whether this process prunes the cache as it fills, rather than
+        leaving it to `glance-cache-pruner`
+        """
+        return config.get_option(
+            self.options, 'image_cache_auto_prune', type='bool',
+            default=False)
+
+    @property
+    def high_watermark(self):
+        """Fraction of `max_size` above which automatic pruning starts"""
+        return config.get_option(
+            self.options, 'image_cache_high_watermark', type='float',
+            default=0.9)
+
+    @property
+    def low_watermark(self):
+        """Fraction of `max_size` at which automatic pruning stops"""
+        return config.get_option(
+            self.options, 'image_cache_low_watermark', type='float',
+            default=0.8)
+
+    @property
+    def usage(self):
+        """The `CacheUsage` of this cache in this process, or None if
+        automatic pruning is disabled
+        """
+        if not self.auto_prune:
+            return None
+        return CacheUsage.for_cache(self)
+
     @property
     def path(self):
         """This is the base path for the image cache"""
         datadir = self.options['image_cache_datadir']
         return datadir
 
+    @property
+    def index_path(self):
+        """This is the SQLite database holding the cache index"""
+        return os.path.join(self.path, 'cache.db')
+
+    @property
+    def index(self):
+        """The `glance.image_cache.index.CacheIndex` for this cache"""
+        if self._index is None:
+            self._index = index.get_index(self.index_path,
+                                          self._rebuild_index)
+        return self._index
+
     @property
     def incomplete_path(self):
         """This provides a temporary place to write our cache entries so that
@@ -132,14 +225,16 @@ class ImageCache(object):
 
     @property
     def prefetch_path(self):
-        """This contains a list of image ids that should be pre-fetched into
-        the cache
+        """Directory in which earlier versions of the cache queued
+        prefetch jobs. It is only read when rebuilding the index.
         """
         return os.path.join(self.path, 'prefetch')
 
     @property
     def prefetching_path(self):
-        """This contains image ids that currently being prefetched"""
+        """Directory in which earlier versions of the cache kept the
+        prefetch jobs in progress. It is only read when rebuilding the index.
+        """
         return os.path.join(self.path, 'prefetching')
 
     def path_for_image(self, image_id):
@@ -186,41 +281,100 @@ class ImageCache(object):
     def _open_write(self, image_meta, mode):
         image_id = image_meta['id']
         incomplete_path = self.incomplete_path_for_image(image_id)
+        name = image_meta['name']
+        expected_size = image_meta['size']
 
-        def set_xattr(key, value):
-            utils.set_xattr(incomplete_path, key, value)
+        usage = self.usage
+        if usage and not usage.admit(expected_size):
+            raise exception.ImageCacheFull(image_id=image_id)
 
         def commit():
-            set_xattr('image_name', image_meta['name'])
-            set_xattr('hits', 0)
-
             final_path = self.path_for_image(image_id)
             logger.debug(_("fetch finished, commiting by moving "
                          "'%(incomplete_path)s' to '%(final_path)s'"),
                          dict(incomplete_path=incomplete_path,
                               final_path=final_path))
             os.rename(incomplete_path, final_path)
+            size = os.path.getsize(final_path)
+            self.index.upsert_entry(image_id, index.CACHED, name=name,
+                                    size=size, expected_size=expected_size)
+            return size
 
         def rollback(e):
-            set_xattr('image_name', image_meta['name'])
-            set_xattr('error', "%s" % e)
-
             invalid_path = self.invalid_path_for_image(image_id)
             logger.debug(_("fetch errored, rolling back by moving "
                          "'%(incomplete_path)s' to '%(invalid_path)s'"),
                          dict(incomplete_path=incomplete_path,
                               invalid_path=invalid_path))
-            os.rename(incomplete_path, invalid_path)
+            try:
+                os.rename(incomplete_path, invalid_path)
+                self.index.upsert_entry(image_id, index.INVALID, name=name,
+                                        size=os.path.getsize(invalid_path),
+                                        expected_size=expected_size,
+                                        error=str(e) or e.__class__.__name__)
+            except Exception:
+                logger.exception(_("Failed to roll back cache fill of "
+                                   "image '%s'"), image_id)
+
+        # The reservation is given back on every way out that doesn't
+        # commit, including a client disconnecting, which closes the
+        # generator writing the file with GeneratorExit
+        reserved = usage is not None
+        try:
+            cache_file = self._lock_incomplete(image_id, mode)
+            with cache_file:
+                self.index.upsert_entry(image_id, index.INCOMPLETE, name=name,
+                                        expected_size=expected_size)
+                try:
+                    yield cache_file
+                except BaseException as e:
+                    rollback(e)
+                    raise
+                # Committed while the file is still locked, so that
+                # followers never see an unlocked incomplete file from a
+                # writer that succeeded
+                cache_file.flush()
+                size = commit()
+            if usage:
+                reserved = False
+                usage.committed(expected_size, size)
+        finally:
+            if reserved:
+                usage.release(expected_size)
+
+    def _lock_incomplete(self, image_id, mode):
+        """Opens the incomplete file of an image for writing, holding an
+        exclusive lock on it for as long as it is open. Followers take the
+        lock being free as a sign that the writer has died.
+
+        :raises `glance.common.exception.ImageCacheBusy` if another writer
+                holds the lock
+        """
+        path = self.incomplete_path_for_image(image_id)
+        # Not truncated until locked, in case another writer has it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        cache_file = os.fdopen(fd, mode)
+        try:
+            fcntl.flock(cache_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            cache_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise exception.ImageCacheBusy(image_id=image_id)
+        cache_file.truncate()
+        return cache_file
 
+    @staticmethod
+    def _is_locked(cache_file):
+        """Returns true if a writer holds the lock on an incomplete file"""
         try:
-            with open(incomplete_path, mode) as cache_file:
-                set_xattr('expected_size', image_meta['size'])
-                yield cache_file
-        except Exception as e:
-            rollback(e)
-            raise
-        else:
-            commit()
+            fcntl.flock(cache_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        fcntl.flock(cache_file, fcntl.LOCK_UN)
+        return False
 
     @contextmanager
     def _open_read(self, image_meta, mode):
@@ -229,7 +383,95 @@ class ImageCache(object):
         with open(path, mode) as cache_file:
             yield cache_file
 
-        utils.inc_xattr(path, 'hits')  # bump the hit count
+        self.index.record_hit(image_id)
+
+    def open_for_transmit(self, image_meta):
+        """Returns an open file object for a cached image.
+
+        This is for callers that hand the file off (to a WSGI
+        `file_wrapper`, say) rather than reading it inside `open`, so the hit
+        is counted up front and the caller is responsible for closing the
+        file.
+        """
+        path = self.path_for_image(image_meta['id'])
+        cache_file = open(path, 'rb')
+        self.index.record_hit(image_meta['id'])
+        return cache_file
+
+    def follow_incomplete(self, image_meta, chunk_size=65536):
+        """Yields the data of an image that another reader is currently
+        writing into the cache.
+
+        The incomplete file is tail-read behind the writer: when we catch up
+        with it we sleep and poll until either more data shows up, the writer
+        commits the entry (renames it into the main cache directory), or the
+        writer rolls back. Since a rename keeps the inode, our open file
+        handle stays valid across the commit.
+
+        :raises `glance.common.exception.ImageCacheFillFailed` if the writer
+                rolls back, dies (no longer holds the lock on the incomplete
+                file) or makes no progress for `follow_timeout` seconds
+        """
+        image_id = image_meta['id']
+        incomplete_path = self.incomplete_path_for_image(image_id)
+        final_path = self.path_for_image(image_id)
+        expected_size = image_meta.get('size')
+
+        try:
+            cache_file = open(incomplete_path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The writer finished between our caller's check and the open,
+            # so the entry is either committed or invalid by now
+            try:
+                cache_file = open(final_path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                raise exception.ImageCacheFillFailed(image_id=image_id)
+
+        bytes_read = 0
+        idle = 0.0
+        with cache_file:
+            while True:
+                chunk = cache_file.read(chunk_size)
+                if chunk:
+                    bytes_read += len(chunk)
+                    idle = 0.0
+                    yield chunk
+                    continue
+
+                if expected_size and bytes_read >= expected_size:
+                    break
+
+                if not os.path.exists(incomplete_path):
+                    # The writer is done; pick up whatever it wrote after our
+                    # last read, then make sure it actually committed.
+                    for chunk in utils.chunkiter(cache_file, chunk_size):
+                        bytes_read += len(chunk)
+                        yield chunk
+                    if not os.path.exists(final_path):
+                        raise exception.ImageCacheFillFailed(
+                            image_id=image_id)
+                    break
+
+                if not self._is_locked(cache_file) and \
+                        os.path.exists(incomplete_path):
+                    logger.warn(_("Cache fill of image '%(image_id)s' was "
+                                  "abandoned by its writer"), locals())
+                    raise exception.ImageCacheFillFailed(image_id=image_id)
+
+                if idle >= self.follow_timeout:
+                    logger.warn(_("Cache fill of image '%(image_id)s' made no "
+                                  "progress for %(idle)d seconds"), locals())
+                    raise exception.ImageCacheFillFailed(image_id=image_id)
+
+                eventlet.sleep(self.FOLLOW_POLL_INTERVAL)
+                idle += self.FOLLOW_POLL_INTERVAL
+
+        if os.path.exists(final_path):
+            self.index.record_hit(image_id)
 
     def hit(self, image_id):
         return os.path.exists(self.path_for_image(image_id))
@@ -245,40 +487,83 @@ class ImageCache(object):
 
     def purge(self, image_id):
         path = self.path_for_image(image_id)
+        usage = self.usage
+        if usage:
+            entry = self.index.get_entry(image_id)
         self._delete_file(path)
+        self.index.delete_entry(image_id, index.CACHED)
+        if usage and entry and entry['state'] == index.CACHED:
+            usage.removed(entry['size'])
+
+    def evict(self, to_free):
+        """Purges images chosen by the configured eviction policy until at
+        least `to_free` bytes have been freed or the cache is empty.
+
+        :returns: the number of bytes freed
+        """
+        # The policy is seeded with the cached entries in order of their
+        # last access, as recorded in the cache index, after restoring the
+        # state it kept from the last eviction
+        policy = policies.get_policy(self.options, self.max_size)
+        policy.load(*self.index.get_policy_state(policy.name))
+        sizes = {}
+        for entry in self.index.get_entries(index.CACHED,
+                                            order_by='last_accessed'):
+            sizes[entry['image_id']] = entry['size']
+            policy.add(entry['image_id'], entry['size'], entry['hits'])
+
+        freed = 0
+        while to_free > 0 and len(policy):
+            image_id = policy.pop_victim()
+            size = sizes[image_id]
+            logger.debug(_("deleting image %(image_id)s to free "
+                           "%(size)d B"), locals())
+            self.purge(image_id)
+            to_free -= size
+            freed += size
+
+        self.index.save_policy_state(policy.name, *policy.save())
+        return freed
 
     def clear(self):
         purged = 0
-        for path in self.get_all_regular_files(self.path):
-            self._delete_file(path)
+        for entry in self.index.get_entries(index.CACHED):
+            self.purge(entry['image_id'])
             purged += 1
         return purged
 
     def is_image_currently_being_written(self, image_id):
-        """Returns true if we're currently downloading an image"""
+        """Returns true if we're currently downloading an image.
+
+        An incomplete file left by a writer that died is not locked, and
+        doesn't count.
+        """
         incomplete_path = self.incomplete_path_for_image(image_id)
-        return os.path.exists(incomplete_path)
+        try:
+            with open(incomplete_path, 'rb') as cache_file:
+                return self._is_locked(cache_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
 
     def is_currently_prefetching_any_images(self):
-        """True if we are currently prefetching an image.
-
-        We only allow one prefetch to occur at a time.
-        """
-        return len(os.listdir(self.prefetching_path)) > 0
+        """True if we are currently prefetching an image."""
+        return self.index.count_prefetch(index.PREFETCHING) > 0
 
     def is_image_queued_for_prefetch(self, image_id):
-        prefetch_path = os.path.join(self.prefetch_path, str(image_id))
-        return os.path.exists(prefetch_path)
+        return self.index.get_prefetch_state(image_id) == index.QUEUED
 
     def is_image_currently_prefetching(self, image_id):
-        prefetching_path = os.path.join(self.prefetching_path, str(image_id))
-        return os.path.exists(prefetching_path)
+        return self.index.get_prefetch_state(image_id) == index.PREFETCHING
 
-    def queue_prefetch(self, image_meta):
-        """This adds a image to be prefetched to the queue directory.
+    def queue_prefetch(self, image_meta, priority=0):
+        """This adds a image to the prefetch queue. Images with a higher
+        `priority` are prefetched first.
 
-        If the image already exists in the queue directory or the
-        prefetching directory, we ignore it.
+        If the image is already being prefetched, or is already queued with
+        the same priority, we ignore it. If it is queued with a different
+        priority, its priority is changed.
         """
         image_id = image_meta['id']
 
@@ -293,56 +578,65 @@ class ImageCache(object):
             logger.warn(msg)
             raise exception.Invalid(msg)
 
-        if self.is_image_queued_for_prefetch(image_id):
-            msg = _("Skipping prefetch, image '%s' already queued for"
-                    " prefetching") % image_id
-            logger.warn(msg)
-            raise exception.Invalid(msg)
-
-        prefetch_path = os.path.join(self.prefetch_path, str(image_id))
+        if self.index.queue_prefetch(image_id, image_meta['name'],
+                                     priority):
+            return
 
-        # Touch the file to add it to the queue
-        with open(prefetch_path, "w") as f:
-            pass
+        job = self.index.get_prefetch(image_id)
+        if job and job['priority'] != priority:
+            self.index.set_prefetch_priority(image_id, priority)
+            return
 
-        utils.set_xattr(prefetch_path, 'image_name', image_meta['name'])
+        msg = _("Skipping prefetch, image '%s' already queued for"
+                " prefetching") % image_id
+        logger.warn(msg)
+        raise exception.Invalid(msg)
 
     def delete_queued_prefetch_image(self, image_id):
-        prefetch_path = os.path.join(self.prefetch_path, str(image_id))
-        self._delete_file(prefetch_path)
+        if not self.index.delete_prefetch(image_id, index.QUEUED):
+            logger.warn(_("image '%s' is not queued for prefetching, unable"
+                          " to delete"), image_id)
 
     def delete_prefetching_image(self, image_id):
-        prefetching_path = os.path.join(self.prefetching_path, str(image_id))
-        self._delete_file(prefetching_path)
+        if not self.index.delete_prefetch(image_id, index.PREFETCHING):
+            logger.warn(_("image '%s' is not being prefetched, unable"
+                          " to delete"), image_id)
 
     def pop_prefetch_item(self):
         """This returns the next prefetch job.
 
-        The prefetch directory is treated like a FIFO; so we sort by modified
-        time and pick the oldest.
+        Jobs with a higher priority come first, then the oldest.
         """
-        items = []
-        for path in self.get_all_regular_files(self.prefetch_path):
-            mtime = os.path.getmtime(path)
-            items.append((mtime, path))
-
-        if not items:
+        image_id = self.index.oldest_queued_prefetch()
+        if image_id is None:
             raise IndexError
+        return image_id
 
-        # Sort oldest files to the end of the list
-        items.sort(reverse=True)
+    def claim_prefetch_item(self):
+        """Returns the next prefetch job and marks it as in-progress, in one
+        step so that concurrent prefetchers never pick the same image.
 
-        mtime, path = items.pop()
-        image_id = os.path.basename(path)
+        Jobs with a higher priority come first, then the oldest.
+        """
+        image_id = self.index.claim_next_prefetch()
+        if image_id is None:
+            raise IndexError
         return image_id
 
+    def requeue_prefetching_images(self):
+        """Puts in-progress prefetch jobs back in the queue, for a prefetcher
+        starting up after a previous one died mid-prefetch
+        """
+        return self.index.requeue_prefetching()
+
     def do_prefetch(self, image_id):
-        """This moves the file from the prefetch queue path to the in-progress
-        prefetching path (so we don't try to prefetch something twice).
+        """This marks a queued prefetch job as in-progress (so we don't try
+        to prefetch something twice).
         """
-        prefetch_path = os.path.join(self.prefetch_path, str(image_id))
-        prefetching_path = os.path.join(self.prefetching_path, str(image_id))
-        os.rename(prefetch_path, prefetching_path)
+        if not self.index.set_prefetch_state(image_id, index.QUEUED,
+                                             index.PREFETCHING):
+            raise exception.Invalid(_("Image '%s' is not queued for "
+                                      "prefetching") % image_id)
 
     @staticmethod
     def get_all_regular_files(basepath):
@@ -351,86 +645,165 @@ class ImageCache(object):
             if os.path.isfile(path):
                 yield path
 
-    def _base_entries(self, basepath):
-        def iso8601_from_timestamp(timestamp):
-            return datetime.datetime.utcfromtimestamp(timestamp)\
-                                    .isoformat()
-
-        for path in self.get_all_regular_files(basepath):
-            filename = os.path.basename(path)
+    @staticmethod
+    def _image_files(basepath):
+        """Yields (image_id, path) for the image files in a directory"""
+        if not os.path.isdir(basepath):
+            return
+        for path in ImageCache.get_all_regular_files(basepath):
             try:
-                image_id = int(filename)
-            except ValueError, TypeError:
+                image_id = int(os.path.basename(path))
+            except (ValueError, TypeError):
                 continue
+            yield image_id, path
 
-            entry = {}
-            entry['id'] = image_id
-            entry['path'] = path
-            entry['name'] = utils.get_xattr(path, 'image_name',
-                                            default='UNKNOWN')
-
-            mtime = os.path.getmtime(path)
-            entry['last_modified'] = iso8601_from_timestamp(mtime)
+    def _rebuild_index(self, cache_index):
+        """Populates a new index from the files in the cache directories.
 
-            atime = os.path.getatime(path)
-            entry['last_accessed'] = iso8601_from_timestamp(atime)
-
-            entry['size'] = os.path.getsize(path)
+        Names, hit counts, expected sizes and errors are taken from the
+        xattrs earlier versions of the cache stored on each file, and access
+        times from the filesystem.
+        """
+        logger.info(_("Rebuilding image cache index '%s'"), self.index_path)
 
-            entry['expected_size'] = utils.get_xattr(
-                    path, 'expected_size', default='UNKNOWN')
+        def int_or_none(value):
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                return None
+
+        def add_entries(basepath, state):
+            for image_id, path in self._image_files(basepath):
+                file_info = os.stat(path)
+                cache_index.upsert_entry(
+                    image_id, state,
+                    name=utils.get_xattr(path, 'image_name', default=None),
+                    size=file_info.st_size,
+                    expected_size=int_or_none(
+                        utils.get_xattr(path, 'expected_size', default=None)),
+                    hits=int_or_none(
+                        utils.get_xattr(path, 'hits', default=None)) or 0,
+                    last_accessed=file_info.st_atime,
+                    last_modified=file_info.st_mtime,
+                    error=utils.get_xattr(path, 'error', default=None))
+
+        add_entries(self.path, index.CACHED)
+        add_entries(self.incomplete_path, index.INCOMPLETE)
+        add_entries(self.invalid_path, index.INVALID)
+
+        # Jobs that were in progress are queued again, and the marker files
+        # removed since the queue now lives in the index.
+        for basepath in (self.prefetch_path, self.prefetching_path):
+            for image_id, path in self._image_files(basepath):
+                name = utils.get_xattr(path, 'image_name', default=None)
+                cache_index.queue_prefetch(image_id, name)
+                os.unlink(path)
+
+    def _format_entries(self, state):
+        def iso8601_from_timestamp(timestamp):
+            return datetime.datetime.utcfromtimestamp(timestamp)\
+                                    .isoformat()
 
+        for row in self.index.get_entries(state):
+            entry = {}
+            entry['id'] = row['image_id']
+            entry['name'] = row['name'] or 'UNKNOWN'
+            entry['last_modified'] = iso8601_from_timestamp(
+                    row['last_modified'])
+            entry['last_accessed'] = iso8601_from_timestamp(
+                    row['last_accessed'])
+            entry['size'] = row['size']
+            entry['expected_size'] = row['expected_size'] or 'UNKNOWN'
+            entry['hits'] = row['hits']
+            entry['error'] = row['error'] or 'UNKNOWN'
             yield entry
 
     def invalid_entries(self):
         """Cache info for invalid cached images"""
-        for entry in self._base_entries(self.invalid_path):
-            path = entry['path']
-            entry['error'] = utils.get_xattr(path, 'error', default='UNKNOWN')
+        for entry in self._format_entries(index.INVALID):
+            entry['path'] = self.invalid_path_for_image(entry['id'])
+            del entry['hits']
             yield entry
 
     def incomplete_entries(self):
-        """Cache info for invalid cached images"""
-        for entry in self._base_entries(self.incomplete_path):
+        """Cache info for images currently being written to the cache"""
+        for entry in self._format_entries(index.INCOMPLETE):
+            path = self.incomplete_path_for_image(entry['id'])
+            # The index doesn't track a fill's progress, so stat the file
+            try:
+                entry['size'] = os.path.getsize(path)
+            except OSError:
+                continue
+            entry['path'] = path
+            del entry['hits']
+            del entry['error']
             yield entry
 
     def prefetch_entries(self):
         """Cache info for both queued and in-progress prefetch jobs"""
-        both_entries = itertools.chain(
-                        self._base_entries(self.prefetch_path),
-                        self._base_entries(self.prefetching_path))
-
-        for entry in both_entries:
-            path = entry['path']
-            entry['status'] = 'in-progress' if 'prefetching' in path\
-                                            else 'queued'
+        for row in self.index.get_prefetch_entries():
+            queued_at = datetime.datetime.utcfromtimestamp(row['queued_at'])\
+                                         .isoformat()
+            entry = {}
+            entry['id'] = row['image_id']
+            entry['name'] = row['name'] or 'UNKNOWN'
+            entry['last_modified'] = queued_at
+            entry['last_accessed'] = queued_at
+            entry['size'] = 0
+            entry['expected_size'] = 'UNKNOWN'
+            entry['priority'] = row['priority']
+            entry['status'] = 'queued'
+            if row['state'] == index.PREFETCHING:
+                entry['status'] = 'in-progress'
+                # Report how far the fill has got
+                cache_entry = self.index.get_entry(row['image_id'])
+                if cache_entry and cache_entry['state'] == index.INCOMPLETE:
+                    path = self.incomplete_path_for_image(row['image_id'])
+                    try:
+                        entry['size'] = os.path.getsize(path)
+                    except OSError:
+                        pass
+                    entry['expected_size'] = (cache_entry['expected_size'] or
+                                              'UNKNOWN')
             yield entry
 
     def entries(self):
         """Cache info for currently cached images"""
-        for entry in self._base_entries(self.path):
-            path = entry['path']
-            entry['hits'] = utils.get_xattr(path, 'hits', default='UNKNOWN')
+        for entry in self._format_entries(index.CACHED):
+            entry['path'] = self.path_for_image(entry['id'])
+            del entry['error']
             yield entry
 
-    def _reap_old_files(self, dirpath, entry_type, grace=None):
-        """
+    def _reap_old_files(self, dirpath, state, entry_type, grace=None):
+        """Deletes the entries in `state` (and their files under `dirpath`)
+        which were last modified more than `grace` seconds ago, or all of
+        them if there is no grace period.
         """
         now = time.time()
         reaped = 0
-        for path in self.get_all_regular_files(dirpath):
-            mtime = os.path.getmtime(path)
-            age = now - mtime
-            if not grace:
-                logger.debug(_("No grace period, reaping '%(path)s'"
-                             " immediately"), locals())
-                self._delete_file(path)
-                reaped += 1
-            elif age > grace:
+        if not grace:
+            logger.debug(_("No grace period, reaping %(entry_type)s entries"
+                         " immediately"), locals())
+            entries = self.index.get_entries(state)
+        else:
+            entries = self.index.get_entries_older_than(state, now - grace)
+
+        for entry in entries:
+            path = os.path.join(dirpath, str(entry['image_id']))
+            if grace:
+                # A fill that is still making progress keeps touching its
+                # file, so go by whichever is more recent.
+                mtime = entry['last_modified']
+                if os.path.exists(path):
+                    mtime = max(mtime, os.path.getmtime(path))
+                age = now - mtime
+                if age <= grace:
+                    continue
                 logger.debug(_("Cache entry '%(path)s' exceeds grace period, "
                              "(%(age)i s > %(grace)i s)"), locals())
-                self._delete_file(path)
-                reaped += 1
+            self._delete_file(path)
+            self.index.delete_entry(entry['image_id'], state)
+            reaped += 1
 
         logger.info(_("Reaped %(reaped)s %(entry_type)s cache entries"),
                     locals())
@@ -442,11 +815,120 @@ class ImageCache(object):
         :param grace: Number of seconds to keep an invalid entry around for
                       debugging purposes. If None, then delete immediately.
         """
-        return self._reap_old_files(self.invalid_path, 'invalid', grace=grace)
+        return self._reap_old_files(self.invalid_path, index.INVALID,
+                                    'invalid', grace=grace)
 
     def reap_stalled(self):
         """Remove any stalled cache entries"""
         stall_timeout = int(self.options.get('image_cache_stall_timeout',
                             86400))
-        return self._reap_old_files(self.incomplete_path, 'stalled',
-                                    grace=stall_timeout)
+        return self._reap_old_files(self.incomplete_path, index.INCOMPLETE,
+                                    'stalled', grace=stall_timeout)
+
+
+class CacheUsage(object):
+    """
+    Running total of the bytes held in an image cache, shared by every
+    `ImageCache` for the same path in this process.
+
+    The total is read from the cache index when first needed and is then
+    updated as images are committed and purged. Each eviction pass re-reads
+    it from the index to pick up changes made by other processes. The
+    expected sizes of images still being written are reserved against the
+    cache's capacity when they are admitted, evicting other images first if
+    they would not otherwise fit.
+    """
+
+    _instances = {}
+
+    def __init__(self, options):
+        self.options = options
+        cache = ImageCache(options)
+        self.size = cache.index.get_total_size()
+        self.reserved = 0
+        self.pruning = False
+
+    @classmethod
+    def for_cache(cls, cache):
+        usage = cls._instances.get(cache.path)
+        if usage is None:
+            usage = cls._instances[cache.path] = cls(cache.options)
+        return usage
+
+    def admit(self, expected_size):
+        """Reserves room for an image that is about to be written, evicting
+        cached images to make room for it if need be.
+
+        :returns: False if the image would not fit in the cache
+        """
+        cache = ImageCache(self.options)
+        expected_size = expected_size or 0
+        if expected_size > cache.max_size:
+            logger.info(_("not caching image of %(expected_size)d B, the "
+                          "cache only holds %(max_size)d B"),
+                        dict(expected_size=expected_size,
+                             max_size=cache.max_size))
+            return False
+
+        # Pruning only frees down to the low watermark, which can leave too
+        # little room for a large image, so make room for it here
+        to_free = self.size + self.reserved + expected_size - cache.max_size
+        if to_free > 0:
+            self.size = cache.index.get_total_size()
+            to_free = (self.size + self.reserved + expected_size -
+                       cache.max_size)
+            if to_free > 0:
+                logger.debug(_("freeing %(to_free)d B for image of "
+                               "%(expected_size)d B"), locals())
+                cache.evict(to_free)
+            if self.size + self.reserved + expected_size > cache.max_size:
+                logger.info(_("not caching image of %(expected_size)d B, "
+                              "%(reserved)d B of the cache is reserved for "
+                              "images being written"),
+                            dict(expected_size=expected_size,
+                                 reserved=self.reserved))
+                return False
+
+        self.reserved += expected_size
+        self._check_high_watermark(cache, self.size + self.reserved)
+        return True
+
+    def release(self, expected_size):
+        """Gives back the reservation of an image that wasn't cached"""
+        self.reserved = max(self.reserved - (expected_size or 0), 0)
+
+    def committed(self, expected_size, size):
+        """Accounts for an image that has been written into the cache"""
+        self.release(expected_size)
+        self.size += size
+        self._check_high_watermark(ImageCache(self.options),
+                                   self.size + self.reserved)
+
+    def removed(self, size):
+        """Accounts for an image that has been purged from the cache"""
+        self.size = max(self.size - size, 0)
+
+    def _check_high_watermark(self, cache, projected):
+        if self.pruning:
+            return
+        if projected > cache.max_size * cache.high_watermark:
+            self.pruning = True
+            eventlet.spawn_n(self.prune)
+
+    def prune(self):
+        """Evicts images until usage falls to the low watermark"""
+        try:
+            cache = ImageCache(self.options)
+            self.size = cache.index.get_total_size()
+            target = cache.max_size * cache.low_watermark
+            to_free = self.size + self.reserved - target
+            if to_free > 0:
+                logger.debug(_("cache above high watermark, freeing "
+                               "%(to_free)d B"), locals())
+                freed = cache.evict(to_free)
+                logger.debug(_("finished pruning, freed %(freed)d bytes"),
+                             locals())
+        except Exception:
+            logger.exception(_("Failed to prune image cache"))
+        finally:
+            self.pruning = False
@@ -0,0 +1,468 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Persistent metadata index for the Image Cache
+"""
+import atexit
+import fcntl
+import logging
+import os
+import sqlite3
+import time
+
+import eventlet
+
+logger = logging.getLogger('glance.image_cache.index')
+
+# States of a row in the `entries` table
+CACHED = 'cached'
+INCOMPLETE = 'incomplete'
+INVALID = 'invalid'
+
+# States of a row in the `prefetch_queue` table
+QUEUED = 'queued'
+PREFETCHING = 'prefetching'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    image_id INTEGER PRIMARY KEY,
+    state VARCHAR(12) NOT NULL,
+    name TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    expected_size INTEGER,
+    hits INTEGER NOT NULL DEFAULT 0,
+    last_accessed REAL NOT NULL,
+    last_modified REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_entries_state_last_accessed
+    ON entries (state, last_accessed);
+CREATE INDEX IF NOT EXISTS ix_entries_state_last_modified
+    ON entries (state, last_modified);
+CREATE TABLE IF NOT EXISTS prefetch_queue (
+    image_id INTEGER PRIMARY KEY,
+    state VARCHAR(12) NOT NULL,
+    name TEXT,
+    queued_at REAL NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_prefetch_queue_state_queued_at
+    ON prefetch_queue (state, queued_at);
+CREATE TABLE IF NOT EXISTS eviction_values (
+    policy VARCHAR(12) NOT NULL,
+    name VARCHAR(32) NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (policy, name)
+);
+CREATE TABLE IF NOT EXISTS eviction_items (
+    policy VARCHAR(12) NOT NULL,
+    position INTEGER NOT NULL,
+    list VARCHAR(12) NOT NULL,
+    image_id INTEGER NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    value REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (policy, position)
+);
+"""
+
+# Changes to tables created by earlier versions, applied on connect
+UPGRADES = (
+    ('prefetch_queue', 'priority',
+     "ALTER TABLE prefetch_queue "
+     "ADD COLUMN priority INTEGER NOT NULL DEFAULT 0"),
+    )
+
+PREFETCH_ORDER = "priority DESC, queued_at, image_id"
+
+ENTRY_COLUMNS = ('image_id', 'state', 'name', 'size', 'expected_size',
+                 'hits', 'last_accessed', 'last_modified', 'error')
+
+# The index of each database opened by this process, by (pid, path)
+_INDEXES = {}
+
+
+def get_index(db_path, rebuild=None):
+    """
+    Returns this process' `CacheIndex` for a database, opening it on first
+    use. Every `ImageCache` for the same path shares it, and so its one
+    connection.
+
+    If the database doesn't exist yet, `rebuild` is called with the new
+    index to populate it. A lock on a file beside the database makes sure
+    only one process creates and rebuilds it, and that the others wait
+    until it has.
+    """
+    key = (os.getpid(), db_path)
+    cache_index = _INDEXES.get(key)
+    if cache_index is None:
+        with open(db_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            needs_rebuild = not os.path.exists(db_path)
+            cache_index = CacheIndex(db_path)
+            cache_index.connect()
+            if needs_rebuild and rebuild is not None:
+                rebuild(cache_index)
+        _INDEXES[key] = cache_index
+    return cache_index
+
+
+@atexit.register
+def _flush_all_hits():
+    for (pid, db_path), cache_index in _INDEXES.items():
+        if pid == os.getpid():
+            try:
+                cache_index.flush_hits()
+            except Exception:
+                pass
+
+
+class CacheIndex(object):
+    """
+    Records the metadata of every image cache entry in a small SQLite
+    database so that listing, pruning and the prefetch queue are answered
+    by indexed queries rather than by scanning the cache directories and
+    reading the xattrs of each file. Access times and hit counts are kept
+    here as well, which means the cache no longer depends on the filesystem
+    updating atime.
+
+    The image files themselves remain the source of truth for whether an
+    image is cached; the index only describes them.
+
+    The database is used in WAL mode, so reads never wait on writes. Cache
+    hits are not written one by one: they are counted in memory and
+    written in one transaction every `HIT_FLUSH_INTERVAL` seconds or
+    `HIT_FLUSH_COUNT` hits, and before entries are read.
+
+    SQLite waits on another process' lock by sleeping, which would hold up
+    every green thread in the process, so it only waits `BUSY_TIMEOUT`
+    seconds itself. Statements that find the database locked are retried
+    after an `eventlet.sleep` instead, for up to `timeout` seconds.
+    """
+
+    HIT_FLUSH_INTERVAL = 5  # seconds
+    HIT_FLUSH_COUNT = 100
+
+    # Seconds SQLite waits on a lock before the statement is retried
+    BUSY_TIMEOUT = 0.01
+    # Most seconds to sleep between retries
+    MAX_RETRY_INTERVAL = 0.5
+
+    def __init__(self, db_path, timeout=30):
+        """
+        :param db_path: Path of the SQLite database file
+        :param timeout: Seconds to retry while another process holds a lock
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self._conn = None
+        self._hits = {}
+        self._hit_count = 0
+        self._hits_flushed_at = time.time()
+
+    def connect(self):
+        """Opens the database, creating or upgrading its tables, unless it
+        is already open, and returns the connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT,
+                                   isolation_level='IMMEDIATE')
+            conn.row_factory = sqlite3.Row
+            try:
+                self._retry(self._setup, conn)
+            except Exception:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    @property
+    def conn(self):
+        return self.connect()
+
+    def _setup(self, conn):
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.executescript(SCHEMA)
+        self._upgrade(conn)
+
+    def _retry(self, func, *args):
+        """
+        Returns func(*args), calling it again after a green sleep whenever
+        it finds the database locked, for up to `timeout` seconds
+        """
+        deadline = time.time() + self.timeout
+        interval = self.BUSY_TIMEOUT
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError, e:
+                if 'locked' not in str(e) or time.time() >= deadline:
+                    raise
+            eventlet.sleep(interval)
+            interval = min(interval * 2, self.MAX_RETRY_INTERVAL)
+
+    def _upgrade(self, conn):
+        for table, column, sql in UPGRADES:
+            columns = [row['name'] for row in
+                       conn.execute("PRAGMA table_info(%s)" % table)]
+            if column not in columns:
+                conn.execute(sql)
+        conn.executescript(
+            "CREATE INDEX IF NOT EXISTS ix_prefetch_queue_state_priority "
+            "ON prefetch_queue (state, priority, queued_at);")
+
+    def close(self):
+        if self._conn is not None:
+            self.flush_hits()
+            self._conn.close()
+            self._conn = None
+
+    def _transaction(self, func, *args):
+        """Returns func(conn, *args), run in a transaction that is retried
+        while the database is locked
+        """
+        conn = self.conn
+
+        def run():
+            with conn:
+                return func(conn, *args)
+        return self._retry(run)
+
+    def _execute(self, sql, *args):
+        return self._transaction(lambda conn: conn.execute(sql, args))
+
+    def _query(self, sql, *args):
+        return self._retry(lambda: self.conn.execute(sql, args).fetchall())
+
+    # Cache entries
+
+    def upsert_entry(self, image_id, state, **values):
+        """Creates or replaces the entry for an image.
+
+        Columns not given in `values` are reset to their defaults, apart
+        from the timestamps which default to now.
+        """
+        now = time.time()
+        row = {'image_id': image_id, 'state': state, 'name': None,
+               'size': 0, 'expected_size': None, 'hits': 0,
+               'last_accessed': now, 'last_modified': now, 'error': None}
+        row.update(values)
+        self._execute("INSERT OR REPLACE INTO entries (%s) VALUES (%s)"
+                      % (', '.join(ENTRY_COLUMNS),
+                         ', '.join('?' * len(ENTRY_COLUMNS))),
+                      *[row[c] for c in ENTRY_COLUMNS])
+
+    def record_hit(self, image_id, accessed=None):
+        """Bumps the hit count and access time of a cached image.
+
+        The hit is written with the others at the next flush.
+        """
+        accessed = accessed or time.time()
+        hits, last_accessed = self._hits.get(image_id, (0, accessed))
+        self._hits[image_id] = (hits + 1, max(last_accessed, accessed))
+        self._hit_count += 1
+        if (self._hit_count >= self.HIT_FLUSH_COUNT or
+            time.time() - self._hits_flushed_at >= self.HIT_FLUSH_INTERVAL):
+            self.flush_hits()
+
+    def flush_hits(self):
+        """Writes the hits recorded since the last flush"""
+        self._hits_flushed_at = time.time()
+        if not self._hits:
+            return
+        hits, self._hits = self._hits, {}
+        self._hit_count = 0
+        # Tried once only; the hits are kept for the next flush if another
+        # process holds the lock
+        conn = self.conn
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE entries SET hits = hits + ?, "
+                    "last_accessed = MAX(last_accessed, ?) "
+                    "WHERE image_id = ? AND state = ?",
+                    [(count, accessed, image_id, CACHED)
+                     for image_id, (count, accessed) in hits.items()])
+        except sqlite3.OperationalError, e:
+            logger.debug(_("Deferring cache hit updates: %s"), e)
+            for image_id, (count, accessed) in hits.items():
+                pending, last_accessed = self._hits.get(image_id,
+                                                        (0, accessed))
+                self._hits[image_id] = (pending + count,
+                                        max(last_accessed, accessed))
+                self._hit_count += count
+
+    def delete_entry(self, image_id, state=None):
+        if state is None:
+            self._execute("DELETE FROM entries WHERE image_id = ?", image_id)
+        else:
+            self._execute("DELETE FROM entries WHERE image_id = ? "
+                          "AND state = ?", image_id, state)
+
+    def get_entry(self, image_id):
+        self.flush_hits()
+        rows = self._query("SELECT * FROM entries WHERE image_id = ?",
+                           image_id)
+        return dict(rows[0]) if rows else None
+
+    def get_entries(self, state, order_by='image_id'):
+        """Returns all entries in `state` as dicts, sorted by `order_by`"""
+        assert order_by in ENTRY_COLUMNS
+        self.flush_hits()
+        return [dict(row) for row in self._query(
+                "SELECT * FROM entries WHERE state = ? ORDER BY %s" % order_by,
+                state)]
+
+    def get_entries_older_than(self, state, last_modified):
+        self.flush_hits()
+        return [dict(row) for row in self._query(
+                "SELECT * FROM entries WHERE state = ? AND last_modified < ? "
+                "ORDER BY last_modified", state, last_modified)]
+
+    def get_total_size(self, state=CACHED):
+        rows = self._query("SELECT COALESCE(SUM(size), 0) FROM entries "
+                           "WHERE state = ?", state)
+        return rows[0][0]
+
+    # Prefetch queue
+
+    def queue_prefetch(self, image_id, name, priority=0):
+        """Adds an image to the prefetch queue. Images with a higher
+        `priority` are prefetched first.
+
+        Returns False if the image was already queued or being prefetched.
+        """
+        cursor = self._execute("INSERT OR IGNORE INTO prefetch_queue "
+                               "(image_id, state, name, queued_at, priority) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               image_id, QUEUED, name, time.time(), priority)
+        return cursor.rowcount > 0
+
+    def set_prefetch_priority(self, image_id, priority):
+        """Changes the priority of a queued prefetch job.
+
+        Returns False if the image is not queued.
+        """
+        cursor = self._execute("UPDATE prefetch_queue SET priority = ? "
+                               "WHERE image_id = ? AND state = ?",
+                               priority, image_id, QUEUED)
+        return cursor.rowcount > 0
+
+    def get_prefetch(self, image_id):
+        rows = self._query("SELECT * FROM prefetch_queue WHERE image_id = ?",
+                           image_id)
+        return dict(rows[0]) if rows else None
+
+    def get_prefetch_state(self, image_id):
+        rows = self._query("SELECT state FROM prefetch_queue "
+                           "WHERE image_id = ?", image_id)
+        return rows[0][0] if rows else None
+
+    def count_prefetch(self, state):
+        rows = self._query("SELECT COUNT(*) FROM prefetch_queue "
+                           "WHERE state = ?", state)
+        return rows[0][0]
+
+    def oldest_queued_prefetch(self):
+        """Returns the image id at the head of the prefetch queue, or None"""
+        rows = self._query("SELECT image_id FROM prefetch_queue "
+                           "WHERE state = ? ORDER BY %s LIMIT 1"
+                           % PREFETCH_ORDER, QUEUED)
+        return rows[0][0] if rows else None
+
+    def claim_next_prefetch(self):
+        """Moves the job at the head of the prefetch queue to the prefetching
+        state in a single transaction, so that concurrent prefetchers never
+        claim the same image, and returns its image id or None.
+        """
+        return self._transaction(self._claim_next_prefetch)
+
+    def _claim_next_prefetch(self, conn):
+        row = conn.execute("SELECT image_id FROM prefetch_queue "
+                           "WHERE state = ? ORDER BY %s LIMIT 1"
+                           % PREFETCH_ORDER, (QUEUED,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE prefetch_queue SET state = ? "
+                     "WHERE image_id = ?", (PREFETCHING, row['image_id']))
+        return row['image_id']
+
+    def requeue_prefetching(self):
+        """Puts every job in the prefetching state back in the queue"""
+        cursor = self._execute("UPDATE prefetch_queue SET state = ? "
+                               "WHERE state = ?", QUEUED, PREFETCHING)
+        return cursor.rowcount
+
+    def set_prefetch_state(self, image_id, from_state, to_state):
+        """Moves a prefetch job between states.
+
+        Returns False if the job was not in `from_state`.
+        """
+        cursor = self._execute("UPDATE prefetch_queue SET state = ? "
+                               "WHERE image_id = ? AND state = ?",
+                               to_state, image_id, from_state)
+        return cursor.rowcount > 0
+
+    def delete_prefetch(self, image_id, state=None):
+        if state is None:
+            cursor = self._execute("DELETE FROM prefetch_queue "
+                                   "WHERE image_id = ?", image_id)
+        else:
+            cursor = self._execute("DELETE FROM prefetch_queue "
+                                   "WHERE image_id = ? AND state = ?",
+                                   image_id, state)
+        return cursor.rowcount > 0
+
+    def get_prefetch_entries(self):
+        return [dict(row) for row in self._query(
+                "SELECT * FROM prefetch_queue ORDER BY %s" % PREFETCH_ORDER)]
+
+    # Eviction policy state
+
+    def get_policy_state(self, policy):
+        """Returns the values and items last saved for an eviction policy
+        by `save_policy_state`
+        """
+        values = dict((row['name'], row['value']) for row in self._query(
+                "SELECT name, value FROM eviction_values WHERE policy = ?",
+                policy))
+        items = [tuple(row) for row in self._query(
+                "SELECT list, image_id, size, hits, value FROM eviction_items "
+                "WHERE policy = ? ORDER BY position", policy)]
+        return values, items
+
+    def save_policy_state(self, policy, values, items):
+        """Replaces the saved state of an eviction policy"""
+        self._transaction(self._save_policy_state, policy, values, items)
+
+    def _save_policy_state(self, conn, policy, values, items):
+        conn.execute("DELETE FROM eviction_values WHERE policy = ?",
+                     (policy,))
+        conn.execute("DELETE FROM eviction_items WHERE policy = ?",
+                     (policy,))
+        conn.executemany(
+            "INSERT INTO eviction_values (policy, name, value) "
+            "VALUES (?, ?, ?)",
+            [(policy, name, value) for name, value in values.items()])
+        conn.executemany(
+            "INSERT INTO eviction_items "
+            "(policy, position, list, image_id, size, hits, value) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(policy, position) + tuple(item)
+             for position, item in enumerate(items)])
@@ -0,0 +1,339 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Eviction policies for the Image Cache
+
+A policy tracks the images currently in the cache and decides which one to
+evict next. The pruner seeds a policy with the entries in the cache index
+and pops victims until enough space has been freed; the simulator drives a
+policy with a replayed access log.
+
+A fresh policy is made for every eviction, so policies that remember more
+than the index records (GDSF's inflation value, ARC's ghost lists) `save`
+that state to the index afterwards and `load` it before being seeded.
+"""
+import collections
+import heapq
+import itertools
+
+from glance.common import config
+from glance.common import exception
+
+
+class EvictionPolicy(object):
+    """
+    Base class for eviction policies.
+
+    :param capacity: Size of the cache in bytes
+    """
+
+    name = None
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sizes = {}
+
+    def __contains__(self, image_id):
+        return image_id in self.sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, image_id, size, hits=0):
+        """Records that an image has been written into the cache.
+
+        :param hits: Number of times the image has been read from the cache
+                     already, for policies seeded from the cache index
+        """
+        raise NotImplementedError
+
+    def touch(self, image_id):
+        """Records a cache hit on an image"""
+        raise NotImplementedError
+
+    def pop_victim(self):
+        """Forgets the image that should be evicted next and returns its id.
+
+        :raises `IndexError` if the policy tracks no images
+        """
+        raise NotImplementedError
+
+    def load(self, values, items):
+        """Restores the state returned by `save` after an earlier eviction.
+        Called before the policy is seeded with the cached images.
+
+        :param values: dict of named numbers
+        :param items: list of (list name, image id, size, hits, value)
+                      tuples, in the order they were saved
+        """
+        pass
+
+    def save(self):
+        """Returns the state to carry over to the next eviction as a tuple
+        of the `values` and `items` that `load` takes
+        """
+        return {}, []
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evicts the least recently used image"""
+
+    name = 'lru'
+
+    def __init__(self, capacity):
+        super(LRUPolicy, self).__init__(capacity)
+        self.order = collections.OrderedDict()
+
+    def add(self, image_id, size, hits=0):
+        self.sizes[image_id] = size
+        self.order.pop(image_id, None)
+        self.order[image_id] = True
+
+    def touch(self, image_id):
+        self.order.pop(image_id)
+        self.order[image_id] = True
+
+    def pop_victim(self):
+        if not self.order:
+            raise IndexError
+        image_id, unused = self.order.popitem(last=False)
+        del self.sizes[image_id]
+        return image_id
+
+
+class _HeapPolicy(EvictionPolicy):
+    """
+    Evicts the image with the lowest priority. Stale heap items left behind
+    when a priority changes are skipped when popped.
+    """
+
+    def __init__(self, capacity):
+        super(_HeapPolicy, self).__init__(capacity)
+        self.heap = []
+        self.priorities = {}
+        self.hits = {}
+        self.counter = itertools.count()
+
+    def priority(self, image_id):
+        raise NotImplementedError
+
+    def _push(self, image_id):
+        priority = self.priority(image_id)
+        self.priorities[image_id] = priority
+        # The counter breaks ties in favour of evicting the older item
+        heapq.heappush(self.heap, (priority, self.counter.next(), image_id))
+
+    def add(self, image_id, size, hits=0):
+        self.sizes[image_id] = size
+        self.hits[image_id] = hits
+        self._push(image_id)
+
+    def touch(self, image_id):
+        self.hits[image_id] += 1
+        self._push(image_id)
+
+    def pop_victim(self):
+        while self.heap:
+            priority, unused, image_id = heapq.heappop(self.heap)
+            if self.priorities.get(image_id) == priority:
+                self.evicted(image_id, priority)
+                del self.priorities[image_id]
+                del self.hits[image_id]
+                del self.sizes[image_id]
+                return image_id
+        raise IndexError
+
+    def evicted(self, image_id, priority):
+        pass
+
+
+class LFUPolicy(_HeapPolicy):
+    """Evicts the least frequently used image, using the cache's hit counts"""
+
+    name = 'lfu'
+
+    def priority(self, image_id):
+        return self.hits[image_id]
+
+
+class GDSFPolicy(_HeapPolicy):
+    """
+    Greedy-Dual-Size-Frequency: evicts the image with the lowest
+    `L + frequency / size`, where the inflation value L is raised to the
+    priority of each evicted image so that images which stop being read
+    eventually age out. Small, frequently read images are favoured over a
+    large image that was read once.
+
+    L only changes when an image is evicted, so an image that has not been
+    read since the last eviction keeps the priority saved then, while one
+    that has been read gets the current L.
+    """
+
+    name = 'gdsf'
+
+    def __init__(self, capacity):
+        super(GDSFPolicy, self).__init__(capacity)
+        self.inflation = 0.0
+        self.saved = {}
+
+    def priority(self, image_id):
+        hits = self.hits[image_id]
+        saved = self.saved.pop(image_id, None)
+        if saved is not None and saved[0] == hits:
+            return saved[1]
+        return self.inflation + float(hits + 1) / max(self.sizes[image_id], 1)
+
+    def evicted(self, image_id, priority):
+        self.inflation = priority
+
+    def load(self, values, items):
+        self.inflation = values.get('inflation', 0.0)
+        self.saved = dict((image_id, (hits, value))
+                          for list_name, image_id, size, hits, value in items)
+
+    def save(self):
+        return ({'inflation': self.inflation},
+                [('priority', image_id, self.sizes[image_id],
+                  self.hits[image_id], priority)
+                 for image_id, priority in self.priorities.items()])
+
+
+class _SizedLRUList(object):
+    """An LRU ordered list of image ids which keeps a total of their sizes"""
+
+    def __init__(self):
+        self.items = collections.OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, image_id):
+        return image_id in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, image_id, size):
+        self.items[image_id] = size
+        self.bytes += size
+
+    def remove(self, image_id):
+        size = self.items.pop(image_id)
+        self.bytes -= size
+        return size
+
+    def pop_oldest(self):
+        image_id, size = self.items.popitem(last=False)
+        self.bytes -= size
+        return image_id, size
+
+
+class ARCPolicy(EvictionPolicy):
+    """
+    Adaptive Replacement Cache, measured in bytes.
+
+    Images read once live in T1 and images read more than once in T2. The
+    ids of images recently evicted from either list are remembered in the
+    ghost lists B1 and B2; a miss on a ghost shifts the target size of T1
+    (`target`) towards whichever list would have produced a hit.
+    """
+
+    name = 'arc'
+
+    def __init__(self, capacity):
+        super(ARCPolicy, self).__init__(capacity)
+        self.t1 = _SizedLRUList()
+        self.t2 = _SizedLRUList()
+        self.b1 = _SizedLRUList()
+        self.b2 = _SizedLRUList()
+        self.target = 0
+
+    def add(self, image_id, size, hits=0):
+        self.sizes[image_id] = size
+        if image_id in self.b1:
+            delta = max(self.b2.bytes / max(self.b1.bytes, 1), 1) * size
+            self.target = min(self.target + delta, self.capacity)
+            self.b1.remove(image_id)
+            self.t2.push(image_id, size)
+        elif image_id in self.b2:
+            delta = max(self.b1.bytes / max(self.b2.bytes, 1), 1) * size
+            self.target = max(self.target - delta, 0)
+            self.b2.remove(image_id)
+            self.t2.push(image_id, size)
+        elif hits > 0:
+            self.t2.push(image_id, size)
+        else:
+            self.t1.push(image_id, size)
+
+    def touch(self, image_id):
+        if image_id in self.t1:
+            size = self.t1.remove(image_id)
+        else:
+            size = self.t2.remove(image_id)
+        self.t2.push(image_id, size)
+
+    def pop_victim(self):
+        if self.t1 and (self.t1.bytes > self.target or not self.t2):
+            image_id, size = self.t1.pop_oldest()
+            self.b1.push(image_id, size)
+        elif self.t2:
+            image_id, size = self.t2.pop_oldest()
+            self.b2.push(image_id, size)
+        else:
+            raise IndexError
+        del self.sizes[image_id]
+
+        # The ghost lists only need to remember a cache's worth of images
+        for ghosts in (self.b1, self.b2):
+            while ghosts and ghosts.bytes > self.capacity:
+                ghosts.pop_oldest()
+        return image_id
+
+    def load(self, values, items):
+        self.target = values.get('target', 0)
+        ghost_lists = {'b1': self.b1, 'b2': self.b2}
+        for list_name, image_id, size, hits, value in items:
+            ghost_lists[list_name].push(image_id, size)
+
+    def save(self):
+        items = []
+        for list_name, ghosts in (('b1', self.b1), ('b2', self.b2)):
+            items.extend((list_name, image_id, size, 0, 0)
+                         for image_id, size in ghosts.items.items())
+        return {'target': self.target}, items
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gdsf': GDSFPolicy,
+    'arc': ARCPolicy,
+}
+
+
+def get_policy(options, capacity):
+    """Returns an instance of the eviction policy named by the
+    `image_cache_eviction_policy` option
+
+    :raises `glance.common.exception.InvalidCacheEvictionPolicy` if the
+            policy is unknown
+    """
+    name = config.get_option(options, 'image_cache_eviction_policy',
+                             type='str', default='lru')
+    try:
+        return POLICIES[name.lower()](capacity)
+    except KeyError:
+        raise exception.InvalidCacheEvictionPolicy(policy=name)
@@ -19,10 +19,10 @@
 Prefetches images into the Image Cache
 """
 import logging
-import os
-import stat
 import time
 
+import eventlet
+
 from glance.common import config
 from glance.common import context
 from glance.image_cache import ImageCache
@@ -33,10 +33,55 @@ from glance.store import get_from_backend
 logger = logging.getLogger('glance.image_cache.prefetcher')
 
 
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by all of a prefetcher's workers, which keeps the
+    rate at which they pull image data from the stores under `rate` bytes
+    per second. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = rate
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        """Accounts for `nbytes` just transferred, sleeping if they took
+        the caller over the limit
+        """
+        if not self.rate:
+            return
+        now = time.time()
+        # Allow bursts of at most one second's worth of data
+        self.available = min(self.rate,
+                             self.available + (now - self.last) * self.rate)
+        self.last = now
+        self.available -= nbytes
+        if self.available < 0:
+            eventlet.sleep(-self.available / float(self.rate))
+
+
 class Prefetcher(object):
     def __init__(self, options):
         self.options = options
         self.cache = ImageCache(options)
+        self.limiter = BandwidthLimiter(self.max_bandwidth)
+
+    @property
+    def workers(self):
+        """Number of images to prefetch concurrently"""
+        return config.get_option(
+            self.options, 'image_cache_prefetcher_workers', type='int',
+            default=1)
+
+    @property
+    def max_bandwidth(self):
+        """Bytes per second all workers together may fetch from the stores,
+        or 0 for no limit
+        """
+        return config.get_option(
+            self.options, 'image_cache_prefetcher_max_bandwidth', type='int',
+            default=0)
 
     def fetch_image_into_cache(self, image_id):
         ctx = context.RequestContext(is_admin=True, show_deleted=True)
@@ -48,22 +93,14 @@ class Prefetcher(object):
                                       options=self.options)
             for chunk in chunks:
                 cache_file.write(chunk)
+                self.limiter.consume(len(chunk))
 
-    def run(self):
-        if self.cache.is_currently_prefetching_any_images():
-            logger.debug(_("Currently prefetching, going back to sleep..."))
-            return
-
-        try:
-            image_id = self.cache.pop_prefetch_item()
-        except IndexError:
-            logger.debug(_("Nothing to prefetch, going back to sleep..."))
-            return
-
+    def prefetch(self, image_id):
+        """Prefetches an image whose job has been claimed from the queue"""
         if self.cache.hit(image_id):
             logger.warn(_("Image %s is already in the cache, deleting "
-                        "prefetch job and going back to sleep..."), image_id)
-            self.cache.delete_queued_prefetch_image(image_id)
+                        "prefetch job..."), image_id)
+            self.cache.delete_prefetching_image(image_id)
             return
 
         # NOTE(sirp): if someone is already downloading an image that is in
@@ -71,18 +108,56 @@ class Prefetcher(object):
         # prefetch another
         if self.cache.is_image_currently_being_written(image_id):
             logger.warn(_("Image %s is already being cached, deleting "
-                        "prefetch job and going back to sleep..."), image_id)
-            self.cache.delete_queued_prefetch_image(image_id)
+                        "prefetch job..."), image_id)
+            self.cache.delete_prefetching_image(image_id)
             return
 
         logger.debug(_("Prefetching '%s'"), image_id)
-        self.cache.do_prefetch(image_id)
-
         try:
             self.fetch_image_into_cache(image_id)
+        except Exception:
+            logger.exception(_("Failed to prefetch image '%s'"), image_id)
         finally:
             self.cache.delete_prefetching_image(image_id)
 
+    def _worker(self):
+        while True:
+            try:
+                image_id = self.cache.claim_prefetch_item()
+            except IndexError:
+                return
+            self.prefetch(image_id)
+
+    def drain(self):
+        """Prefetches queued images with `workers` concurrent workers until
+        the queue is empty
+        """
+        pool = eventlet.GreenPool(self.workers)
+        for i in xrange(self.workers):
+            pool.spawn_n(self._worker)
+        pool.waitall()
+
+    def run(self):
+        if self.cache.is_currently_prefetching_any_images():
+            logger.debug(_("Currently prefetching, going back to sleep..."))
+            return
+
+        self.drain()
+
+    def run_forever(self, wakeup_time):
+        """Runs as a daemon, draining the prefetch queue every `wakeup_time`
+        seconds
+        """
+        # Only one prefetcher daemon runs per cache, so any job still marked
+        # in-progress was left behind by one that died
+        requeued = self.cache.requeue_prefetching_images()
+        if requeued:
+            logger.info(_("Requeued %d interrupted prefetch jobs"), requeued)
+
+        while True:
+            self.drain()
+            eventlet.sleep(wakeup_time)
+
 
 def app_factory(global_config, **local_conf):
     conf = global_config.copy()
@@ -19,12 +19,10 @@
 Prunes the Image Cache
 """
 import logging
-import os
-import stat
-import time
 
 from glance.common import config
 from glance.image_cache import ImageCache
+from glance.image_cache import index
 
 logger = logging.getLogger('glance.image_cache.pruner')
 
@@ -36,10 +34,7 @@ class Pruner(object):
 
     @property
     def max_size(self):
-        default = 1 * 1024 * 1024 * 1024  # 1 GB
-        return config.get_option(
-            self.options, 'image_cache_max_size_bytes',
-            type='int', default=default)
+        return self.cache.max_size
 
     @property
     def percent_extra_to_free(self):
@@ -51,47 +46,9 @@ class Pruner(object):
         self.prune_cache()
 
     def prune_cache(self):
-        """Prune the cache using an LRU strategy"""
-
-        # NOTE(sirp): 'Recency' is determined via the filesystem, first using
-        # atime (access time) and falling back to mtime (modified time).
-        #
-        # It has become more common to disable access-time updates by setting
-        # the `noatime` option for the filesystem. `noatime` is NOT compatible
-        # with this method.
-        #
-        # If `noatime` needs to be supported, we will need to persist access
-        # times elsewhere (either as a separate file, in the DB, or as
-        # an xattr).
-        def get_stats():
-            stats = []
-            for path in self.cache.get_all_regular_files(self.cache.path):
-                file_info = os.stat(path)
-                stats.append((file_info[stat.ST_ATIME],  # access time
-                              file_info[stat.ST_MTIME],  # modification time
-                              file_info[stat.ST_SIZE],   # size in bytes
-                              path))                     # absolute path
-            return stats
-
-        def prune_lru(stats, to_free):
-            # Sort older access and modified times to the back
-            stats.sort(reverse=True)
-
-            freed = 0
-            while to_free > 0:
-                atime, mtime, size, path = stats.pop()
-                logger.debug(_("deleting '%(path)s' to free %(size)d B"),
-                             locals())
-                os.unlink(path)
-                to_free -= size
-                freed += size
-
-            return freed
-
-        stats = get_stats()
-
+        """Prune the cache using the configured eviction policy"""
         # Check for overage
-        cur_size = sum(s[2] for s in stats)
+        cur_size = self.cache.index.get_total_size()
         max_size = self.max_size
         logger.debug(_("cur_size=%(cur_size)d B max_size=%(max_size)d B"),
                      locals())
@@ -105,7 +62,7 @@ class Pruner(object):
         logger.debug(_("overage=%(overage)d B extra=%(extra)d B"
                      " total=%(to_free)d B"), locals())
 
-        freed = prune_lru(stats, to_free)
+        freed = self.cache.evict(to_free)
         logger.debug(_("finished pruning, freed %(freed)d bytes"), locals())
 
 
@@ -0,0 +1,93 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Replays an image access log against the cache eviction policies
+"""
+from glance.image_cache import policies
+
+
+def read_access_log(lines):
+    """Parses an access log into (image_id, size) tuples.
+
+    Each line describes one image download and ends with the image id and
+    its size in bytes, separated by whitespace; anything before them (a
+    timestamp, say) is ignored, as are blank lines and lines starting
+    with '#'.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) < 2:
+            raise ValueError(_("Malformed access log line: %r") % line)
+        yield fields[-2], int(fields[-1])
+
+
+def simulate(policy, accesses):
+    """Replays `accesses` against a cache of `policy.capacity` bytes
+    managed by `policy`, and returns a dict of hit statistics.
+
+    Images are admitted on a miss and victims evicted straight away until
+    the cache fits again. Images larger than the cache are never admitted.
+
+    :param policy: A `glance.image_cache.policies.EvictionPolicy`
+    :param accesses: Iterable of (image_id, size) tuples
+    """
+    requests = hits = 0
+    bytes_requested = bytes_hit = 0
+    used = 0
+    sizes = {}
+
+    for image_id, size in accesses:
+        requests += 1
+        bytes_requested += size
+
+        if image_id in policy:
+            hits += 1
+            bytes_hit += size
+            policy.touch(image_id)
+            continue
+
+        if size > policy.capacity:
+            continue
+
+        policy.add(image_id, size)
+        sizes[image_id] = size
+        used += size
+        while used > policy.capacity:
+            used -= sizes.pop(policy.pop_victim())
+
+    return {'requests': requests,
+            'hits': hits,
+            'hit_ratio': float(hits) / requests if requests else 0.0,
+            'byte_hit_ratio': (float(bytes_hit) / bytes_requested
+                               if bytes_requested else 0.0)}
+
+
+def compare_policies(accesses, capacity, names=None):
+    """Replays the same accesses against each of the named policies (all
+    of them by default) and returns a dict of statistics per policy name.
+    """
+    accesses = list(accesses)
+    names = names or sorted(policies.POLICIES)
+    results = {}
+    for name in names:
+        policy = policies.POLICIES[name](capacity)
+        results[name] = simulate(policy, accesses)
+    return results
@@ -42,11 +42,21 @@ def get_images_detail(options, context, **kwargs):
     return c.get_images_detailed(**kwargs)
 
 
+def get_images_page(options, context, detailed=False, **kwargs):
+    c = get_registry_client(options, context)
+    return c.get_images_page(detailed=detailed, **kwargs)
+
+
 def get_image_metadata(options, context, image_id):
     c = get_registry_client(options, context)
     return c.get_image(image_id)
 
 
+def get_images_metadata(options, context, image_ids):
+    c = get_registry_client(options, context)
+    return c.get_images_by_id(image_ids)
+
+
 def add_image_metadata(options, context, image_meta):
     if options['debug']:
         logger.debug(_("Adding image metadata..."))
@@ -51,14 +51,13 @@ class RegistryClient(BaseClient):
 
         :param filters: dict of keys & expected values to filter results
         :param marker: image id after which to start page
+        :param cursor: cursor returned with the previous page, after which
+                       to start page
         :param limit: max number of images to return
         :param sort_key: results will be ordered by this image attribute
         :param sort_dir: direction in which to to order results (asc, desc)
         """
-        params = self._extract_params(kwargs, server.SUPPORTED_PARAMS)
-        res = self.do_request("GET", "/images", params=params)
-        data = json.loads(res.read())['images']
-        return data
+        return self.get_images_page(**kwargs)['images']
 
     def get_images_detailed(self, **kwargs):
         """
@@ -66,14 +65,44 @@ class RegistryClient(BaseClient):
 
         :param filters: dict of keys & expected values to filter results
         :param marker: image id after which to start page
+        :param cursor: cursor returned with the previous page, after which
+                       to start page
         :param limit: max number of images to return
         :param sort_key: results will be ordered by this image attribute
         :param sort_dir: direction in which to to order results (asc, desc)
         """
+        return self.get_images_page(detailed=True, **kwargs)['images']
+
+    def get_images_page(self, detailed=False, **kwargs):
+        """
+        Returns a page of images from Registry as a mapping holding the
+        list of images under 'images' and, if the page is full, the cursor
+        of the next page under 'next_cursor'. Takes the same params as
+        `get_images`.
+
+        :param detailed: whether to return detailed image data mappings
+        """
         params = self._extract_params(kwargs, server.SUPPORTED_PARAMS)
-        res = self.do_request("GET", "/images/detail", params=params)
-        data = json.loads(res.read())['images']
-        return data
+        action = "/images/detail" if detailed else "/images"
+        res = self.do_request("GET", action, params=params)
+        return json.loads(res.read())
+
+    def iter_images(self, **kwargs):
+        """
+        Yields image id/name mappings of every image matching the params
+        of `get_images`, fetching pages of `limit` images as they are
+        needed
+        """
+        return self._iter_pages(self.get_images_page, kwargs)
+
+    def iter_images_detailed(self, **kwargs):
+        """
+        Yields detailed image data mappings of every image matching the
+        params of `get_images_detailed`, fetching pages of `limit` images as
+        they are needed
+        """
+        kwargs['detailed'] = True
+        return self._iter_pages(self.get_images_page, kwargs)
 
     def get_image(self, image_id):
         """Returns a mapping of image metadata from Registry"""
@@ -81,6 +110,20 @@ class RegistryClient(BaseClient):
         data = json.loads(res.read())['image']
         return data
 
+    def get_images_by_id(self, image_ids):
+        """
+        Returns a list of mappings of image metadata from Registry, fetched
+        in a single request. Images that don't exist or aren't visible are
+        left out.
+
+        :param image_ids: list of image ids
+        """
+        body = json.dumps(dict(ids=list(image_ids)))
+        headers = {'Content-Type': 'application/json'}
+        res = self.do_request("POST", "/images/bulk-get", body, headers)
+        data = json.loads(res.read())['images']
+        return data
+
     def add_image(self, image_metadata):
         """
         Tells registry about an image's metadata
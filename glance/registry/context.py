@@ -27,6 +27,10 @@ class RequestContext(context.RequestContext):
     Also provides tests for image visibility and sharability.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(RequestContext, self).__init__(*args, **kwargs)
+        self._memberships = {}
+
     def is_image_visible(self, image):
         """Return True if the image is visible in this context."""
         # Is admin == image visible
@@ -47,11 +51,8 @@ class RequestContext(context.RequestContext):
                 return True
 
             # Figure out if this image is shared with that tenant
-            try:
-                db_api.image_member_find(self, image.id, self.owner)
+            if self.get_membership(image) is not None:
                 return True
-            except exception.NotFound:
-                pass
 
         # Private image
         return False
@@ -77,12 +78,37 @@ class RequestContext(context.RequestContext):
                 # Not shared with us anyway
                 return False
         else:
-            try:
-                membership = db_api.image_member_find(self, image.id,
-                                                      self.owner)
-            except exception.NotFound:
+            membership = self.get_membership(image)
+            if membership is None:
                 # Not shared with us anyway
                 return False
 
         # It's the can_share attribute we're now interested in
         return membership.can_share
+
+    def get_membership(self, image):
+        """
+        Return the membership sharing the image with our owner, or None.
+
+        The answer is remembered for the life of the context, which lasts
+        a single request. It is read from the image's members when they
+        were loaded along with the image, and looked up otherwise.
+        """
+        if self.owner is None:
+            return None
+
+        if image.id not in self._memberships:
+            # SQLAlchemy keeps loaded relationships in the instance dict
+            if 'members' in image.__dict__:
+                found = [m for m in image.members
+                         if m.member == self.owner and
+                            m.deleted == self.show_deleted]
+                membership = found[0] if found else None
+            else:
+                try:
+                    membership = db_api.image_member_find(self, image.id,
+                                                          self.owner)
+                except exception.NotFound:
+                    membership = None
+            self._memberships[image.id] = membership
+        return self._memberships[image.id]
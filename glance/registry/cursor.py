@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Opaque, signed cursors for paging through registry listings
+
+A cursor records where a page of results ended: the sort key and direction
+of the listing, and the sort key value and id of the last row. The next
+page is then read with a single range scan of the (sort key, id) ordering,
+without first loading the last row again.
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+
+from glance.common import config
+from glance.common import exception
+from glance.registry.db import api as db_api
+
+# Sort keys whose values are datetimes, and how they are written in cursors
+DATETIME_SORT_KEYS = ('created_at', 'updated_at')
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def get_secret(options):
+    """
+    Returns the key cursors are signed with: the `cursor_secret` option, or
+    if that is not set a random key generated by the first registry server
+    to need one and kept in the registry database, so that all the servers
+    sharing the database use it. The database must be configured first.
+    """
+    secret = config.get_option(options, 'cursor_secret', type='str',
+                               default=None)
+    if not secret:
+        secret = db_api.setting_get_or_create('cursor_secret',
+                                              os.urandom(32).encode('hex'))
+    # hmac needs a byte string key
+    return str(secret)
+
+
+def _sign(secret, data):
+    return hmac.new(secret, data, hashlib.sha256).hexdigest()
+
+
+def _equal(a, b):
+    """Compares two strings in a time independent of where they differ"""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def encode(secret, sort_key, sort_dir, value, id):
+    """
+    Returns a cursor for the row with `id` and `value` for `sort_key`, in a
+    listing sorted on `sort_key` in direction `sort_dir`
+    """
+    if sort_key in DATETIME_SORT_KEYS and value is not None:
+        value = value.strftime(DATETIME_FORMAT)
+    data = base64.urlsafe_b64encode(json.dumps([sort_key, sort_dir,
+                                                value, id]))
+    return "%s.%s" % (data, _sign(secret, data))
+
+
+def decode(secret, token):
+    """
+    Returns the (sort_key, sort_dir, value, id) recorded in a cursor
+
+    :raises `glance.common.exception.InvalidCursor` if the cursor is
+            malformed or was not signed with `secret`
+    """
+    try:
+        data, signature = str(token).rsplit('.', 1)
+    except (ValueError, UnicodeError):
+        raise exception.InvalidCursor()
+    if not _equal(_sign(secret, data), signature):
+        raise exception.InvalidCursor()
+
+    try:
+        sort_key, sort_dir, value, id = json.loads(
+                base64.urlsafe_b64decode(data))
+        if sort_key in DATETIME_SORT_KEYS and value is not None:
+            value = datetime.datetime.strptime(value, DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        raise exception.InvalidCursor()
+    return sort_key, sort_dir, value, id
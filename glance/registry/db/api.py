@@ -21,14 +21,16 @@
 Defines interface for DB access
 """
 
+import copy
 import logging
 
 from sqlalchemy import asc, create_engine, desc
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import exc
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import or_, and_
 
 from glance.common import config
@@ -81,6 +83,11 @@ def configure_db(options):
 
         models.register_models(_ENGINE)
 
+        # Workers forked by a pre-forking server must not share the
+        # connection pooled while registering the models
+        if config.get_option(options, 'workers', type='int', default=0):
+            _ENGINE.dispose()
+
 
 def get_session(autocommit=True, expire_on_commit=False):
     """Helper method to grab session"""
@@ -107,6 +114,23 @@ def image_update(context, image_id, values, purge_props=False):
     return _image_update(context, values, image_id, purge_props)
 
 
+def image_update_many(context, image_ids, values):
+    """
+    Set the given attributes on several images with a single UPDATE.
+    Unlike `image_update`, the values are not validated and properties
+    cannot be set.
+
+    :retval the number of images updated
+    """
+    if not image_ids:
+        return 0
+    session = get_session()
+    with session.begin():
+        query = session.query(models.Image).\
+                        filter(models.Image.id.in_(image_ids))
+        return query.update(values, synchronize_session=False)
+
+
 def image_destroy(context, image_id):
     """Destroy the image or raise if it does not exist."""
     session = get_session()
@@ -131,40 +155,75 @@ def image_get(context, image_id, session=None):
     except (TypeError, ValueError):
         raise exception.NotFound("No image found")
 
+    query = session.query(models.Image).\
+                   options(joinedload(models.Image.properties)).\
+                   options(joinedload(models.Image.members)).\
+                   filter_by(deleted=_deleted(context)).\
+                   filter_by(id=image_id)
     try:
-        image = session.query(models.Image).\
-                       options(joinedload(models.Image.properties)).\
-                       options(joinedload(models.Image.members)).\
-                       filter_by(deleted=_deleted(context)).\
-                       filter_by(id=image_id).\
-                       one()
+        return _filter_visible(context, query).one()
     except exc.NoResultFound:
-        raise exception.NotFound("No image found with ID %s" % image_id)
-
-    # Make sure they can look at it
-    if not context.is_image_visible(image):
+        _check_image_exists(context, image_id, session)
         raise exception.NotAuthorized("Image not visible to you")
 
-    return image
-
 
-def image_get_all_pending_delete(context, delete_time=None, limit=None):
-    """Get all images that are pending deletion
+def image_get_many(context, image_ids):
+    """
+    Get the images with the given ids in a single query.
 
-    :param limit: maximum number of images to return
+    Ids that don't exist or name images not visible in the context are
+    left out, so the result may be shorter than `image_ids`. Images are
+    returned in the order their ids were given.
     """
+    ids = []
+    for image_id in image_ids:
+        try:
+            # Compare as integers, for the same reason as image_get
+            ids.append(int(image_id))
+        except (TypeError, ValueError):
+            pass
+    if not ids:
+        return []
+
     session = get_session()
     query = session.query(models.Image).\
                    options(joinedload(models.Image.properties)).\
                    options(joinedload(models.Image.members)).\
+                   filter_by(deleted=_deleted(context)).\
+                   filter(models.Image.id.in_(set(ids)))
+
+    by_id = dict((image.id, image)
+                 for image in _filter_visible(context, query).all())
+    results = []
+    for image_id in ids:
+        image = by_id.pop(image_id, None)
+        if image is not None:
+            results.append(image)
+    return results
+
+
+def image_get_all_pending_delete(context, delete_time=None, limit=None,
+                                 cursor=None):
+    """Get all images that are pending deletion, in the order they were
+    deleted. Their properties and members are not loaded.
+
+    :param limit: maximum number of images to return
+    :param cursor: (deleted_at, id) of the image after which to start
+    """
+    session = get_session()
+    query = session.query(models.Image).\
                    filter_by(deleted=True).\
                    filter(models.Image.status == 'pending_delete')
 
     if delete_time:
         query = query.filter(models.Image.deleted_at <= delete_time)
 
-    query = query.order_by(desc(models.Image.deleted_at)).\
-                  order_by(desc(models.Image.id))
+    query = query.order_by(asc(models.Image.deleted_at)).\
+                  order_by(asc(models.Image.id))
+
+    if cursor is not None:
+        query = _filter_after(query, models.Image.deleted_at,
+                              models.Image.id, 'asc', *cursor)
 
     if limit:
         query = query.limit(limit)
@@ -173,26 +232,39 @@ def image_get_all_pending_delete(context, delete_time=None, limit=None):
 
 
 def image_get_all(context, filters=None, marker=None, limit=None,
-                  sort_key='created_at', sort_dir='desc'):
+                  sort_key='created_at', sort_dir='desc', cursor=None,
+                  columns=None):
     """
     Get all images that match zero or more filters.
 
+    Images are returned with their properties, which are read by a second
+    query rather than joined to every image row. Their members are not
+    loaded.
+
     :param filters: dict of filter keys and values. If a 'properties'
                     key is present, it is treated as a dict of key/value
                     filters on the image properties attribute
     :param marker: image id after which to start page
+    :param cursor: (sort key value, id) of the image after which to start
+                   page, which saves looking up the marker image
     :param limit: maximum number of images to return
     :param sort_key: image attribute by which results should be sorted
     :param sort_dir: direction in which results should be sorted (asc, desc)
+    :param columns: names of the only image attributes to read. If given,
+                    each image is returned as a dict of these attributes,
+                    without its properties, and no Image objects are built
     """
     filters = filters or {}
 
     session = get_session()
-    query = session.query(models.Image).\
-                   options(joinedload(models.Image.properties)).\
-                   options(joinedload(models.Image.members)).\
-                   filter_by(deleted=_deleted(context)).\
-                   filter(models.Image.status != 'killed')
+    if columns:
+        query = session.query(*[getattr(models.Image, column)
+                                for column in columns])
+    else:
+        query = session.query(models.Image)
+    query = query.filter(models.Image.deleted == _deleted(context)).\
+                  filter(models.Image.status != 'killed')
+    query = _filter_visible(context, query)
 
     sort_dir_func = {
         'asc': asc,
@@ -223,32 +295,139 @@ def image_get_all(context, filters=None, marker=None, limit=None,
             query = query.filter(the_filter[0])
         del filters['is_public']
 
-    for (k, v) in filters.pop('properties', {}).items():
-        query = query.filter(models.Image.properties.any(name=k, value=v))
+    properties = filters.pop('properties', None)
+    if properties:
+        query = query.filter(models.Image.id.in_(
+                _with_properties(session, properties)))
 
     for (k, v) in filters.items():
         if v is not None:
             query = query.filter(getattr(models.Image, k) == v)
 
-    if marker != None:
+    if cursor is None and marker != None:
         # images returned should be created before the image defined by marker
         marker_image = image_get(context, marker)
-        marker_value = getattr(marker_image, sort_key)
-        if sort_dir == 'desc':
-            query = query.filter(
-                or_(sort_key_attr < marker_value,
-                    and_(sort_key_attr == marker_value,
-                         models.Image.id < marker)))
-        else:
-            query = query.filter(
-                or_(sort_key_attr > marker_value,
-                    and_(sort_key_attr == marker_value,
-                         models.Image.id > marker)))
+        cursor = (getattr(marker_image, sort_key), marker)
+
+    if cursor is not None:
+        query = _filter_after(query, sort_key_attr, models.Image.id,
+                              sort_dir, *cursor)
 
     if limit != None:
         query = query.limit(limit)
 
-    return query.all()
+    if columns:
+        return [dict(zip(columns, row)) for row in query]
+
+    images = query.all()
+    _load_properties(session, images)
+    return images
+
+
+def _with_properties(session, properties):
+    """
+    Returns a subquery selecting the ids of the images that have all of a
+    dict of properties.
+
+    Rather than one subquery per property, the matching property rows are
+    joined on image id: the rows matching one (name, value) pair are found
+    through the property index, and each of the other pairs is checked
+    with a lookup on the unique (image_id, name) index.
+    """
+    query = None
+    for name, value in sorted(properties.items()):
+        prop = aliased(models.ImageProperty)
+        matches = and_(prop.name == name, prop.value == value,
+                       prop.deleted == False)
+        if query is None:
+            first = prop
+            query = session.query(prop.image_id).filter(matches)
+        else:
+            query = query.join((prop, and_(prop.image_id == first.image_id,
+                                           matches)))
+    return query.subquery()
+
+
+def _load_properties(session, images):
+    """
+    Loads the properties of a list of images with a single query, rather
+    than with a join that repeats each image's row for every property.
+    """
+    if not images:
+        return
+    properties = dict((image.id, []) for image in images)
+    image_ids = properties.keys()
+    query = session.query(models.ImageProperty).\
+                    filter(models.ImageProperty.image_id.in_(image_ids))
+    for prop in query:
+        properties[prop.image_id].append(prop)
+    for image in images:
+        set_committed_value(image, 'properties', properties[image.id])
+
+
+def image_iter_all(context, batch_size, filters=None, marker=None,
+                   limit=None, sort_key='created_at', sort_dir='desc',
+                   cursor=None, columns=None):
+    """
+    Get all images that match zero or more filters, as `image_get_all`
+    does, but read `batch_size` at a time so that only one batch is held
+    in memory.
+
+    The first batch is read before this returns, so that errors such as
+    an unknown marker are raised here rather than while iterating.
+
+    :param batch_size: maximum number of images to read at once
+    :retval an iterator over the images
+    """
+    def get_batch(read, **kwargs):
+        if limit is not None:
+            count = min(batch_size, limit - read)
+        else:
+            count = batch_size
+        images = image_get_all(context, filters=copy.deepcopy(filters),
+                               limit=count, sort_key=sort_key,
+                               sort_dir=sort_dir, columns=columns,
+                               **kwargs)
+        return images, count
+
+    def iterate(images, count):
+        read = 0
+        while True:
+            for image in images:
+                yield image
+            read += len(images)
+            if len(images) < count or read == limit:
+                return
+            # Each batch starts after the last image of the one before
+            last = images[-1]
+            images, count = get_batch(read,
+                                      cursor=(last[sort_key], last['id']))
+
+    return iterate(*get_batch(0, marker=marker, cursor=cursor))
+
+
+def _filter_after(query, sort_key_attr, id_attr, sort_dir, value, id):
+    """
+    Restricts a query ordered by (sort_key_attr, id_attr) in `sort_dir` to
+    the rows that come after the row with `id` and sort key `value`.
+
+    NULL sort keys are taken to sort before any value, as SQLite and MySQL
+    sort them.
+    """
+    if value is None:
+        if sort_dir == 'desc':
+            return query.filter(and_(sort_key_attr == None, id_attr < id))
+        return query.filter(or_(and_(sort_key_attr == None, id_attr > id),
+                                sort_key_attr != None))
+
+    if sort_dir == 'desc':
+        return query.filter(
+            or_(sort_key_attr < value,
+                and_(sort_key_attr == value, id_attr < id),
+                sort_key_attr == None))
+    return query.filter(
+        or_(sort_key_attr > value,
+            and_(sort_key_attr == value, id_attr > id)))
 
 
 def _drop_protected_attrs(model_class, values):
@@ -446,20 +625,25 @@ def image_member_delete(context, memb_ref, session=None):
 def image_member_get(context, member_id, session=None):
     """Get an image member or raise if it does not exist."""
     session = session or get_session()
+    query = session.query(models.ImageMember).\
+                   options(joinedload(models.ImageMember.image)).\
+                   filter_by(deleted=_deleted(context)).\
+                   filter_by(id=member_id)
+    if not context.is_admin:
+        query = _filter_visible(context, query.join(models.ImageMember.image))
     try:
-        member = session.query(models.ImageMember).\
-                        options(joinedload(models.ImageMember.image)).\
-                        filter_by(deleted=_deleted(context)).\
-                        filter_by(id=member_id).\
-                        one()
+        return query.one()
     except exc.NoResultFound:
-        raise exception.NotFound("No membership found with ID %s" % member_id)
-
-    # Make sure they can look at it
-    if not context.is_image_visible(member.image):
-        raise exception.NotAuthorized("Image not visible to you")
+        pass
 
-    return member
+    try:
+        session.query(models.ImageMember.id).\
+                filter_by(deleted=_deleted(context)).\
+                filter_by(id=member_id).\
+                one()
+    except exc.NoResultFound:
+        raise exception.NotFound("No membership found with ID %s" % member_id)
+    raise exception.NotAuthorized("Image not visible to you")
 
 
 def image_member_find(context, image_id, member, session=None):
@@ -480,12 +664,15 @@ def image_member_find(context, image_id, member, session=None):
 
 
 def image_member_get_memberships(context, member, marker=None, limit=None,
-                                 sort_key='created_at', sort_dir='desc'):
+                                 sort_key='created_at', sort_dir='desc',
+                                 cursor=None):
     """
     Get all image memberships for the given member.
 
     :param member: the member to look up memberships for
     :param marker: membership id after which to start page
+    :param cursor: (sort key value, id) of the membership after which to
+                   start page, which saves looking up the marker membership
     :param limit: maximum number of memberships to return
     :param sort_key: membership attribute by which results should be sorted
     :param sort_dir: direction in which results should be sorted (asc, desc)
@@ -507,21 +694,15 @@ def image_member_get_memberships(context, member, marker=None, limit=None,
     query = query.order_by(sort_dir_func(sort_key_attr)).\
                   order_by(sort_dir_func(models.ImageMember.id))
 
-    if marker != None:
+    if cursor is None and marker != None:
         # memberships returned should be created before the membership
         # defined by marker
         marker_membership = image_member_get(context, marker)
-        marker_value = getattr(marker_membership, sort_key)
-        if sort_dir == 'desc':
-            query = query.filter(
-                or_(sort_key_attr < marker_value,
-                    and_(sort_key_attr == marker_value,
-                         models.ImageMember.id < marker)))
-        else:
-            query = query.filter(
-                or_(sort_key_attr > marker_value,
-                    and_(sort_key_attr == marker_value,
-                         models.ImageMember.id > marker)))
+        cursor = (getattr(marker_membership, sort_key), marker)
+
+    if cursor is not None:
+        query = _filter_after(query, sort_key_attr, models.ImageMember.id,
+                              sort_dir, *cursor)
 
     if limit != None:
         query = query.limit(limit)
@@ -529,6 +710,35 @@ def image_member_get_memberships(context, member, marker=None, limit=None,
     return query.all()
 
 
+def _filter_visible(context, query):
+    """
+    Restricts a query on images to those visible in the context, in the
+    same way as RequestContext.is_image_visible but as a single SQL
+    predicate, so that no further queries are needed to check membership.
+    """
+    if context.is_admin:
+        return query
+
+    visible = [models.Image.owner == None,
+               models.Image.is_public == True]
+    if context.owner is not None:
+        visible.append(models.Image.owner == context.owner)
+        visible.append(models.Image.members.any(
+                member=context.owner, deleted=_deleted(context)))
+    return query.filter(or_(*visible))
+
+
+def _check_image_exists(context, image_id, session):
+    """Raises NotFound unless an image exists, whoever may see it"""
+    try:
+        session.query(models.Image.id).\
+                filter_by(deleted=_deleted(context)).\
+                filter_by(id=image_id).\
+                one()
+    except exc.NoResultFound:
+        raise exception.NotFound("No image found with ID %s" % image_id)
+
+
 # pylint: disable-msg=C0111
 def _deleted(context):
     """
@@ -540,3 +750,23 @@ def _deleted(context):
     if not hasattr(context, 'get'):
         return False
     return context.get('deleted', False)
+
+
+def setting_get_or_create(name, value):
+    """
+    Returns the value of a setting, first storing `value` as its value if
+    it has none. Of several servers creating the same setting at once, all
+    are returned the value stored first.
+    """
+    session = get_session()
+    setting = session.query(models.Setting).filter_by(name=name).first()
+    if setting is not None:
+        return setting.value
+    try:
+        with session.begin():
+            session.add(models.Setting(name=name, value=value))
+    except IntegrityError:
+        session = get_session()
+        setting = session.query(models.Setting).filter_by(name=name).one()
+        return setting.value
+    return value
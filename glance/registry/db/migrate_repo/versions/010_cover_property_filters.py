@@ -0,0 +1,93 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from migrate.changeset import *
+from sqlalchemy import *
+
+from glance.registry.db.migrate_repo.schema import from_migration_import
+
+
+def get_images_table(meta):
+    """
+    No changes to the images table from 009...
+    """
+    (get_images_table,) = from_migration_import(
+        '009_add_listing_indexes', ['get_images_table'])
+
+    images = get_images_table(meta)
+    return images
+
+
+def get_image_properties_table(meta):
+    """
+    No changes to the image properties table from 009...
+    """
+    (get_image_properties_table,) = from_migration_import(
+        '009_add_listing_indexes', ['get_image_properties_table'])
+
+    image_properties = get_image_properties_table(meta)
+    return image_properties
+
+
+def get_image_members_table(meta):
+    """
+    No changes to the image members table from 009...
+    """
+    (get_image_members_table,) = from_migration_import(
+        '009_add_listing_indexes', ['get_image_members_table'])
+
+    image_members = get_image_members_table(meta)
+    return image_members
+
+
+def _value_column(migrate_engine):
+    # MySQL can only index a prefix of a TEXT column, which
+    # sqlalchemy's Index cannot express
+    dialect = migrate_engine.url.get_dialect().name
+    return 'value(255)' if dialect.startswith('mysql') else 'value'
+
+
+def upgrade(migrate_engine):
+    """
+    Replaces the (name, value) index on image properties with one that
+    also holds `deleted` and `image_id`, so that property filters need
+    not read the properties table itself.
+    """
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    image_properties = get_image_properties_table(meta)
+    migrate_engine.execute(
+            "CREATE INDEX ix_image_properties_name_value_deleted_image_id "
+            "ON image_properties (name, %s, deleted, image_id)"
+            % _value_column(migrate_engine))
+    Index('ix_image_properties_name_value', image_properties.c.name,
+          image_properties.c.value).drop(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    image_properties = get_image_properties_table(meta)
+    migrate_engine.execute("CREATE INDEX ix_image_properties_name_value "
+                           "ON image_properties (name, %s)"
+                           % _value_column(migrate_engine))
+    Index('ix_image_properties_name_value_deleted_image_id',
+          image_properties.c.name, image_properties.c.value,
+          image_properties.c.deleted,
+          image_properties.c.image_id).drop(migrate_engine)
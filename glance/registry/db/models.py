@@ -26,7 +26,7 @@ import datetime
 from sqlalchemy.orm import relationship, backref, exc, object_mapper, validates
 from sqlalchemy import Column, Integer, String, BigInteger
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import DDL, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 
 import glance.registry.db.api
@@ -134,11 +134,49 @@ class ImageMember(BASE, ModelBase):
     can_share = Column(Boolean, nullable=False, default=False)
 
 
+class Setting(BASE):
+    """Represents a value the registry servers sharing a database agree on"""
+    __tablename__ = 'settings'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    name = Column(String(255), primary_key=True)
+    value = Column(Text)
+
+
+# Indexes serving the listings in glance.registry.db.api. Each images index
+# leads with `deleted`, which every listing filters on, followed by one of
+# the supported sort keys and the id that breaks ties between equal keys.
+Index('ix_images_deleted_created_at', Image.__table__.c.deleted,
+      Image.__table__.c.created_at, Image.__table__.c.id)
+Index('ix_images_deleted_updated_at', Image.__table__.c.deleted,
+      Image.__table__.c.updated_at, Image.__table__.c.id)
+Index('ix_images_deleted_name', Image.__table__.c.deleted,
+      Image.__table__.c.name, Image.__table__.c.id)
+Index('ix_images_deleted_size', Image.__table__.c.deleted,
+      Image.__table__.c.size, Image.__table__.c.id)
+Index('ix_images_deleted_status', Image.__table__.c.deleted,
+      Image.__table__.c.status, Image.__table__.c.id)
+Index('ix_image_members_member_deleted', ImageMember.__table__.c.member,
+      ImageMember.__table__.c.deleted)
+
+# MySQL can only index a prefix of a TEXT column, so the property value
+# index is created by hand. It also holds `deleted` and `image_id`, so that
+# property filters are answered from the index alone.
+PROPERTY_VALUE_INDEX = ("CREATE INDEX "
+                        "ix_image_properties_name_value_deleted_image_id "
+                        "ON image_properties (name, %s, deleted, image_id)")
+DDL(PROPERTY_VALUE_INDEX % 'value(255)', on='mysql').execute_at(
+        'after-create', ImageProperty.__table__)
+DDL(PROPERTY_VALUE_INDEX % 'value',
+    on=lambda ddl, event, target, bind, **kw: bind.engine.name != 'mysql').\
+    execute_at('after-create', ImageProperty.__table__)
+
+
 def register_models(engine):
     """
     Creates database tables for all models with the given engine
     """
-    models = (Image, ImageProperty, ImageMember)
+    models = (Image, ImageProperty, ImageMember, Setting)
     for model in models:
         model.metadata.create_all(engine)
 
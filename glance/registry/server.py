@@ -25,8 +25,10 @@ import logging
 import routes
 from webob import exc
 
-from glance.common import wsgi
+from glance.common import config
 from glance.common import exception
+from glance.common import wsgi
+from glance.registry import cursor
 from glance.registry.db import api as db_api
 
 
@@ -44,7 +46,14 @@ SUPPORTED_SORT_KEYS = ('name', 'status', 'container_format', 'disk_format',
 
 SUPPORTED_SORT_DIRS = ('asc', 'desc')
 
-SUPPORTED_PARAMS = ('limit', 'marker', 'sort_key', 'sort_dir')
+DEFAULT_SORT_KEY = 'created_at'
+
+DEFAULT_SORT_DIR = 'desc'
+
+SUPPORTED_PARAMS = ('limit', 'marker', 'sort_key', 'sort_dir', 'cursor')
+
+# Maximum number of images a single bulk-get request may ask for
+MAX_BULK_GET = 1000
 
 
 class Controller(object):
@@ -52,13 +61,19 @@ class Controller(object):
 
     def __init__(self, options):
         self.options = options
+        self.listing_batch_size = config.get_option(
+                options, 'listing_batch_size', type='int', default=200)
         db_api.configure_db(options)
+        self.cursor_secret = cursor.get_secret(options)
 
-    def _get_images(self, context, **params):
+    def _get_images(self, context, batch_size=None, **params):
         """
-        Get images, wrapping in exception if necessary.
+        Get images, wrapping in exception if necessary. If `batch_size` is
+        given, an iterator reading that many images at a time is returned.
         """
         try:
+            if batch_size:
+                return db_api.image_iter_all(context, batch_size, **params)
             return db_api.image_get_all(context, **params)
         except exception.NotFound, e:
             msg = _("Invalid marker. Image could not be found.")
@@ -71,7 +86,7 @@ class Controller(object):
         :param req: the Request object coming from the wsgi layer
         :retval a mapping of the following form::
 
-            dict(images=[image_list])
+            dict(images=[image_list], next_cursor=<CURSOR>)
 
         Where image_list is a sequence of mappings::
 
@@ -83,17 +98,24 @@ class Controller(object):
             'container_format': <CONTAINER_FORMAT>,
             'checksum': <CHECKSUM>
             }
-        """
-        params = self._get_query_params(req)
-        images = self._get_images(req.context, **params)
 
-        results = []
-        for image in images:
+        and next_cursor, present only if the page is full, is passed as the
+        cursor query param to fetch the next page.
+        """
+        def make_result(image):
             result = {}
             for field in DISPLAY_FIELDS_IN_INDEX:
                 result[field] = image[field]
-            results.append(result)
-        return dict(images=results)
+            return result
+
+        # Only the displayed fields, and the sort key that cursors record,
+        # are read from the database
+        params = self._get_query_params(req)
+        params['columns'] = list(DISPLAY_FIELDS_IN_INDEX)
+        sort_key = params.get('sort_key', DEFAULT_SORT_KEY)
+        if sort_key not in params['columns']:
+            params['columns'].append(sort_key)
+        return self._get_page(req.context, params, make_result)
 
     def detail(self, req):
         """
@@ -102,16 +124,63 @@ class Controller(object):
         :param req: the Request object coming from the wsgi layer
         :retval a mapping of the following form::
 
-            dict(images=[image_list])
+            dict(images=[image_list], next_cursor=<CURSOR>)
 
         Where image_list is a sequence of mappings containing
-        all image model fields.
+        all image model fields, and next_cursor is as for `index`.
         """
         params = self._get_query_params(req)
+        return self._get_page(req.context, params, make_image_dict)
+
+    def _get_page(self, context, params, make_result):
+        """
+        Returns the response for a page of images, each converted by
+        `make_result`, with a cursor for the next page unless this one was
+        the last.
 
-        images = self._get_images(req.context, **params)
-        image_dicts = [make_image_dict(i) for i in images]
-        return dict(images=image_dicts)
+        Pages of more than `listing_batch_size` images are read from the
+        database that many at a time, and streamed to the client as they
+        are read rather than built whole in memory.
+        """
+        if params['limit'] <= self.listing_batch_size:
+            images = self._get_images(context, **params)
+            page = dict(images=[make_result(image) for image in images])
+            if images:
+                next_cursor = self._next_cursor(images[-1], len(images),
+                                                params)
+                if next_cursor is not None:
+                    page['next_cursor'] = next_cursor
+            return page
+
+        images = self._get_images(context, self.listing_batch_size,
+                                  **params)
+        read = dict(last=None, count=0)
+
+        def results():
+            for image in images:
+                read['last'] = image
+                read['count'] += 1
+                yield make_result(image)
+
+        # Called by the serializer once every image has been written
+        def next_cursor():
+            if read['last'] is not None:
+                return self._next_cursor(read['last'], read['count'],
+                                         params)
+
+        return dict(images=results(), next_cursor=next_cursor)
+
+    def _next_cursor(self, last, count, params):
+        """
+        Returns the cursor for the page after one of `count` images ending
+        with `last`, or None if that page was not full.
+        """
+        if count != params['limit']:
+            return None
+        sort_key = params.get('sort_key', DEFAULT_SORT_KEY)
+        sort_dir = params.get('sort_dir', DEFAULT_SORT_DIR)
+        return cursor.encode(self.cursor_secret, sort_key, sort_dir,
+                             last[sort_key], last['id'])
 
     def _get_query_params(self, req):
         """
@@ -127,6 +196,11 @@ class Controller(object):
             'sort_dir': self._get_sort_dir(req),
             'marker': self._get_marker(req),
         }
+        params['cursor'] = self._get_cursor(req, params['sort_key'],
+                                            params['sort_dir'])
+        if params['cursor'] is not None and params['marker'] is not None:
+            msg = _("Only one of marker and cursor may be given")
+            raise exc.HTTPBadRequest(explanation=msg)
 
         for key, value in params.items():
             if value is None:
@@ -203,6 +277,28 @@ class Controller(object):
             raise exc.HTTPBadRequest(_("marker param must be an integer"))
         return marker
 
+    def _get_cursor(self, req, sort_key, sort_dir):
+        """
+        Parse a cursor query param into the (sort key value, id) of the
+        image it points after.
+        """
+        token = req.str_params.get('cursor', None)
+
+        if token is None:
+            return None
+
+        try:
+            key, direction, value, image_id = cursor.decode(
+                    self.cursor_secret, token)
+        except exception.InvalidCursor, e:
+            raise exc.HTTPBadRequest(explanation=str(e))
+
+        if (key, direction) != (sort_key or DEFAULT_SORT_KEY,
+                                sort_dir or DEFAULT_SORT_DIR):
+            msg = _("cursor was made for a listing sorted differently")
+            raise exc.HTTPBadRequest(explanation=msg)
+        return value, image_id
+
     def _get_sort_key(self, req):
         """Parse a sort key query param from the request object."""
         sort_key = req.str_params.get('sort_key', None)
@@ -257,6 +353,31 @@ class Controller(object):
 
         return dict(image=make_image_dict(image))
 
+    def bulk_get(self, req, body=None):
+        """
+        Returns data about each of a list of images, read in one query.
+
+        :param req: wsgi Request object
+        :param body: Mapping of the form {'ids': [<ID>, ...]}
+
+        :retval a mapping of the form dict(images=[image_list]), holding
+                the images in the order they were asked for. Images that
+                don't exist or aren't visible to the requester are left
+                out.
+        """
+        image_ids = body.get('ids') if isinstance(body, dict) else None
+        if not isinstance(image_ids, list):
+            msg = _("The request body must be a mapping with a list of "
+                    "image ids under 'ids'")
+            raise exc.HTTPBadRequest(explanation=msg)
+        if len(image_ids) > MAX_BULK_GET:
+            msg = _("At most %d images may be requested at once") \
+                  % MAX_BULK_GET
+            raise exc.HTTPBadRequest(explanation=msg)
+
+        images = db_api.image_get_many(req.context, image_ids)
+        return dict(images=[make_image_dict(image) for image in images])
+
     def delete(self, req, id):
         """
         Deletes an existing image with the registry.
@@ -618,6 +739,8 @@ class API(wsgi.Router):
         mapper.resource("image", "images", controller=resource,
                         collection={'detail': 'GET'})
         mapper.connect("/", controller=resource, action="index")
+        mapper.connect("/images/bulk-get", controller=resource,
+                       action="bulk_get", conditions=dict(method=["POST"]))
         mapper.connect("/shared-images/{member}",
                        controller=resource, action="shared_images")
         mapper.connect("/images/{image_id}/members",
@@ -642,8 +765,8 @@ def make_image_dict(image):
     """
 
     def _fetch_attrs(d, attrs):
-        return dict([(a, d[a]) for a in attrs
-                    if a in d.keys()])
+        keys = set(d.keys())
+        return dict([(a, d[a]) for a in attrs if a in keys])
 
     # TODO(sirp): should this be a dict, or a list of dicts?
     # A plain dict is more convenient, but list of dicts would provide
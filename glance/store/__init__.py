@@ -121,13 +121,18 @@ def get_store_from_uri(uri):
     return get_store_from_scheme(scheme)
 
 
-def get_from_backend(uri, **kwargs):
-    """Yields chunks of data from backend specified by uri"""
+def get_from_backend(uri, offset=0, length=None, **kwargs):
+    """
+    Yields chunks of data from backend specified by uri
+
+    :param offset: byte offset within the image to start reading from
+    :param length: number of bytes to read, or None to read to the end
+    """
 
     store = get_store_from_uri(uri)
     loc = location.get_location_from_uri(uri)
 
-    return store.get(loc)
+    return store.get(loc, offset=offset, length=length)
 
 
 def delete_from_backend(uri, **kwargs):
@@ -141,6 +146,22 @@ def delete_from_backend(uri, **kwargs):
         raise exception.StoreDeleteNotSupported
 
 
+def delete_many_from_backend(uris):
+    """
+    Removes the data of several images from the backend specified by their
+    uris, which must all be handled by the same store
+
+    :retval a list holding, for each uri in turn, None if its data was
+            removed, or else the exception that prevented it
+    """
+    store = get_store_from_uri(uris[0])
+    locations = [location.get_location_from_uri(uri) for uri in uris]
+    results = store.delete_many(locations)
+    return [exception.StoreDeleteNotSupported()
+            if isinstance(result, NotImplementedError) else result
+            for result in results]
+
+
 def get_store_from_location(uri):
     """
     Given a location (assumed to be a URL), attempt to determine
@@ -17,8 +17,11 @@
 
 """Base class for all storage backends"""
 
+import collections
 import logging
 
+import eventlet
+
 from glance.common import exception
 
 logger = logging.getLogger('glance.store.base')
@@ -52,7 +55,7 @@ class Store(object):
         """
         pass
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -60,6 +63,8 @@ class Store(object):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: byte offset within the image to start reading from
+        :param length: number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
@@ -97,3 +102,55 @@ class Store(object):
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
+
+    def delete_many(self, locations):
+        """
+        Takes a list of `glance.store.location.Location` objects that
+        indicate where to find image files to delete, and deletes them all.
+
+        By default each file is deleted with `delete`. Stores that can
+        delete several files with one request, or that need a connection
+        to delete a file, override this to do so for the whole list.
+
+        :retval a list holding, for each location in turn, None if its
+                file was deleted, or else the exception that prevented it;
+                `glance.exception.NotFound` if the file did not exist
+        """
+        results = []
+        for location in locations:
+            try:
+                self.delete(location)
+            except Exception, e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
+
+def parallel_range_reader(fetch_range, offset, length, chunk_size,
+                          concurrency):
+    """
+    Returns an iterator over `length` bytes of an object starting at
+    `offset`, which reads the object as a series of `chunk_size` byte ranges
+    with up to `concurrency` of them in flight at once. The ranges are
+    yielded in order; at most `concurrency` of them are held in memory
+    waiting for an earlier range to finish.
+
+    :param fetch_range: Callable taking (offset, length) which returns the
+                        bytes of that range of the object as a string
+    """
+    pool = eventlet.GreenPool(concurrency)
+    pending = collections.deque()
+    end = offset + length
+    try:
+        for start in xrange(offset, end, chunk_size):
+            if len(pending) >= concurrency:
+                yield pending.popleft().wait()
+            pending.append(pool.spawn(fetch_range, start,
+                                      min(chunk_size, end - start)))
+        while pending:
+            yield pending.popleft().wait()
+    finally:
+        # Don't leave requests running if the reader gives up early
+        for thread in pending:
+            thread.kill()
@@ -19,11 +19,15 @@
 A simple filesystem-backed store
 """
 
+import errno
 import hashlib
 import logging
 import os
 import urlparse
 
+import eventlet
+import eventlet.tpool
+
 from glance.common import exception
 import glance.store
 import glance.store.base
@@ -68,16 +72,24 @@ class ChunkedFile(object):
 
     CHUNKSIZE = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, length=None):
         self.filepath = filepath
         self.fp = open(self.filepath, 'rb')
+        if offset:
+            self.fp.seek(offset)
+        self.remaining = length
 
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
-            while True:
-                chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+            while self.remaining is None or self.remaining > 0:
+                size = ChunkedFile.CHUNKSIZE
+                if self.remaining is not None:
+                    size = min(size, self.remaining)
+                chunk = self.fp.read(size)
                 if chunk:
+                    if self.remaining is not None:
+                        self.remaining -= len(chunk)
                     yield chunk
                 else:
                     break
@@ -123,7 +135,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -131,6 +143,8 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: byte offset within the image to start reading from
+        :param length: number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
@@ -140,7 +154,7 @@ class Store(glance.store.base.Store):
         else:
             msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
             logger.debug(msg)
-            return ChunkedFile(filepath)
+            return ChunkedFile(filepath, offset=offset, length=length)
 
     def delete(self, location):
         """
@@ -165,6 +179,39 @@ class Store(glance.store.base.Store):
         else:
             raise exception.NotFound(_("Image file %s does not exist") % fn)
 
+    # Most files unlinked at once by delete_many
+    DELETE_CONCURRENCY = 8
+
+    def delete_many(self, locations):
+        """
+        Deletes the files at a list of locations. Each file is unlinked
+        without first checking that it exists, and a missing file reported
+        as `glance.exception.NotFound`. Up to `DELETE_CONCURRENCY` files are
+        unlinked at once, each in a thread so that a slow disk does not hold
+        up other green threads.
+
+        :retval a list holding, for each location in turn, None if its
+                file was deleted, or else the exception that prevented it
+        """
+        pool = eventlet.GreenPool(self.DELETE_CONCURRENCY)
+        return list(pool.imap(self._unlink, locations))
+
+    def _unlink(self, location):
+        """Returns None once the file at a location is unlinked, or else
+        the exception that prevented it
+        """
+        fn = location.store_location.path
+        try:
+            eventlet.tpool.execute(os.unlink, fn)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return exception.NotFound(
+                    _("Image file %s does not exist") % fn)
+            return exception.NotAuthorized(
+                _("You cannot delete file %s") % fn)
+        logger.debug(_("Deleted image at %(fn)s") % locals())
+        return None
+
     def add(self, image_id, image_file):
         """
         Stores an image file with supplied identifier to the backend
@@ -19,6 +19,7 @@ import httplib
 import urlparse
 
 from glance.common import exception
+from glance import utils
 import glance.store.base
 import glance.store.location
 
@@ -99,7 +100,7 @@ class Store(glance.store.base.Store):
 
     """An implementation of the HTTP(S) Backend Adapter"""
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -107,16 +108,29 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: byte offset within the image to start reading from
+        :param length: number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
+        ranged = offset or length is not None
+
+        headers = {}
+        if ranged:
+            headers['Range'] = utils.make_range_header(offset, length)
 
         conn_class = self._get_conn_class(loc)
         conn = conn_class(loc.netloc)
-        conn.request("GET", loc.path, "", {})
+        conn.request("GET", loc.path, "", headers)
 
         try:
-            return http_response_iterator(conn.getresponse(), self.CHUNKSIZE)
+            resp = conn.getresponse()
+            iterator = http_response_iterator(resp, self.CHUNKSIZE)
+            status = getattr(resp, 'status', None)
+            if ranged and status != httplib.PARTIAL_CONTENT:
+                # The server ignored our Range header and sent everything
+                iterator = utils.chunkslice(iterator, offset, length)
+            return iterator
         finally:
             conn.close()
 
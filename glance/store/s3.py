@@ -20,17 +20,28 @@
 import logging
 import hashlib
 import httplib
+import StringIO
 import tempfile
 import urlparse
 
+import eventlet
+
 from glance.common import config
 from glance.common import exception
+from glance import utils
 import glance.store
 import glance.store.base
 import glance.store.location
 
 logger = logging.getLogger('glance.store.s3')
 
+DEFAULT_MULTIPART_CHUNK_SIZE = 10  # MB
+DEFAULT_MULTIPART_CONCURRENCY = 4
+DEFAULT_READ_CHUNK_SIZE = 16  # MB
+
+# Most keys S3 deletes in one multi-object delete request
+MAX_DELETE_KEYS = 1000
+
 
 class StoreLocation(glance.store.location.StoreLocation):
 
@@ -190,6 +201,14 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
+        # Reads don't depend on the options below, so these are read first
+        self.read_concurrency = max(1, config.get_option(
+            self.options, 's3_store_read_concurrency', type='int',
+            default=1))
+        self.read_chunk_size = max(1, config.get_option(
+            self.options, 's3_store_read_chunk_size', type='int',
+            default=DEFAULT_READ_CHUNK_SIZE)) * 1024 * 1024
+
         self.s3_host = self._option_get('s3_store_host')
         access_key = self._option_get('s3_store_access_key')
         secret_key = self._option_get('s3_store_secret_key')
@@ -210,6 +229,17 @@ class Store(glance.store.base.Store):
         else:  # Defaults http
             self.full_s3_host = 'http://' + self.s3_host
 
+        self.multipart_upload = config.get_option(
+            self.options, 's3_store_multipart_upload', type='bool',
+            default=False)
+        # S3 requires every part but the last to be at least 5 MB
+        self.multipart_chunk_size = max(5, config.get_option(
+            self.options, 's3_store_multipart_chunk_size', type='int',
+            default=DEFAULT_MULTIPART_CHUNK_SIZE)) * 1024 * 1024
+        self.multipart_concurrency = max(1, config.get_option(
+            self.options, 's3_store_multipart_concurrency', type='int',
+            default=DEFAULT_MULTIPART_CONCURRENCY))
+
     def _option_get(self, param):
         result = self.options.get(param)
         if not result:
@@ -220,7 +250,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -228,6 +258,8 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: byte offset within the image to start reading from
+        :param length: number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
@@ -252,7 +284,23 @@ class Store(glance.store.base.Store):
         #   logger.error(msg)
         #   raise glance.store.BackendException(msg)
 
+        nbytes = key.size - offset if length is None else length
+        if self.read_concurrency > 1 and nbytes > self.read_chunk_size:
+            def fetch_range(start, size):
+                range_key = bucket_obj.key_class(bucket_obj, loc.key)
+                range_header = utils.make_range_header(start, size)
+                return range_key.get_contents_as_string(
+                    headers={'Range': range_header})
+
+            return glance.store.base.parallel_range_reader(
+                fetch_range, offset, nbytes, self.read_chunk_size,
+                self.read_concurrency)
+
         key.BufferSize = self.CHUNKSIZE
+        if offset or length is not None:
+            # Subsequent reads of the key consume this ranged response
+            range_header = utils.make_range_header(offset, length)
+            key.open_read(headers={'Range': range_header})
         return ChunkedFile(key)
 
     def add(self, image_id, image_file):
@@ -307,6 +355,14 @@ class Store(glance.store.base.Store):
                 'obj_name': obj_name})
         logger.debug(msg)
 
+        if self.multipart_upload:
+            size, checksum_hex = self._add_multipart(bucket_obj, obj_name,
+                                                     image_file)
+            logger.debug(_("Wrote %(size)d bytes to S3 key named "
+                           "%(obj_name)s with checksum %(checksum_hex)s")
+                         % locals())
+            return (loc.get_uri(), size, checksum_hex)
+
         key = bucket_obj.new_key(obj_name)
 
         # We need to wrap image_file, which is a reference to the
@@ -347,6 +403,79 @@ class Store(glance.store.base.Store):
 
         return (loc.get_uri(), size, checksum_hex)
 
+    def _add_multipart(self, bucket_obj, obj_name, image_file):
+        """
+        Streams `image_file` into S3 as a multipart upload, without spooling
+        it to local disk. The body is cut into `s3_store_multipart_chunk_size`
+        MB parts, of which up to `s3_store_multipart_concurrency` are
+        uploaded concurrently while the next one is read, so at most that
+        many parts plus one are held in memory. An image that fits in a
+        single part is uploaded with a plain PUT.
+
+        The multipart upload is aborted if any part fails.
+
+        :retval tuple of the size and the hex MD5 checksum of the image
+        """
+        checksum = hashlib.md5()
+
+        def read_part():
+            parts = []
+            remaining = self.multipart_chunk_size
+            while remaining > 0:
+                chunk = image_file.read(min(remaining, self.CHUNKSIZE))
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                parts.append(chunk)
+                remaining -= len(chunk)
+            return ''.join(parts)
+
+        data = read_part()
+        size = len(data)
+        if size < self.multipart_chunk_size:
+            key = bucket_obj.new_key(obj_name)
+            key.set_contents_from_file(StringIO.StringIO(data),
+                                       replace=False)
+            return size, checksum.hexdigest()
+
+        mp = bucket_obj.initiate_multipart_upload(obj_name)
+        logger.debug(_("Started multipart upload %(mp_id)s of S3 key "
+                       "%(obj_name)s") % dict(mp_id=mp.id, obj_name=obj_name))
+        pool = eventlet.GreenPool(self.multipart_concurrency)
+        errors = []
+
+        def upload_part(part_num, data):
+            try:
+                mp.upload_part_from_file(StringIO.StringIO(data), part_num)
+            except Exception, e:
+                logger.error(_("Failed to upload part %(part_num)d of S3 "
+                               "key %(obj_name)s: %(e)s")
+                             % dict(part_num=part_num, obj_name=obj_name,
+                                    e=e))
+                errors.append(e)
+
+        try:
+            part_num = 1
+            while data and not errors:
+                # Blocks while all of the pool's workers are busy
+                pool.spawn_n(upload_part, part_num, data)
+                part_num += 1
+                data = read_part()
+                size += len(data)
+            pool.waitall()
+            if errors:
+                raise errors[0]
+            mp.complete_upload()
+        except Exception:
+            pool.waitall()
+            logger.error(_("Aborting multipart upload %(mp_id)s of S3 key "
+                           "%(obj_name)s") % dict(mp_id=mp.id,
+                                                  obj_name=obj_name))
+            mp.cancel_upload()
+            raise
+
+        return size, checksum.hexdigest()
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -376,6 +505,57 @@ class Store(glance.store.base.Store):
 
         return key.delete()
 
+    def delete_many(self, locations):
+        """
+        Deletes the objects at a list of locations with S3 multi-object
+        delete requests, one for each bucket and up to MAX_DELETE_KEYS
+        objects, sent over one connection for each set of credentials.
+
+        :retval a list holding, for each location in turn, None if its
+                object was deleted, or else the exception that prevented it
+        """
+        from boto.s3.connection import S3Connection
+        results = [None] * len(locations)
+
+        # Indices of the locations, by credentials and then by bucket
+        groups = {}
+        for i, location in enumerate(locations):
+            loc = location.store_location
+            account = (loc.accesskey, loc.secretkey, loc.s3serviceurl,
+                       loc.scheme)
+            groups.setdefault(account, {}).setdefault(loc.bucket,
+                                                      []).append(i)
+
+        for account, buckets in groups.items():
+            accesskey, secretkey, s3serviceurl, scheme = account
+            s3_conn = S3Connection(accesskey, secretkey, host=s3serviceurl,
+                                   is_secure=(scheme == 's3+https'))
+            for bucket, indices in buckets.items():
+                for start in xrange(0, len(indices), MAX_DELETE_KEYS):
+                    batch = indices[start:start + MAX_DELETE_KEYS]
+                    keys = [locations[i].store_location.key for i in batch]
+                    logger.debug(_("Deleting %(count)d image objects from "
+                                   "S3 bucket %(bucket)s") %
+                                 dict(count=len(keys), bucket=bucket))
+                    try:
+                        bucket_obj = get_bucket(s3_conn, bucket)
+                        errors = dict(
+                            (error.key, error)
+                            for error in bucket_obj.delete_keys(keys).errors)
+                    except Exception, e:
+                        for i in batch:
+                            results[i] = e
+                        continue
+                    for i, key in zip(batch, keys):
+                        error = errors.get(key)
+                        if error is not None:
+                            results[i] = glance.store.BackendException(
+                                _("Failed to delete S3 key %(key)s: "
+                                  "%(code)s %(message)s") %
+                                dict(key=key, code=error.code,
+                                     message=error.message))
+        return results
+
 
 def get_bucket(conn, bucket_id):
     """
@@ -17,16 +17,20 @@
 
 import datetime
 import eventlet
+import json
 import logging
+import os
 
 from glance import registry
 from glance import store
 import glance.store.filesystem
 import glance.store.http
+import glance.store.location
 import glance.store.s3
 import glance.store.swift
 from glance.common import config
 from glance.registry import context
+from glance.registry import cursor
 from glance.common import exception
 from glance.registry.db import api as db_api
 
@@ -67,28 +71,151 @@ class Scrubber(object):
                                        default=0)
         logger.info(_("Scrub interval set to %s seconds") % scrub_time)
         self.scrub_time = datetime.timedelta(seconds=scrub_time)
+        self.batch_size = config.get_option(options, 'scrub_batch_size',
+                                            type='int', default=100)
+        self.store_concurrency = config.get_option(
+                options, 'scrub_store_concurrency', type='int', default=10)
+        self.checkpoint_file = config.get_option(
+                options, 'scrub_checkpoint_file', type='str', default=None)
         db_api.configure_db(options)
         store.create_stores(options)
 
     def run(self, pool, event=None):
+        """
+        Deletes the images that have been pending deletion for longer than
+        `scrub_time`, reading them `scrub_batch_size` at a time.
+
+        The data of a batch of images is deleted from the stores in
+        green threads from `pool`, at most `scrub_store_concurrency` for
+        each store, and the images whose data is gone are then marked
+        deleted with a single UPDATE. The position reached is saved
+        to `scrub_checkpoint_file` after each batch, so that a scrubber
+        restarted part way through a run carries on from there. Images
+        whose data could not be deleted are tried again on the next run.
+        """
         delete_time = datetime.datetime.utcnow() - self.scrub_time
         logger.info(_("Getting images deleted before %s") % delete_time)
-        pending = db_api.image_get_all_pending_delete(None, delete_time)
-        num_pending = len(pending)
-        logger.info(_("Deleting %(num_pending)s images") % locals())
-        delete_work = [(p['id'], p['location']) for p in pending]
-        pool.starmap(self._delete, delete_work)
-
-    def _delete(self, id, location):
-        try:
-            logger.debug(_("Deleting %(location)s") % locals())
-            store.delete_from_backend(location)
-        except (store.UnsupportedBackend, exception.NotFound):
-            msg = _("Failed to delete image from store (%(uri)s).") % locals()
-            logger.error(msg)
-
+        position = self._read_checkpoint()
+        if position is not None:
+            logger.info(_("Resuming after image %s") % position[1])
+
+        num_deleted = 0
+        while True:
+            pending = db_api.image_get_all_pending_delete(
+                    None, delete_time, limit=self.batch_size, cursor=position)
+            num_pending = len(pending)
+            if not num_pending:
+                break
+            logger.info(_("Deleting %(num_pending)s images") % locals())
+            num_deleted += self._delete_batch(pool, pending)
+            if num_pending < self.batch_size:
+                break
+            last = pending[-1]
+            position = (last['deleted_at'], last['id'])
+            self._write_checkpoint(position)
+
+        self._clear_checkpoint()
+        logger.info(_("Deleted %(num_deleted)s images") % locals())
+
+    def _delete_batch(self, pool, images):
+        """
+        Deletes the data of a batch of images, then marks those whose data
+        is gone deleted. Returns the number of images marked.
+
+        The images are grouped by store, and each store's images are split
+        between up to `scrub_store_concurrency` green threads, each of
+        which deletes its share with a single call to the store's
+        `delete_many`.
+        """
+        by_store = {}
+        for image in images:
+            store_name = self._get_store_name(image['location'])
+            by_store.setdefault(store_name, []).append(image)
+
+        threads = []
+        for store_images in by_store.values():
+            for i in xrange(min(self.store_concurrency, len(store_images))):
+                share = store_images[i::self.store_concurrency]
+                threads.append(pool.spawn(self._delete_many, share))
+
+        deleted = []
+        for thread in threads:
+            deleted.extend(thread.wait())
         ctx = context.RequestContext(is_admin=True, show_deleted=True)
-        db_api.image_update(ctx, id, {'status': 'deleted'})
+        db_api.image_update_many(ctx, deleted, {'status': 'deleted'})
+        return len(deleted)
+
+    @staticmethod
+    def _get_store_name(location):
+        scheme = location[:location.find('://')]
+        return glance.store.location.SCHEME_TO_STORE_MAP.get(scheme, scheme)
+
+    def _delete_many(self, images):
+        """
+        Deletes the data of images held by the same store, returning the
+        ids of those that may now be marked deleted.
+        """
+        uris = [image['location'] for image in images]
+        logger.debug(_("Deleting %s") % ', '.join(uris))
+        try:
+            results = store.delete_many_from_backend(uris)
+        except Exception, e:
+            logger.exception(_("Failed to delete images from store"))
+            results = [e] * len(images)
+
+        deleted = []
+        for image, e in zip(images, results):
+            id = image['id']
+            location = image['location']
+            if e is None:
+                deleted.append(id)
+            elif isinstance(e, (store.UnsupportedBackend,
+                                exception.NotFound)):
+                msg = _("Failed to delete image from store "
+                        "(%(location)s).") % locals()
+                logger.error(msg)
+                deleted.append(id)
+            else:
+                msg = _("Failed to delete image %(id)s from store, will "
+                        "retry on the next run: %(e)s") % locals()
+                logger.error(msg)
+        return deleted
+
+    def _read_checkpoint(self):
+        """
+        Returns the (deleted_at, id) of the last image of the last batch
+        finished by a run that did not complete, or None
+        """
+        if not self.checkpoint_file or not os.path.exists(
+                self.checkpoint_file):
+            return None
+        try:
+            with open(self.checkpoint_file) as checkpoint:
+                deleted_at, image_id = json.load(checkpoint)
+            deleted_at = datetime.datetime.strptime(
+                    deleted_at, cursor.DATETIME_FORMAT)
+        except (IOError, TypeError, ValueError), e:
+            msg = _("Ignoring unreadable checkpoint file "
+                    "%(path)s: %(e)s") % dict(path=self.checkpoint_file,
+                                              e=e)
+            logger.warn(msg)
+            return None
+        return deleted_at, image_id
+
+    def _write_checkpoint(self, position):
+        if not self.checkpoint_file:
+            return
+        deleted_at, image_id = position
+        # Written aside and renamed, so a crash cannot leave half a file
+        tmp_path = self.checkpoint_file + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump([deleted_at.strftime(cursor.DATETIME_FORMAT),
+                       image_id], checkpoint)
+        os.rename(tmp_path, self.checkpoint_file)
+
+    def _clear_checkpoint(self):
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.unlink(self.checkpoint_file)
 
 
 def app_factory(global_config, **local_conf):
@@ -19,12 +19,17 @@
 
 from __future__ import absolute_import
 
+import hashlib
 import httplib
 import logging
+import urllib
 import urlparse
 
+import eventlet
+
 from glance.common import config
 from glance.common import exception
+from glance import utils
 import glance.store
 import glance.store.base
 import glance.store.location
@@ -35,6 +40,9 @@ except ImportError:
     pass
 
 DEFAULT_SWIFT_CONTAINER = 'glance'
+DEFAULT_READ_CHUNK_SIZE = 16  # MB
+DEFAULT_SEGMENT_SIZE = 200  # MB
+DEFAULT_SEGMENT_CONCURRENCY = 1
 
 logger = logging.getLogger('glance.store.swift')
 
@@ -171,6 +179,128 @@ class StoreLocation(glance.store.location.StoreLocation):
         return full_url
 
 
+def get_object_range(url, token, container, obj, offset, length=None,
+                     resp_chunk_size=None, http_conn=None):
+    """
+    Returns `length` bytes of a Swift object starting at `offset`, or
+    everything from `offset` on if `length` is None.
+
+    swift.common.client.get_object() cannot send a Range header, so the
+    request is made here, on a connection of its own so that several
+    ranges can be read at once. `http_conn` is accepted so that this can be
+    called through swift.common.client.Connection, but is not used.
+
+    :param resp_chunk_size: if given, the range is returned as an iterator
+                            reading chunks of this size from the response
+                            rather than as a string
+    :raises `swift.common.client.ClientException` if the GET failed
+    """
+    parsed, conn = swift_client.http_connection(url)
+    path = '%s/%s/%s' % (parsed.path, swift_client.quote(container),
+                         swift_client.quote(obj))
+    conn.request('GET', path, '',
+                 {'X-Auth-Token': token,
+                  'Range': utils.make_range_header(offset, length)})
+    resp = conn.getresponse()
+    if resp.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+        # The range starts past the end of the object
+        resp.read()
+        conn.close()
+        return iter([]) if resp_chunk_size else ''
+    if resp.status < 200 or resp.status >= 300:
+        resp.read()
+        conn.close()
+        raise swift_client.ClientException(
+            'Object GET failed', http_scheme=parsed.scheme,
+            http_host=conn.host, http_port=conn.port, http_path=path,
+            http_status=resp.status, http_reason=resp.reason)
+
+    if resp_chunk_size:
+        def _body():
+            try:
+                chunk = resp.read(resp_chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = resp.read(resp_chunk_size)
+            finally:
+                conn.close()
+
+        body = _body()
+        if resp.status == httplib.OK:
+            # The Range header was ignored and the whole object returned
+            body = utils.chunkslice(body, offset, length)
+        return body
+
+    body = resp.read()
+    conn.close()
+    if resp.status == httplib.OK:
+        # The Range header was ignored and the whole object returned
+        end = None if length is None else offset + length
+        body = body[offset:end]
+    return body
+
+
+def put_manifest(url, token, container, obj, manifest):
+    """
+    Writes a large object manifest, which Swift serves as the concatenation
+    of the objects whose names start with `manifest` (``container/prefix``).
+
+    Older versions of swift.common.client cannot send the
+    X-Object-Manifest header, so the request is made here.
+
+    :raises `swift.common.client.ClientException` if the PUT failed
+    """
+    parsed, conn = swift_client.http_connection(url)
+    path = '%s/%s/%s' % (parsed.path, swift_client.quote(container),
+                         swift_client.quote(obj))
+    conn.request('PUT', path, '',
+                 {'X-Auth-Token': token,
+                  'X-Object-Manifest': swift_client.quote(manifest),
+                  'Content-Length': '0'})
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    if resp.status < 200 or resp.status >= 300:
+        raise swift_client.ClientException(
+            'Object PUT failed', http_scheme=parsed.scheme,
+            http_host=conn.host, http_port=conn.port, http_path=path,
+            http_status=resp.status, http_reason=resp.reason)
+
+
+class SegmentReader(object):
+    """
+    A file-like object which reads at most `length` bytes of `image_file`,
+    starting with the already read `head`, and computes the MD5 checksum of
+    the segment and of the whole image (`image_checksum`) as it goes.
+    """
+
+    def __init__(self, image_file, length, head, image_checksum):
+        self.image_file = image_file
+        self.head = head
+        self.remaining = length - len(head)
+        self.image_checksum = image_checksum
+        self.checksum = hashlib.md5()
+        self.bytes_read = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        if self.head:
+            chunk, self.head = self.head, ''
+        else:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            if not size:
+                return ''
+            chunk = self.image_file.read(size)
+            if not chunk:
+                self.eof = True
+            self.remaining -= len(chunk)
+        self.checksum.update(chunk)
+        self.image_checksum.update(chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
 class Store(glance.store.base.Store):
     """An implementation of the swift backend adapter."""
 
@@ -185,6 +315,14 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
+        # Reads don't depend on the options below, so these are read first
+        self.read_concurrency = max(1, config.get_option(
+            self.options, 'swift_store_read_concurrency', type='int',
+            default=1))
+        self.read_chunk_size = max(1, config.get_option(
+            self.options, 'swift_store_read_chunk_size', type='int',
+            default=DEFAULT_READ_CHUNK_SIZE)) * 1024 * 1024
+
         self.auth_address = self._option_get('swift_store_auth_address')
         self.user = self._option_get('swift_store_user')
         self.key = self._option_get('swift_store_key')
@@ -203,7 +341,17 @@ class Store(glance.store.base.Store):
         self.snet = config.get_option(
             self.options, 'swift_enable_snet', type='bool', default=False)
 
-    def get(self, location):
+        self.segmented_upload = config.get_option(
+            self.options, 'swift_store_segmented_upload', type='bool',
+            default=False)
+        self.segment_size = max(1, config.get_option(
+            self.options, 'swift_store_segment_size', type='int',
+            default=DEFAULT_SEGMENT_SIZE)) * 1024 * 1024
+        self.segment_concurrency = max(1, config.get_option(
+            self.options, 'swift_store_segment_concurrency', type='int',
+            default=DEFAULT_SEGMENT_CONCURRENCY))
+
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -211,6 +359,8 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: byte offset within the image to start reading from
+        :param length: number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
@@ -218,6 +368,28 @@ class Store(glance.store.base.Store):
             auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
 
         try:
+            if self.read_concurrency > 1:
+                resp_headers = swift_conn.head_object(
+                    container=loc.container, obj=loc.obj)
+                obj_size = int(resp_headers['content-length'])
+                nbytes = obj_size - offset if length is None else length
+                if nbytes > self.read_chunk_size:
+                    def fetch_range(start, size):
+                        return get_object_range(
+                            swift_conn.url, swift_conn.token,
+                            loc.container, loc.obj, start, size)
+
+                    return glance.store.base.parallel_range_reader(
+                        fetch_range, offset, nbytes, self.read_chunk_size,
+                        self.read_concurrency)
+
+            if offset or length is not None:
+                # Only the requested bytes are fetched from Swift. The
+                # Connection authenticates and retries the request for us
+                return swift_conn._retry(
+                    get_object_range, loc.container, loc.obj, offset, length,
+                    resp_chunk_size=self.CHUNKSIZE)
+
             (resp_headers, resp_body) = swift_conn.get_object(
                 container=loc.container, obj=loc.obj,
                 resp_chunk_size=self.CHUNKSIZE)
@@ -301,14 +473,18 @@ class Store(glance.store.base.Store):
         logger.debug(_("Adding image object '%(obj_name)s' "
                        "to Swift") % locals())
         try:
-            obj_etag = swift_conn.put_object(self.container, obj_name,
-                                             image_file)
-
             # NOTE: We return the user and key here! Have to because
             # location is used by the API server to return the actual
             # image data. We *really* should consider NOT returning
             # the location attribute from GET /images/<ID> and
             # GET /images/details
+            if self.segmented_upload:
+                size, obj_etag = self._add_segmented(swift_conn, obj_name,
+                                                     image_file)
+                return (location.get_uri(), size, obj_etag)
+
+            obj_etag = swift_conn.put_object(self.container, obj_name,
+                                             image_file)
 
             # We do a HEAD on the newly-added image to determine the size
             # of the image. A bit slow, but better than taking the word
@@ -328,6 +504,104 @@ class Store(glance.store.base.Store):
             logger.error(msg)
             raise glance.store.BackendException(msg)
 
+    def _add_segmented(self, swift_conn, obj_name, image_file):
+        """
+        Writes `image_file` to Swift as a large object: a series of
+        `swift_store_segment_size` MB segment objects named
+        ``<obj_name>/<segment number>``, followed by a manifest object
+        `obj_name` which Swift serves as the concatenation of the segments.
+
+        Each segment is streamed from `image_file` to Swift as it is read.
+        With a `swift_store_segment_concurrency` above 1, segments are read
+        into memory instead, so that several can be uploaded while the next
+        one is read.
+
+        The size and checksum are computed while the image is read, so no
+        HEAD request is needed afterwards, and the ETag Swift returns for
+        each segment is checked against the MD5 of the data sent. The
+        segments already written are deleted if any segment fails.
+
+        :retval tuple of the size and the hex MD5 checksum of the image
+        """
+        checksum = hashlib.md5()
+        prefix = '%s/' % obj_name
+        streaming = self.segment_concurrency == 1
+        pool = eventlet.GreenPool(self.segment_concurrency)
+        segments = []
+        errors = []
+        size = 0
+
+        def upload_segment(segment_name, contents, segment_checksum):
+            # Each upload needs an HTTP connection of its own, but can reuse
+            # the token of the connection that is already authenticated. A
+            # streamed segment cannot be read again, so is never retried
+            conn = swift_client.Connection(
+                authurl=self.full_auth_address, user=self.user, key=self.key,
+                preauthurl=swift_conn.url, preauthtoken=swift_conn.token,
+                snet=self.snet, retries=0 if streaming else 5)
+            try:
+                etag = conn.put_object(self.container, segment_name,
+                                       contents)
+                if etag != segment_checksum.hexdigest():
+                    raise glance.store.BackendException(
+                        _("Swift stored segment %(segment_name)s with "
+                          "checksum %(etag)s rather than %(expected)s")
+                        % dict(segment_name=segment_name, etag=etag,
+                               expected=segment_checksum.hexdigest()))
+            except Exception, e:
+                logger.error(_("Failed to upload segment %(segment_name)s "
+                               "to Swift: %(e)s")
+                             % dict(segment_name=segment_name, e=e))
+                errors.append(e)
+
+        try:
+            while not errors:
+                # Reading ahead means no empty segment is written when the
+                # image is a whole number of segments long
+                head = image_file.read(min(self.CHUNKSIZE, self.segment_size))
+                if not head and segments:
+                    break
+                segment_name = '%s%05d' % (prefix, len(segments) + 1)
+                segments.append(segment_name)
+                reader = SegmentReader(image_file, self.segment_size, head,
+                                       checksum)
+                if streaming:
+                    upload_segment(segment_name, reader, reader.checksum)
+                else:
+                    data = ''.join(iter(lambda: reader.read(self.CHUNKSIZE),
+                                        ''))
+                    # Blocks while all of the pool's workers are busy
+                    pool.spawn_n(upload_segment, segment_name, data,
+                                 reader.checksum)
+                size += reader.bytes_read
+                if reader.eof:
+                    break
+            pool.waitall()
+            if errors:
+                raise errors[0]
+            manifest = '%s/%s' % (self.container, prefix)
+            put_manifest(swift_conn.url, swift_conn.token, self.container,
+                         obj_name, manifest)
+        except Exception:
+            pool.waitall()
+            logger.error(_("Deleting the segments of the partially uploaded "
+                           "Swift object %(obj_name)s") % locals())
+            self._delete_segments(swift_conn, segments)
+            raise
+
+        logger.debug(_("Wrote %(count)d segments of Swift object "
+                       "%(obj_name)s") % dict(count=len(segments),
+                                              obj_name=obj_name))
+        return size, checksum.hexdigest()
+
+    def _delete_segments(self, swift_conn, segments):
+        """Deletes whichever of the named segments exist"""
+        for segment_name in segments:
+            try:
+                swift_conn.delete_object(self.container, segment_name)
+            except swift_client.ClientException:
+                pass
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -341,8 +615,54 @@ class Store(glance.store.base.Store):
         loc = location.store_location
         swift_conn = self._make_swift_connection(
             auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
+        self._delete_object(swift_conn, location)
 
+    def delete_many(self, locations):
+        """
+        Deletes the objects at a list of locations, authenticating and
+        connecting to Swift once for each account rather than once for
+        each object.
+
+        :retval a list holding, for each location in turn, None if its
+                object was deleted, or else the exception that prevented it
+        """
+        results = []
+        connections = {}
+        for location in locations:
+            loc = location.store_location
+            account = (loc.swift_auth_url, loc.user, loc.key)
+            if account not in connections:
+                connections[account] = self._make_swift_connection(
+                    auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
+            try:
+                self._delete_object(connections[account], location)
+            except Exception, e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
+    def _delete_object(self, swift_conn, location):
+        """
+        Deletes the object at a location and, if it is a large object
+        manifest, the segments it names
+
+        :raises NotFound if the object does not exist
+        """
+        loc = location.store_location
         try:
+            # Whether the object was written in segments is told by the
+            # object itself, whatever swift_store_segmented_upload is now
+            headers = swift_conn.head_object(loc.container, loc.obj)
+            manifest = headers.get('x-object-manifest')
+            if manifest:
+                # Large objects are deleted segments first, so that a failed
+                # delete can be retried through the manifest
+                container, prefix = urllib.unquote(manifest).split('/', 1)
+                unused, segments = swift_conn.get_container(
+                    container, prefix=prefix, full_listing=True)
+                for segment in segments:
+                    swift_conn.delete_object(container, segment['name'])
             swift_conn.delete_object(loc.container, loc.obj)
         except swift_client.ClientException, e:
             if e.http_status == httplib.NOT_FOUND:
@@ -142,6 +142,7 @@ class ApiServer(Server):
         self.s3_store_secret_key = ""
         self.s3_store_bucket = ""
         self.delayed_delete = delayed_delete
+        self.workers = 0
         self.conf_base = """[DEFAULT]
 verbose = %(verbose)s
 debug = %(debug)s
@@ -149,6 +150,7 @@ filesystem_store_datadir=%(image_dir)s
 default_store = %(default_store)s
 bind_host = 0.0.0.0
 bind_port = %(bind_port)s
+workers = %(workers)s
 registry_host = 0.0.0.0
 registry_port = %(registry_port)s
 log_file = %(log_file)s
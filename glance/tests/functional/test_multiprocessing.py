@@ -0,0 +1,102 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests running the API server with several worker processes"""
+
+import httplib2
+import os
+import signal
+import time
+
+from glance.tests import functional
+from glance.tests.utils import execute
+
+
+def get_children(pid):
+    """Returns the set of ids of the child processes of `pid`"""
+    children = set()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % entry).read()
+        except IOError:
+            continue
+        # The parent pid is the second field after the parenthesised name
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.add(int(entry))
+    return children
+
+
+class TestMultiprocessing(functional.FunctionalTest):
+
+    def _get_images(self):
+        path = "http://%s:%d/v1/images" % ("0.0.0.0", self.api_port)
+        http = httplib2.Http()
+        response, content = http.request(path, 'GET')
+        return response.status
+
+    def _wait_for(self, predicate, timeout=10):
+        for _junk in xrange(timeout * 10):
+            if predicate():
+                return True
+            time.sleep(0.1)
+        return False
+
+    def test_workers_are_restarted(self):
+        """Test that the parent replaces a worker that dies"""
+        self.cleanup()
+        self.api_server.workers = 2
+        self.start_servers()
+
+        api_pid = int(open(self.api_server.pid_file).read().strip())
+        self.assertTrue(self._wait_for(
+            lambda: len(get_children(api_pid)) == 2))
+        self.assertEqual(self._get_images(), 200)
+
+        workers = get_children(api_pid)
+        dead_worker = workers.pop()
+        os.kill(dead_worker, signal.SIGKILL)
+
+        def replaced():
+            children = get_children(api_pid)
+            return len(children) == 2 and dead_worker not in children
+
+        self.assertTrue(self._wait_for(replaced))
+        self.assertEqual(self._get_images(), 200)
+
+        self.stop_servers()
+
+    def test_graceful_shutdown(self):
+        """Test that a shutdown drains the workers and exits"""
+        self.cleanup()
+        self.api_server.workers = 2
+        self.start_servers()
+
+        api_pid = int(open(self.api_server.pid_file).read().strip())
+        self.assertEqual(self._get_images(), 200)
+
+        cmd = ("./bin/glance-control api shutdown %s --pid-file=%s"
+               % (self.api_server.conf_file_name, self.api_server.pid_file))
+        exitcode, out, err = execute(cmd)
+        self.assertEqual(0, exitcode)
+
+        self.assertTrue(self._wait_for(
+            lambda: not os.path.exists('/proc/%d' % api_pid)))
+        self.assertFalse(self.ping_server(self.api_port))
+
+        self.stop_servers()
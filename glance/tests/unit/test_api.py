@@ -15,18 +15,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
 import datetime
 import hashlib
 import httplib
 import os
 import json
 import unittest
+import urllib
 
+import sqlalchemy
 import stubout
 import webob
 
+from glance import registry
 from glance.api import v1 as server
 from glance.common import context
+from glance.common import exception
 from glance.registry import context as rcontext
 from glance.registry import server as rserver
 from glance.registry.db import api as db_api
@@ -116,6 +121,195 @@ class TestRegistryAPI(unittest.TestCase):
         for k, v in fixture.iteritems():
             self.assertEquals(v, image[k])
 
+    def test_bulk_get(self):
+        """
+        Tests that the /images/bulk-get registry API endpoint returns the
+        images asked for in order, leaving out unknown ones
+        """
+        req = webob.Request.blank('/images/bulk-get')
+        req.method = 'POST'
+        req.content_type = 'application/json'
+        req.body = json.dumps(dict(ids=[2, 99, 1]))
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        images = json.loads(res.body)['images']
+        self.assertEquals([2, 1], [image['id'] for image in images])
+        self.assertEquals({'type': 'kernel'}, images[1]['properties'])
+
+    def test_bulk_get_bad_body(self):
+        """
+        Tests that the /images/bulk-get registry API endpoint returns a 400
+        unless given a list of ids
+        """
+        for body in ('{"ids": 2}', '[2]', ''):
+            req = webob.Request.blank('/images/bulk-get')
+            req.method = 'POST'
+            req.content_type = 'application/json'
+            req.body = body
+            res = req.get_response(self.api)
+            self.assertEquals(res.status_int, 400)
+
+    def test_bulk_get_hides_private_images(self):
+        """
+        Tests that images a context may not see are left out of a bulk get
+        """
+        db_api.image_create(self.context, dict(self.FIXTURES[0], id=3,
+                                               owner='tenant2'))
+        ctx = rcontext.RequestContext(is_admin=False, tenant='tenant1')
+        images = db_api.image_get_many(ctx, ['3', '2', '1'])
+        self.assertEquals([2, 1], [image.id for image in images])
+
+    def capture_queries(self, func, *args, **kwargs):
+        """
+        Returns the SQL statements executed by func(*args, **kwargs), as
+        (statement, parameters) pairs
+        """
+        statements = []
+        connection_class = sqlalchemy.engine.base.Connection
+        cursor_execute = connection_class._cursor_execute
+
+        def capturing_cursor_execute(conn, cursor, statement, parameters,
+                                     *args, **kw):
+            statements.append((statement, parameters))
+            return cursor_execute(conn, cursor, statement, parameters,
+                                  *args, **kw)
+
+        query_stubs = stubout.StubOutForTesting()
+        query_stubs.Set(connection_class, '_cursor_execute',
+                        capturing_cursor_execute)
+        try:
+            func(*args, **kwargs)
+        finally:
+            query_stubs.UnsetAll()
+        return statements
+
+    def count_queries(self, func, *args):
+        """Returns the number of SQL statements executed by func(*args)"""
+        return len(self.capture_queries(func, *args))
+
+    def assertUsesIndex(self, index_name, func, *args, **kwargs):
+        """
+        Asserts that SQLite plans one of the statements executed by
+        func(*args, **kwargs) with the named index
+        """
+        connection = db_api._ENGINE.raw_connection()
+        plans = []
+        for statement, parameters in self.capture_queries(func, *args,
+                                                          **kwargs):
+            plans.extend(row[-1] for row in connection.execute(
+                    "EXPLAIN QUERY PLAN " + statement, parameters))
+        connection.close()
+        self.assertTrue([plan for plan in plans if index_name in plan],
+                        "%s not used in plans: %s" % (index_name, plans))
+
+    def test_listings_use_indexes(self):
+        """
+        Tests that the registry's listings are answered from the indexes
+        created for them
+        """
+        if db_api._ENGINE.name != 'sqlite':
+            return
+        self.create_shared_images(5)
+        db_api.image_update(self.context, 3, {'properties': {'distro':
+                                                             'Ubuntu'}})
+        ctx = rcontext.RequestContext(is_admin=False, tenant='tenant1')
+
+        self.assertUsesIndex('ix_images_deleted_created_at',
+                             db_api.image_get_all, ctx,
+                             filters={'is_public': True}, limit=2)
+        for sort_key in ('created_at', 'updated_at', 'name', 'size',
+                         'status'):
+            self.assertUsesIndex('ix_images_deleted_%s' % sort_key,
+                                 db_api.image_get_all, self.context,
+                                 sort_key=sort_key, sort_dir='asc', limit=2)
+        property_index = 'ix_image_properties_name_value_deleted_image_id'
+        self.assertUsesIndex(property_index, db_api.image_get_all,
+                             self.context,
+                             filters={'properties': {'distro': 'Ubuntu'}})
+        self.assertUsesIndex('ix_image_members_member_deleted',
+                             db_api.image_member_get_memberships,
+                             self.context, 'tenant1')
+        self.assertUsesIndex('ix_images_deleted_status',
+                             db_api.image_get_all_pending_delete,
+                             self.context)
+
+    def create_shared_images(self, count):
+        """Creates private images of tenant2 shared with tenant1"""
+        image_ids = range(3, count + 3)
+        for image_id in image_ids:
+            db_api.image_create(self.context, dict(self.FIXTURES[0],
+                                                   id=image_id,
+                                                   owner='tenant2'))
+            db_api.image_member_create(self.context,
+                                       dict(image_id=image_id,
+                                            member='tenant1'))
+        return image_ids
+
+    def test_shared_image_visibility_checked_in_one_query(self):
+        """
+        Tests that fetching a shared image and checking whether it may be
+        shared on takes a single query
+        """
+        self.create_shared_images(1)
+        ctx = rcontext.RequestContext(is_admin=False, tenant='tenant1')
+
+        def get_image():
+            image = db_api.image_get(ctx, 3)
+            self.assertFalse(ctx.is_image_sharable(image))
+
+        self.assertEquals(1, self.count_queries(get_image))
+
+    def test_listings_read_properties_in_one_query(self):
+        """
+        Tests that a listing reads the properties of all its images in a
+        single query, and that a listing of columns reads nothing else
+        """
+        image_ids = self.create_shared_images(10)
+        for image_id in image_ids:
+            db_api.image_update(self.context, image_id,
+                                {'properties': {'a': '1', 'b': '2'}})
+
+        self.assertEquals(2, self.count_queries(db_api.image_get_all,
+                                                self.context))
+        images = dict((image.id, image)
+                      for image in db_api.image_get_all(self.context))
+        self.assertEquals(12, len(images))
+        self.assertEquals(['a', 'b'], sorted(p['name'] for p in
+                                             images[3]['properties']))
+
+        columns = ['id', 'name', 'created_at']
+        self.assertEquals(1, self.count_queries(db_api.image_get_all,
+                                                self.context, None, None,
+                                                None, 'created_at', 'desc',
+                                                None, columns))
+        images = db_api.image_get_all(self.context, columns=columns)
+        self.assertEquals(12, len(images))
+        self.assertEquals(dict, type(images[0]))
+        self.assertEquals(set(columns), set(images[0].keys()))
+
+    def test_shared_images_bulk_get_in_one_query(self):
+        """
+        Tests that a bulk get of shared images takes a single query
+        """
+        image_ids = self.create_shared_images(10)
+        ctx = rcontext.RequestContext(is_admin=False, tenant='tenant1')
+
+        self.assertEquals(1, self.count_queries(db_api.image_get_many, ctx,
+                                                image_ids))
+        self.assertEquals(10, len(db_api.image_get_many(ctx, image_ids)))
+
+    def test_image_get_not_visible(self):
+        """
+        Tests that image_get tells images that exist but are not visible
+        apart from images that don't exist
+        """
+        self.create_shared_images(1)
+        ctx = rcontext.RequestContext(is_admin=False, tenant='tenant3')
+
+        self.assertRaises(exception.NotAuthorized, db_api.image_get, ctx, 3)
+        self.assertRaises(exception.NotFound, db_api.image_get, ctx, 99)
+        self.assertEquals(2, db_api.image_get(ctx, 2).id)
+
     def test_show_unknown(self):
         """
         Tests that the /images/<id> registry API endpoint
@@ -240,6 +434,160 @@ class TestRegistryAPI(unittest.TestCase):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, 400)
 
+    def get_pages(self, path, limit, **params):
+        """
+        Follows the cursors of a paged registry listing, returning the ids
+        on each page
+        """
+        pages = []
+        cursor = None
+        while True:
+            query = dict(params, limit=limit)
+            if cursor is not None:
+                query['cursor'] = cursor
+            req = webob.Request.blank('%s?%s' % (path,
+                                                 urllib.urlencode(query)))
+            res = req.get_response(self.api)
+            self.assertEquals(res.status_int, 200)
+            res_dict = json.loads(res.body)
+            pages.append([image['id'] for image in res_dict['images']])
+            cursor = res_dict.get('next_cursor')
+            if cursor is None:
+                return pages
+
+    def test_get_index_cursor(self):
+        """
+        Tests that the /images registry API pages through public images
+        by following the cursor returned with each full page, even when
+        the last image of a page has been deleted since
+        """
+        time1 = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        for image_id in (3, 4, 5):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'new name! #123',
+                             'size': 20,
+                             'checksum': None,
+                             'created_at': time1}
+            db_api.image_create(self.context, extra_fixture)
+
+        self.assertEquals(self.get_pages('/images', 2),
+                          [[5, 4], [3, 2], []])
+
+        req = webob.Request.blank('/images?limit=2')
+        res_dict = json.loads(req.get_response(self.api).body)
+        db_api.image_destroy(self.context, 4)
+        req = webob.Request.blank('/images?limit=2&cursor=%s'
+                                  % res_dict['next_cursor'])
+        res_dict = json.loads(req.get_response(self.api).body)
+        self.assertEquals([3, 2], [i['id'] for i in res_dict['images']])
+
+    def test_get_details_cursor_null_sort_values(self):
+        """
+        Tests that the /images/detail registry API pages through images
+        whose sort key is null exactly once, whichever the sort direction
+        """
+        for image_id, name in ((3, None), (4, 'a'), (5, None), (6, 'b')):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': name,
+                             'size': 20,
+                             'checksum': None}
+            db_api.image_create(self.context, extra_fixture)
+
+        self.assertEquals(self.get_pages('/images/detail', 2,
+                                         sort_key='name', sort_dir='asc'),
+                          [[3, 5], [4, 6], [2]])
+        self.assertEquals(self.get_pages('/images/detail', 1,
+                                         sort_key='name', sort_dir='desc'),
+                          [[2], [6], [4], [5], [3], []])
+
+    def test_get_details_streamed(self):
+        """
+        Tests that the /images/detail registry API streams listings of
+        more than listing_batch_size images, reading them from the
+        database a batch at a time
+        """
+        for image_id in range(3, 9):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'new name! #%d' % image_id,
+                             'size': 20,
+                             'checksum': None,
+                             'properties': {'n': str(image_id)}}
+            db_api.image_create(self.context, extra_fixture)
+
+        options = dict(OPTIONS, listing_batch_size=2)
+        self.api = context.ContextMiddleware(rserver.API(options), options)
+        limits = []
+        image_get_all = db_api.image_get_all
+
+        def recording_image_get_all(context, **kwargs):
+            limits.append(kwargs['limit'])
+            return image_get_all(context, **kwargs)
+
+        self.stubs.Set(db_api, 'image_get_all', recording_image_get_all)
+
+        self.assertEquals(self.get_pages('/images/detail', 4),
+                          [[8, 7, 6, 5], [4, 3, 2]])
+        self.assertEquals(limits, [2, 2, 2, 2])
+
+        req = webob.Request.blank('/images/detail?limit=3&marker=6')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals(res.content_length, None)
+        res_dict = json.loads(res.body)
+        self.assertEquals([5, 4, 3], [i['id'] for i in res_dict['images']])
+        self.assertEquals({'n': '5'}, res_dict['images'][0]['properties'])
+        self.assertTrue('next_cursor' in res_dict)
+
+        req = webob.Request.blank('/images/detail?limit=3&marker=99')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 400)
+
+    def test_get_index_invalid_cursor(self):
+        """
+        Tests that the /images registry API returns a 400 for a cursor
+        that was tampered with, that was made for a listing sorted another
+        way, or that comes with a marker
+        """
+        req = webob.Request.blank('/images?limit=1')
+        cursor = json.loads(req.get_response(self.api).body)['next_cursor']
+        data, signature = cursor.split('.')
+
+        tampered = '%s.%s' % (base64.urlsafe_b64encode(
+                json.dumps(['created_at', 'desc', None, 99])), signature)
+        for query in ('cursor=%s' % tampered,
+                      'cursor=garbage',
+                      'cursor=%s&sort_dir=asc' % cursor,
+                      'cursor=%s&marker=2' % cursor):
+            req = webob.Request.blank('/images?%s' % query)
+            res = req.get_response(self.api)
+            self.assertEquals(res.status_int, 400)
+
+    def test_cursor_secret_kept_in_database(self):
+        """
+        Tests that registry servers without a cursor_secret sign cursors
+        with a random key they share through their database
+        """
+        secret = rserver.Controller(OPTIONS).cursor_secret
+        self.assertEquals(secret, rserver.Controller(OPTIONS).cursor_secret)
+        self.assertNotEquals(
+            secret, hashlib.sha256(OPTIONS['sql_connection']).hexdigest())
+
+        options = dict(OPTIONS, cursor_secret='configured')
+        self.assertEquals('configured',
+                          rserver.Controller(options).cursor_secret)
+
     def test_get_index_limit(self):
         """
         Tests that the /images registry API returns list of
@@ -1162,6 +1510,38 @@ class TestRegistryAPI(unittest.TestCase):
         for image in images:
             self.assertEqual('v a', image['properties']['prop_123'])
 
+    def test_get_details_filter_properties(self):
+        """
+        Tests that the /images/detail registry API returns only the images
+        that have all of several custom properties, and ignores properties
+        that have been deleted
+        """
+        fixtures = {3: {'type': 'machine', 'distro': 'Ubuntu'},
+                    4: {'type': 'machine', 'distro': 'Fedora'},
+                    5: {'type': 'kernel', 'distro': 'Ubuntu'},
+                    6: {'type': 'machine', 'distro': 'Ubuntu'}}
+        for image_id, properties in fixtures.items():
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'fake image #%d' % image_id,
+                             'size': 19,
+                             'checksum': None,
+                             'properties': properties}
+            db_api.image_create(self.context, extra_fixture)
+        db_api.image_update(self.context, 6, {'properties': {'distro':
+                                                             'Ubuntu'}},
+                            purge_props=True)
+
+        req = webob.Request.blank('/images/detail?property-type=machine&'
+                                  'property-distro=Ubuntu')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        res_dict = json.loads(res.body)
+        self.assertEquals([3], [i['id'] for i in res_dict['images']])
+
     def test_get_details_filter_public_none(self):
         """
         Tests that the /images/detail registry API returns list of
@@ -1768,6 +2148,70 @@ class TestGlanceAPI(unittest.TestCase):
                         "res.headerlist = %r" % res.headerlist)
         self.assertTrue('/images/3' in res.headers['location'])
 
+    def _add_image_with_checksums(self, headers=None):
+        """
+        Adds an image through an API computing MD5 and SHA-256 digests
+        of uploaded images
+        """
+        options = dict(OPTIONS, checksum_algorithms='md5, sha256')
+        api = context.ContextMiddleware(server.API(options), options)
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        req.headers.update({'x-image-meta-store': 'file',
+                            'x-image-meta-disk-format': 'vhd',
+                            'x-image-meta-container-format': 'ovf',
+                            'x-image-meta-name': 'fake image #3'})
+        req.headers.update(headers or {})
+        req.headers['Content-Type'] = 'application/octet-stream'
+        req.body = "chunk00000remainder"
+        return req.get_response(api)
+
+    def test_add_image_checksums(self):
+        """
+        Tests that the configured digests of an uploaded image are stored
+        as properties and returned as headers
+        """
+        res = self._add_image_with_checksums()
+        self.assertEquals(res.status_int, httplib.CREATED)
+
+        md5 = hashlib.md5("chunk00000remainder").hexdigest()
+        sha256 = hashlib.sha256("chunk00000remainder").hexdigest()
+        self.assertEquals(md5, res.headers['etag'])
+        self.assertEquals(sha256, res.headers[
+            'x-image-meta-property-checksum_sha256'])
+
+        res_body = json.loads(res.body)['image']
+        self.assertEquals(md5, res_body['checksum'])
+        self.assertEquals({'checksum_sha256': sha256},
+                          res_body['properties'])
+
+        req = webob.Request.blank("/images/3")
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals(sha256, res.headers[
+            'x-image-meta-property-checksum_sha256'])
+
+    def test_add_image_bad_supplied_checksum(self):
+        """
+        Tests that an image whose supplied SHA-256 digest does not match
+        the uploaded data is killed
+        """
+        res = self._add_image_with_checksums(
+            {'x-image-meta-property-checksum_sha256': 'bogus'})
+        self.assertEquals(res.status_int, httplib.BAD_REQUEST)
+        self.assertTrue('checksum_sha256' in res.body)
+
+        req = webob.Request.blank("/images/3")
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals('killed', res.headers['x-image-meta-status'])
+
+    def test_invalid_checksum_algorithm(self):
+        """Tests that an unknown checksum algorithm is refused"""
+        options = dict(OPTIONS, checksum_algorithms='sha256, bogus')
+        self.assertRaises(exception.InvalidChecksumAlgorithm,
+                          server.API, options)
+
     def test_get_index_sort_name_asc(self):
         """
         Tests that the /images registry API returns list of
@@ -1910,6 +2354,39 @@ class TestGlanceAPI(unittest.TestCase):
         for key, value in expected_headers.iteritems():
             self.assertEquals(value, res.headers[key])
 
+    def test_image_meta_cached(self):
+        """Test HEAD /images/<ID> served from the metadata cache"""
+        options = dict(OPTIONS, image_meta_cache_size='10')
+        api = context.ContextMiddleware(server.API(options), options)
+        calls = []
+        get_image_metadata = registry.get_image_metadata
+
+        def counting_get_image_metadata(*args):
+            calls.append(args)
+            return get_image_metadata(*args)
+
+        self.stubs.Set(registry, 'get_image_metadata',
+                       counting_get_image_metadata)
+
+        def head():
+            req = webob.Request.blank("/images/2")
+            req.method = 'HEAD'
+            res = req.get_response(api)
+            self.assertEquals(res.status_int, 200)
+            return res.headers['x-image-meta-name']
+
+        self.assertEquals(head(), 'fake image #2')
+        self.assertEquals(head(), 'fake image #2')
+        self.assertEquals(len(calls), 1)
+
+        req = webob.Request.blank("/images/2")
+        req.method = 'PUT'
+        req.headers['x-image-meta-name'] = 'renamed'
+        res = req.get_response(api)
+        self.assertEquals(res.status_int, 200)
+
+        self.assertEquals(head(), 'renamed')
+
     def test_show_image_basic(self):
         req = webob.Request.blank("/images/2")
         res = req.get_response(self.api)
@@ -1917,6 +2394,57 @@ class TestGlanceAPI(unittest.TestCase):
         self.assertEqual(res.content_type, 'application/octet-stream')
         self.assertEqual('chunk00000remainder', res.body)
 
+    def test_show_image_range(self):
+        req = webob.Request.blank("/images/2")
+        req.headers['Range'] = 'bytes=5-9'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 5-9/19')
+        self.assertEqual(res.content_length, 5)
+        self.assertEqual('00000', res.body)
+
+    def test_show_image_suffix_range(self):
+        req = webob.Request.blank("/images/2")
+        req.headers['Range'] = 'bytes=-9'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 10-18/19')
+        self.assertEqual('remainder', res.body)
+
+    def test_show_image_range_not_satisfiable(self):
+        req = webob.Request.blank("/images/2")
+        req.headers['Range'] = 'bytes=30-40'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 416)
+        self.assertEqual(res.headers['Content-Range'], 'bytes */19')
+
+    def test_show_image_if_range_mismatch(self):
+        db_api.image_update(self.context, 2, {'checksum': 'abc123'})
+        req = webob.Request.blank("/images/2")
+        req.headers['Range'] = 'bytes=5-9'
+        req.headers['If-Range'] = '"def456"'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual('chunk00000remainder', res.body)
+
+        req.headers['If-Range'] = '"abc123"'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual('00000', res.body)
+
+    def test_show_image_if_none_match(self):
+        db_api.image_update(self.context, 2, {'checksum': 'abc123'})
+        req = webob.Request.blank("/images/2")
+        req.headers['If-None-Match'] = '"abc123"'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 304)
+        self.assertEqual(res.headers['ETag'], 'abc123')
+
+        req.headers['If-None-Match'] = '"def456"'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual('chunk00000remainder', res.body)
+
     def test_show_non_exists_image(self):
         req = webob.Request.blank("/images/42")
         res = req.get_response(self.api)
@@ -1981,6 +2509,52 @@ class TestGlanceAPI(unittest.TestCase):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, 400)
 
+    def test_get_details_streamed(self):
+        """
+        Tests that the /images/detail API streams listings of more than
+        listing_batch_size images, fetching them from the registry a batch
+        at a time
+        """
+        for image_id in range(3, 9):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'new name! #%d' % image_id,
+                             'size': 20,
+                             'checksum': None}
+            db_api.image_create(self.context, extra_fixture)
+
+        options = dict(OPTIONS, listing_batch_size=2)
+        self.api = context.ContextMiddleware(server.API(options), options)
+        requests = []
+        get_images_page = registry.get_images_page
+
+        def recording_get_images_page(options, context, **kwargs):
+            requests.append((kwargs['limit'], kwargs.get('marker'),
+                             'cursor' in kwargs))
+            return get_images_page(options, context, **kwargs)
+
+        self.stubs.Set(registry, 'get_images_page',
+                       recording_get_images_page)
+
+        req = webob.Request.blank('/images/detail?limit=5&marker=8')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals(res.content_length, None)
+        res_dict = json.loads(res.body)
+        self.assertEquals([7, 6, 5, 4, 3],
+                          [i['id'] for i in res_dict['images']])
+        self.assertEquals(requests, [(2, '8', False), (2, None, True),
+                                     (1, None, True)])
+
+        req = webob.Request.blank('/images/detail?limit=5&cursor=%s'
+                                  % res_dict['next_cursor'])
+        res_dict = json.loads(req.get_response(self.api).body)
+        self.assertEquals([2], [i['id'] for i in res_dict['images']])
+        self.assertFalse('next_cursor' in res_dict)
+
     def test_get_image_members(self):
         """
         Tests members listing for existing images
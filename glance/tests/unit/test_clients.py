@@ -16,6 +16,7 @@
 #    under the License.
 
 import datetime
+import httplib
 import json
 import os
 import stubout
@@ -25,12 +26,14 @@ import unittest
 import webob
 
 from glance import client
+from glance.common import client as base_client
 from glance.common import context
 from glance.common import exception
 from glance.registry.db import api as db_api
 from glance.registry.db import models as db_models
 from glance.registry import client as rclient
 from glance.registry import context as rcontext
+from glance.registry import server as rserver
 from glance.tests import stubs
 
 OPTIONS = {'sql_connection': 'sqlite://'}
@@ -48,6 +51,169 @@ class TestBadClients(unittest.TestCase):
                           1)
 
 
+class FakeConnection(object):
+
+    """Records how a pooled connection is used"""
+
+    def __init__(self, host, port):
+        self.closed = False
+        self.requests = 0
+        self.fail_next = False
+        self.fail_response = False
+        self.status = httplib.OK
+
+    def request(self, method, url, body=None, headers=None):
+        if self.fail_next:
+            self.fail_next = False
+            raise httplib.BadStatusLine('')
+        self.requests += 1
+
+    def getresponse(self):
+        if self.fail_response:
+            self.fail_response = False
+            raise httplib.BadStatusLine('')
+        return FakeResponse(self.status)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResponse(object):
+
+    def __init__(self, status=httplib.OK):
+        self.status = status
+        self.finished = False
+
+    def read(self):
+        self.finished = True
+        return ''
+
+    def isclosed(self):
+        return self.finished
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    """Test the keep-alive connection pool shared by clients"""
+
+    def setUp(self):
+        self.pool = base_client.HTTPConnectionPool(FakeConnection,
+                                                   'localhost', 9191,
+                                                   max_size=2,
+                                                   idle_timeout=30)
+
+    def test_reuses_connection_after_response_is_read(self):
+        conn, reused = self.pool.get()
+        self.assertFalse(reused)
+        response = conn.getresponse()
+        self.pool.put(conn, response)
+
+        # The response hasn't been read yet, so the connection is busy
+        other, reused = self.pool.get()
+        self.assertFalse(other is conn)
+        self.assertFalse(reused)
+
+        response.read()
+        again, reused = self.pool.get()
+        self.assertTrue(again is conn)
+        self.assertTrue(reused)
+
+    def test_idle_connections_are_capped(self):
+        conns = [self.pool.get()[0] for i in xrange(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        self.assertTrue(conns[0].closed)
+        self.assertEqual([c for c, t in self.pool.idle], conns[1:])
+
+    def test_idle_connections_expire(self):
+        conn, reused = self.pool.get()
+        self.pool.put(conn)
+        self.pool.idle = [(conn, self.pool.idle[0][1] - 31)]
+
+        new_conn, reused = self.pool.get()
+        self.assertTrue(conn.closed)
+        self.assertFalse(new_conn is conn)
+
+    def test_clients_share_pool(self):
+        stubs = stubout.StubOutForTesting()
+        stubs.Set(base_client.BaseClient, 'get_connection_type',
+                  lambda self: FakeConnection)
+        try:
+            first = rclient.RegistryClient('pooltest', 9191)
+            second = rclient.RegistryClient('pooltest', 9191)
+            first.do_request('GET', '/images').read()
+            second.do_request('GET', '/images').read()
+
+            pool = second.get_connection_pool()
+            conn, reused = pool.get()
+            self.assertTrue(reused)
+            self.assertEqual(conn.requests, 2)
+
+            # A kept-alive connection the server has closed is replaced
+            conn.fail_next = True
+            pool.put(conn)
+            first.do_request('GET', '/images').read()
+            self.assertTrue(conn.closed)
+            new_conn, reused = pool.get()
+            self.assertTrue(reused)
+            self.assertEqual(new_conn.requests, 1)
+        finally:
+            stubs.UnsetAll()
+
+    def _pooled_client(self, host):
+        stubs = stubout.StubOutForTesting()
+        stubs.Set(base_client.BaseClient, 'get_connection_type',
+                  lambda self: FakeConnection)
+        self.addCleanup(stubs.UnsetAll)
+        rc = rclient.RegistryClient(host, 9191)
+        rc.do_request('GET', '/images').read()
+        pool = rc.get_connection_pool()
+        conn, reused = pool.get()
+        self.assertTrue(reused)
+        return rc, pool, conn
+
+    def test_post_is_not_resent_after_response_fails(self):
+        rc, pool, conn = self._pooled_client('posttest')
+
+        # The request may have reached the server, so it isn't sent again
+        conn.fail_response = True
+        pool.put(conn)
+        self.assertRaises(httplib.BadStatusLine, rc.do_request,
+                          'POST', '/images', body='{}')
+        self.assertTrue(conn.closed)
+        self.assertEqual(conn.requests, 2)
+        self.assertFalse(pool.idle)
+
+        # But a GET is
+        conn, reused = pool.get()
+        conn.fail_response = True
+        pool.put(conn)
+        rc.do_request('GET', '/images').read()
+        self.assertTrue(conn.closed)
+
+    def test_post_is_resent_if_never_sent(self):
+        rc, pool, conn = self._pooled_client('unsenttest')
+
+        conn.fail_next = True
+        pool.put(conn)
+        rc.do_request('POST', '/images', body='{}').read()
+        self.assertTrue(conn.closed)
+        new_conn, reused = pool.get()
+        self.assertTrue(reused)
+        self.assertEqual(new_conn.requests, 1)
+
+    def test_error_response_is_read_before_reuse(self):
+        rc, pool, conn = self._pooled_client('errortest')
+
+        conn.status = httplib.NOT_FOUND
+        pool.put(conn)
+        self.assertRaises(exception.NotFound, rc.do_request,
+                          'GET', '/images/1')
+        self.assertFalse(conn.closed)
+        self.assertEqual(pool.busy, [])
+        self.assertEqual([c for c, t in pool.idle], [conn])
+
+
 class TestRegistryClient(unittest.TestCase):
 
     """
@@ -118,6 +284,31 @@ class TestRegistryClient(unittest.TestCase):
         for k, v in fixture.items():
             self.assertEquals(v, images[0][k])
 
+    def test_iter_images(self):
+        """Test iterating over public images a page at a time"""
+        for image_id in (3, 4):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'new name! #%d' % image_id,
+                             'size': 19,
+                             'checksum': None}
+            db_api.image_create(self.context, extra_fixture)
+
+        page = self.client.get_images_page(limit=2)
+        self.assertEquals([4, 3], [image['id'] for image in page['images']])
+        self.assertTrue(page['next_cursor'])
+
+        images = self.client.iter_images(limit=1, sort_key='id',
+                                         sort_dir='asc')
+        self.assertEquals([2, 3, 4], [image['id'] for image in images])
+
+        images = self.client.iter_images_detailed(limit=2,
+                                                  filters={'size_max': 19})
+        self.assertEquals([4, 3, 2], [image['id'] for image in images])
+
     def test_get_index_sort_id_desc(self):
         """
         Tests that the /images registry API returns list of
@@ -804,6 +995,20 @@ class TestRegistryClient(unittest.TestCase):
                           self.client.get_image,
                           42)
 
+    def test_get_images_by_id(self):
+        """Tests that several images are returned in the order asked for"""
+        images = self.client.get_images_by_id([2, 42, 1, 'foo'])
+
+        self.assertEquals([2, 1], [image['id'] for image in images])
+        self.assertEquals('fake image #2', images[0]['name'])
+        self.assertEquals({'type': 'kernel'}, images[1]['properties'])
+
+    def test_get_images_by_id_too_many(self):
+        """Tests that a bulk get of too many images is refused"""
+        self.assertRaises(exception.Invalid,
+                          self.client.get_images_by_id,
+                          range(rserver.MAX_BULK_GET + 1))
+
     def test_add_image_basic(self):
         """Tests that we can add image metadata and returns the new id"""
         fixture = {'name': 'fake public image',
@@ -1048,6 +1253,14 @@ class TestClient(unittest.TestCase):
         for k, v in expected_meta.items():
             self.assertEquals(v, meta[k])
 
+    def test_get_images_by_id(self):
+        """Test several images' metadata are returned in one request"""
+        images = self.client.get_images_by_id([2, 42, 1])
+
+        self.assertEquals([2, 1], [image['id'] for image in images])
+        self.assertEquals("file:///tmp/glance-tests/2",
+                          images[0]['location'])
+
     def test_get_image_not_existing(self):
         """Test retrieval of a non-existing image returns a 404"""
         self.assertRaises(exception.NotFound,
@@ -1100,6 +1313,27 @@ class TestClient(unittest.TestCase):
         for k, v in fixture.items():
             self.assertEquals(v, images[0][k])
 
+    def test_iter_images(self):
+        """Test iterating over public images a page at a time"""
+        for image_id in (3, 4):
+            extra_fixture = {'id': image_id,
+                             'status': 'active',
+                             'is_public': True,
+                             'disk_format': 'vhd',
+                             'container_format': 'ovf',
+                             'name': 'new name! #%d' % image_id,
+                             'size': 19,
+                             'checksum': None}
+            db_api.image_create(self.context, extra_fixture)
+
+        images = self.client.iter_images(limit=1, sort_key='id',
+                                         sort_dir='asc')
+        self.assertEquals([2, 3, 4], [image['id'] for image in images])
+
+        images = list(self.client.iter_images_detailed(limit=2))
+        self.assertEquals([4, 3, 2], [image['id'] for image in images])
+        self.assertEquals(19, images[0]['size'])
+
     def test_get_image_index_marker(self):
         """Test correct set of public images returned with marker param."""
         extra_fixture = {'id': 3,
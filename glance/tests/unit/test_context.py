@@ -240,3 +240,46 @@ class TestContext(unittest.TestCase):
         """
         self.do_sharable(True, 'pattieblack', FakeMembership(True),
                          tenant='froggy')
+
+    def test_membership_looked_up_once(self):
+        """
+        Tests that a context looks up its owner's membership of an image
+        only once, however often it is asked about the image.
+        """
+        lookups = []
+
+        def fake_image_member_find(ctx, image_id, member):
+            lookups.append((image_id, member))
+            return FakeMembership(True)
+
+        stubs = stubout.StubOutForTesting()
+        stubs.Set(context.db_api, 'image_member_find',
+                  fake_image_member_find)
+        try:
+            img = FakeImage('pattieblack', False)
+            ctx = context.RequestContext(tenant='froggy')
+            self.assertTrue(ctx.is_image_visible(img))
+            self.assertTrue(ctx.is_image_visible(img))
+            self.assertTrue(ctx.is_image_sharable(img))
+        finally:
+            stubs.UnsetAll()
+
+        self.assertEqual(lookups, [(None, 'froggy')])
+
+    def test_membership_read_from_loaded_members(self):
+        """
+        Tests that a context finds its owner's membership among the
+        members loaded with an image rather than querying for it.
+        """
+        membership = FakeMembership(True)
+        membership.member = 'froggy'
+        membership.deleted = False
+        img = FakeImage('pattieblack', False)
+        img.members = [membership]
+
+        ctx = context.RequestContext(tenant='froggy')
+        self.assertTrue(ctx.is_image_visible(img))
+        self.assertTrue(ctx.is_image_sharable(img))
+
+        ctx = context.RequestContext(tenant='tadpole')
+        self.assertFalse(ctx.is_image_visible(img))
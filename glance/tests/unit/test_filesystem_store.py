@@ -19,6 +19,9 @@
 
 import StringIO
 import hashlib
+import os
+import threading
+import time
 import unittest
 
 import stubout
@@ -66,6 +69,13 @@ class TestStore(unittest.TestCase):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_range(self):
+        """Test retrieval of a byte range of an image"""
+        loc = get_location_from_uri("file:///tmp/glance-tests/2")
+        image_file = self.store.get(loc, offset=5, length=12)
+
+        self.assertEqual("00000remaind", "".join(image_file))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
@@ -138,3 +148,41 @@ class TestStore(unittest.TestCase):
         self.assertRaises(exception.NotFound,
                           self.store.delete,
                           loc)
+
+    def test_delete_many(self):
+        """
+        Test that deleting several images reports, for each, whether it
+        was deleted
+        """
+        locs = [get_location_from_uri("file:///tmp/glance-tests/2"),
+                get_location_from_uri("file:///tmp/glance-tests/noexist")]
+        results = self.store.delete_many(locs)
+
+        self.assertEqual(None, results[0])
+        self.assertTrue(isinstance(results[1], exception.NotFound))
+        self.assertRaises(exception.NotFound, self.store.get, locs[0])
+
+    def test_delete_many_unlinks_concurrently(self):
+        """Test that deleting several images unlinks their files at once"""
+        lock = threading.Lock()
+        unlinking = []
+        most_unlinking = [0]
+
+        def slow_unlink(path):
+            with lock:
+                unlinking.append(path)
+                most_unlinking[0] = max(most_unlinking[0], len(unlinking))
+            time.sleep(0.05)
+            with lock:
+                unlinking.remove(path)
+            raise OSError(2, 'No such file or directory')
+
+        self.stubs.Set(os, 'unlink', slow_unlink)
+        locs = [get_location_from_uri("file:///tmp/glance-tests/%d" % i)
+                for i in xrange(4)]
+        results = self.store.delete_many(locs)
+
+        self.assertEqual(4, len(results))
+        for result in results:
+            self.assertTrue(isinstance(result, exception.NotFound))
+        self.assertTrue(most_unlinking[0] > 1)
@@ -14,11 +14,24 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import fcntl
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
 import unittest
 
+import eventlet
 import stubout
 
+from glance.common import exception
 from glance import image_cache
+from glance.image_cache import index
+from glance.image_cache import policies
+from glance.image_cache import prefetcher
+from glance.image_cache import pruner
+from glance.image_cache import simulator
 
 
 def stub_out_image_cache(stubs):
@@ -53,3 +66,590 @@ class TestImageCache(unittest.TestCase):
                    'image_cache_datadir': '/some/place'}
         cache = image_cache.ImageCache(options)
         self.assertEqual(cache.enabled, True)
+
+
+class TestImageCacheReads(unittest.TestCase):
+    """Test reading cached and in-progress images"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.options = {'image_cache_enabled': 'True',
+                        'image_cache_datadir': self.cache_dir,
+                        'image_cache_follow_timeout': '1'}
+        self.cache = image_cache.ImageCache(self.options)
+        self.image_meta = {'id': 1, 'name': 'image1', 'size': 15}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _writer(self, chunks, fail=False):
+        with self.cache.open(self.image_meta, 'wb') as cache_file:
+            for chunk in chunks:
+                cache_file.write(chunk)
+                cache_file.flush()
+                eventlet.sleep(0.15)
+            if fail:
+                raise IOError("backend went away")
+
+    def test_follow_until_commit(self):
+        chunks = ['aaaaa', 'bbbbb', 'ccccc']
+        with open(self.cache.incomplete_path_for_image(1), 'wb'):
+            pass
+        writer = eventlet.spawn(self._writer, chunks)
+        eventlet.sleep(0)
+
+        data = ''.join(self.cache.follow_incomplete(self.image_meta))
+        writer.wait()
+
+        self.assertEqual(data, 'aaaaabbbbbccccc')
+        self.assertTrue(self.cache.hit(1))
+
+    def test_follow_writer_rollback(self):
+        self.image_meta['size'] = 0
+
+        def run_writer():
+            try:
+                self._writer(['aaaaa'], fail=True)
+            except IOError:
+                pass
+
+        with open(self.cache.incomplete_path_for_image(1), 'wb'):
+            pass
+        writer = eventlet.spawn(run_writer)
+        eventlet.sleep(0)
+
+        def follow():
+            return ''.join(self.cache.follow_incomplete(self.image_meta))
+
+        self.assertRaises(exception.ImageCacheFillFailed, follow)
+        writer.wait()
+
+    def test_follow_stalled_writer(self):
+        with open(self.cache.incomplete_path_for_image(1), 'wb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write('aaaaa')
+            f.flush()
+
+            def follow():
+                return ''.join(self.cache.follow_incomplete(self.image_meta))
+
+            self.assertRaises(exception.ImageCacheFillFailed, follow)
+
+    def test_follow_dead_writer(self):
+        with open(self.cache.incomplete_path_for_image(1), 'wb') as f:
+            f.write('aaaaa')
+        self.assertFalse(self.cache.is_image_currently_being_written(1))
+
+        def follow():
+            return ''.join(self.cache.follow_incomplete(self.image_meta))
+
+        # Given up on at once, rather than after follow_timeout
+        start = time.time()
+        self.assertRaises(exception.ImageCacheFillFailed, follow)
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_client_disconnect_rolls_back(self):
+        def tee():
+            with self.cache.open(self.image_meta, 'wb') as cache_file:
+                for chunk in ('aaaaa', 'bbbbb', 'ccccc'):
+                    cache_file.write(chunk)
+                    yield chunk
+
+        chunks = tee()
+        chunks.next()
+        self.assertTrue(self.cache.is_image_currently_being_written(1))
+        chunks.close()
+
+        self.assertFalse(self.cache.is_image_currently_being_written(1))
+        self.assertFalse(
+            os.path.exists(self.cache.incomplete_path_for_image(1)))
+        self.assertTrue(os.path.exists(self.cache.invalid_path_for_image(1)))
+
+    def test_second_writer_is_refused(self):
+        with self.cache.open(self.image_meta, 'wb') as cache_file:
+            cache_file.write('aaaaa')
+
+            def write():
+                with self.cache.open(self.image_meta, 'wb'):
+                    pass
+
+            self.assertRaises(exception.ImageCacheBusy, write)
+            cache_file.write('bbbbbccccc')
+        self.assertEqual(open(self.cache.path_for_image(1)).read(),
+                         'aaaaabbbbbccccc')
+
+    def test_open_for_transmit(self):
+        with self.cache.open(self.image_meta, 'wb') as cache_file:
+            cache_file.write('aaaaabbbbbccccc')
+
+        cache_file = self.cache.open_for_transmit(self.image_meta)
+        try:
+            self.assertEqual(cache_file.read(), 'aaaaabbbbbccccc')
+        finally:
+            cache_file.close()
+
+
+class TestImageCacheIndex(unittest.TestCase):
+    """Test the cache index kept alongside the cached images"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.options = {'image_cache_enabled': 'True',
+                        'image_cache_datadir': self.cache_dir,
+                        'image_cache_max_size_bytes': '10',
+                        'image_cache_percent_extra_to_free': '0'}
+        self.cache = image_cache.ImageCache(self.options)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _cache_image(self, image_id, data):
+        image_meta = {'id': image_id, 'name': 'image%d' % image_id,
+                      'size': len(data)}
+        with self.cache.open(image_meta, 'wb') as cache_file:
+            cache_file.write(data)
+        return image_meta
+
+    def test_commit_read_and_purge(self):
+        image_meta = self._cache_image(1, 'aaaaa')
+        with self.cache.open(image_meta, 'rb') as cache_file:
+            cache_file.read()
+
+        entries = list(self.cache.entries())
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['id'], 1)
+        self.assertEqual(entries[0]['name'], 'image1')
+        self.assertEqual(entries[0]['size'], 5)
+        self.assertEqual(entries[0]['hits'], 1)
+
+        self.cache.purge(1)
+        self.assertFalse(self.cache.hit(1))
+        self.assertEqual(list(self.cache.entries()), [])
+
+    def test_rollback_records_invalid_entry(self):
+        image_meta = {'id': 1, 'name': 'image1', 'size': 5}
+        try:
+            with self.cache.open(image_meta, 'wb') as cache_file:
+                cache_file.write('aa')
+                raise IOError("backend went away")
+        except IOError:
+            pass
+
+        self.assertEqual(list(self.cache.entries()), [])
+        entries = list(self.cache.invalid_entries())
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['error'], 'backend went away')
+        self.assertEqual(self.cache.reap_invalid(), 1)
+        self.assertEqual(list(self.cache.invalid_entries()), [])
+
+    def test_prefetch_queue_is_fifo(self):
+        for image_id in (3, 1, 2):
+            self.cache.queue_prefetch({'id': image_id, 'name': 'image'})
+
+        self.assertRaises(exception.Invalid, self.cache.queue_prefetch,
+                          {'id': 1, 'name': 'image'})
+        self.assertEqual(self.cache.pop_prefetch_item(), 3)
+
+        self.cache.do_prefetch(3)
+        self.assertTrue(self.cache.is_currently_prefetching_any_images())
+        self.assertTrue(self.cache.is_image_currently_prefetching(3))
+        self.assertEqual(self.cache.pop_prefetch_item(), 1)
+
+        self.cache.delete_prefetching_image(3)
+        self.cache.delete_queued_prefetch_image(1)
+        self.assertFalse(self.cache.is_currently_prefetching_any_images())
+        self.assertEqual(self.cache.pop_prefetch_item(), 2)
+
+    def test_rebuild_index_from_files(self):
+        self._cache_image(1, 'aaaaa')
+        os.makedirs(self.cache.prefetch_path)
+        open(os.path.join(self.cache.prefetch_path, '2'), 'w').close()
+        # As in a new process after an upgrade
+        self.cache.index.close()
+        os.unlink(self.cache.index_path)
+        index._INDEXES.clear()
+
+        cache = image_cache.ImageCache(self.options)
+        entries = list(cache.entries())
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['size'], 5)
+        self.assertTrue(cache.is_image_queued_for_prefetch(2))
+        self.assertFalse(os.listdir(cache.prefetch_path))
+
+    def test_index_is_shared(self):
+        cache = image_cache.ImageCache(self.options)
+        self.assertTrue(cache.index is self.cache.index)
+        mode = cache.index.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_waits_on_locks_without_blocking(self):
+        """
+        Test that a write waiting on another process' lock lets other green
+        threads run
+        """
+        db = sqlite3.connect(self.cache.index_path, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            committed = []
+
+            def commit():
+                db.execute("COMMIT")
+                committed.append(True)
+
+            eventlet.spawn_after(0.05, commit)
+            self.cache.index.upsert_entry(1, index.CACHED, size=5)
+            self.assertEqual(committed, [True])
+            self.assertEqual(self.cache.index.get_entry(1)['size'], 5)
+        finally:
+            db.close()
+
+    def test_hits_are_batched(self):
+        self._cache_image(1, 'aaaaa')
+        self.cache.index.record_hit(1)
+        self.cache.index.record_hit(1)
+
+        db = sqlite3.connect(self.cache.index_path)
+        try:
+            hits = "SELECT hits FROM entries WHERE image_id = 1"
+            self.assertEqual(db.execute(hits).fetchone()[0], 0)
+            self.assertEqual(self.cache.index.get_entry(1)['hits'], 2)
+            self.assertEqual(db.execute(hits).fetchone()[0], 2)
+        finally:
+            db.close()
+
+    def test_prune_least_recently_used(self):
+        for image_id in (1, 2, 3):
+            self._cache_image(image_id, 'aaaaa')
+        self.cache.index.record_hit(1, accessed=time.time() + 10)
+        self.cache.index.record_hit(3, accessed=time.time() + 5)
+
+        pruner.Pruner(self.options).prune_cache()
+
+        self.assertTrue(self.cache.hit(1))
+        self.assertFalse(self.cache.hit(2))
+        self.assertTrue(self.cache.hit(3))
+
+
+class TestEvictionPolicies(unittest.TestCase):
+    """Test the image cache eviction policies and simulator"""
+
+    def _victims(self, policy):
+        victims = []
+        while len(policy):
+            victims.append(policy.pop_victim())
+        return victims
+
+    def test_lru(self):
+        policy = policies.LRUPolicy(100)
+        for image_id in (1, 2, 3):
+            policy.add(image_id, 10)
+        policy.touch(1)
+        self.assertEqual(self._victims(policy), [2, 3, 1])
+
+    def test_lfu(self):
+        policy = policies.LFUPolicy(100)
+        policy.add(1, 10, hits=5)
+        policy.add(2, 10, hits=1)
+        policy.add(3, 10)
+        policy.touch(3)
+        policy.touch(3)
+        self.assertEqual(self._victims(policy), [2, 3, 1])
+
+    def test_gdsf_prefers_small_images(self):
+        policy = policies.GDSFPolicy(100)
+        policy.add(1, 10, hits=1)
+        policy.add(2, 80, hits=1)
+        policy.add(3, 10, hits=1)
+        self.assertEqual(policy.pop_victim(), 2)
+
+    def test_arc_resists_scans(self):
+        policy = policies.ARCPolicy(30)
+        policy.add(1, 10)
+        policy.touch(1)
+        policy.add(2, 10)
+        policy.add(3, 10)
+        self.assertEqual(policy.pop_victim(), 2)
+        self.assertEqual(policy.pop_victim(), 3)
+        self.assertEqual(policy.pop_victim(), 1)
+
+    def test_gdsf_state_is_carried_over(self):
+        policy = policies.GDSFPolicy(100)
+        policy.add(1, 10, hits=1)
+        policy.add(2, 80, hits=1)
+        self.assertEqual(policy.pop_victim(), 2)
+        values, items = policy.save()
+        self.assertEqual(values, {'inflation': 2.0 / 80})
+
+        # Image 1 keeps its old priority, so a new image read as often
+        # outranks it
+        policy = policies.GDSFPolicy(100)
+        policy.load(values, items)
+        policy.add(1, 10, hits=1)
+        policy.add(3, 10, hits=1)
+        self.assertEqual(policy.pop_victim(), 1)
+
+    def test_arc_state_is_carried_over(self):
+        policy = policies.ARCPolicy(30)
+        policy.add(1, 10)
+        policy.add(2, 10)
+        self.assertEqual(policy.pop_victim(), 1)
+
+        # Image 1 is a ghost hit when it is cached again
+        policy2 = policies.ARCPolicy(30)
+        policy2.load(*policy.save())
+        policy2.add(1, 10)
+        self.assertTrue(policy2.target > 0)
+        self.assertTrue(1 in policy2.t2)
+        self.assertFalse(1 in policy2.b1)
+
+    def test_evict_saves_policy_state(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            options = {'image_cache_enabled': 'True',
+                       'image_cache_datadir': cache_dir,
+                       'image_cache_max_size_bytes': '100',
+                       'image_cache_eviction_policy': 'arc'}
+            cache = image_cache.ImageCache(options)
+
+            def cache_image(image_id):
+                image_meta = {'id': image_id, 'name': 'image', 'size': 10}
+                with cache.open(image_meta, 'wb') as cache_file:
+                    cache_file.write('a' * 10)
+
+            for image_id in (1, 2):
+                cache_image(image_id)
+            cache.index.record_hit(2)
+            self.assertEqual(cache.evict(10), 10)
+            self.assertFalse(cache.hit(1))
+            self.assertEqual(cache.index.get_policy_state('arc'),
+                             ({'target': 0}, [('b1', 1, 10, 0, 0)]))
+
+            cache_image(1)
+            cache.evict(10)
+            values, items = cache.index.get_policy_state('arc')
+            self.assertTrue(values['target'] > 0)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_get_policy(self):
+        policy = policies.get_policy(
+            {'image_cache_eviction_policy': 'GDSF'}, 100)
+        self.assertTrue(isinstance(policy, policies.GDSFPolicy))
+        self.assertTrue(isinstance(policies.get_policy({}, 100),
+                                   policies.LRUPolicy))
+        self.assertRaises(exception.InvalidCacheEvictionPolicy,
+                          policies.get_policy,
+                          {'image_cache_eviction_policy': 'fifo'}, 100)
+
+    def test_simulate(self):
+        log = ['# image_id size',
+               '2011-09-01T00:00:00 1 100',
+               '2 10', '1 100', '3 50', '2 10', '1 100']
+        accesses = list(simulator.read_access_log(log))
+        self.assertEqual(accesses[0], ('1', 100))
+
+        results = simulator.compare_policies(accesses, 120)
+        self.assertEqual(sorted(results), sorted(policies.POLICIES))
+        self.assertEqual(results['lru']['requests'], 6)
+        self.assertEqual(results['lru']['hits'], 1)
+        self.assertEqual(results['lfu']['hits'], 2)
+        self.assertAlmostEqual(results['lfu']['byte_hit_ratio'],
+                               200.0 / 370)
+
+    def test_prune_with_policy(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            options = {'image_cache_enabled': 'True',
+                       'image_cache_datadir': cache_dir,
+                       'image_cache_max_size_bytes': '100',
+                       'image_cache_percent_extra_to_free': '0',
+                       'image_cache_eviction_policy': 'lfu'}
+            cache = image_cache.ImageCache(options)
+            for image_id, size in ((1, 60), (2, 30), (3, 30)):
+                image_meta = {'id': image_id, 'name': 'image', 'size': size}
+                with cache.open(image_meta, 'wb') as cache_file:
+                    cache_file.write('a' * size)
+            cache.index.record_hit(1)
+            cache.index.record_hit(3)
+
+            pruner.Pruner(options).prune_cache()
+
+            self.assertTrue(cache.hit(1))
+            self.assertFalse(cache.hit(2))
+            self.assertTrue(cache.hit(3))
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+class TestCacheAutoPrune(unittest.TestCase):
+    """Test pruning the cache from within the process that fills it"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.options = {'image_cache_enabled': 'True',
+                        'image_cache_datadir': self.cache_dir,
+                        'image_cache_auto_prune': 'True',
+                        'image_cache_max_size_bytes': '100',
+                        'image_cache_high_watermark': '0.9',
+                        'image_cache_low_watermark': '0.5'}
+        self.cache = image_cache.ImageCache(self.options)
+
+    def tearDown(self):
+        image_cache.CacheUsage._instances.clear()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _cache_image(self, image_id, size):
+        image_meta = {'id': image_id, 'name': 'image', 'size': size}
+        with self.cache.open(image_meta, 'wb') as cache_file:
+            cache_file.write('a' * size)
+
+    def test_tracks_usage(self):
+        self._cache_image(1, 30)
+        self._cache_image(2, 20)
+        self.assertEqual(self.cache.usage.size, 50)
+        self.assertEqual(self.cache.usage.reserved, 0)
+
+        self.cache.purge(1)
+        self.assertEqual(self.cache.usage.size, 20)
+
+    def test_prunes_to_low_watermark(self):
+        for image_id in (1, 2, 3):
+            self._cache_image(image_id, 30)
+            eventlet.sleep(0)
+        self.assertEqual(self.cache.usage.size, 90)
+
+        self._cache_image(4, 10)
+        eventlet.sleep(0)
+
+        self.assertFalse(self.cache.usage.pruning)
+        self.assertEqual(self.cache.usage.size, 40)
+        self.assertFalse(self.cache.hit(1))
+        self.assertFalse(self.cache.hit(2))
+        self.assertTrue(self.cache.hit(3))
+        self.assertTrue(self.cache.hit(4))
+
+    def test_evicts_to_fit_large_image(self):
+        for image_id in (1, 2, 3):
+            self._cache_image(image_id, 30)
+        self._cache_image(4, 80)
+        eventlet.sleep(0)
+
+        self.assertEqual(self.cache.usage.size, 80)
+        self.assertEqual(self.cache.usage.reserved, 0)
+        for image_id in (1, 2, 3):
+            self.assertFalse(self.cache.hit(image_id))
+        self.assertTrue(self.cache.hit(4))
+
+    def test_refuses_images_that_do_not_fit(self):
+        image_meta = {'id': 1, 'name': 'image', 'size': 101}
+
+        def write():
+            with self.cache.open(image_meta, 'wb'):
+                pass
+
+        self.assertRaises(exception.ImageCacheFull, write)
+        self.assertFalse(
+            os.path.exists(self.cache.incomplete_path_for_image(1)))
+        self.assertEqual(self.cache.usage.reserved, 0)
+
+    def test_client_disconnect_releases_reservation(self):
+        image_meta = {'id': 1, 'name': 'image', 'size': 60}
+
+        def tee():
+            with self.cache.open(image_meta, 'wb') as cache_file:
+                cache_file.write('a' * 30)
+                yield 'a' * 30
+                cache_file.write('a' * 30)
+                yield 'a' * 30
+
+        chunks = tee()
+        chunks.next()
+        self.assertEqual(self.cache.usage.reserved, 60)
+        chunks.close()
+        self.assertEqual(self.cache.usage.reserved, 0)
+
+        self._cache_image(2, 60)
+        self.assertTrue(self.cache.hit(2))
+
+
+class TestPrefetcher(unittest.TestCase):
+    """Test draining the prefetch queue"""
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.cache_dir = tempfile.mkdtemp()
+        self.options = {'image_cache_enabled': 'True',
+                        'image_cache_datadir': self.cache_dir,
+                        'image_cache_prefetcher_workers': '3'}
+        self.cache = image_cache.ImageCache(self.options)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_claim_by_priority(self):
+        self.cache.queue_prefetch({'id': 1, 'name': 'image'})
+        self.cache.queue_prefetch({'id': 2, 'name': 'image'}, priority=5)
+        self.cache.queue_prefetch({'id': 3, 'name': 'image'}, priority=5)
+        self.cache.queue_prefetch({'id': 1, 'name': 'image'}, priority=10)
+
+        self.assertEqual([e['id'] for e in self.cache.prefetch_entries()],
+                         [1, 2, 3])
+        self.assertEqual(self.cache.claim_prefetch_item(), 1)
+        self.assertEqual(self.cache.claim_prefetch_item(), 2)
+        self.assertTrue(self.cache.is_image_currently_prefetching(2))
+
+        self.assertEqual(self.cache.requeue_prefetching_images(), 2)
+        self.assertTrue(self.cache.is_image_queued_for_prefetch(2))
+
+    def test_upgrade_index_without_priorities(self):
+        self.cache.index.close()
+        conn = sqlite3.connect(self.cache.index_path)
+        conn.executescript("DROP TABLE IF EXISTS prefetch_queue;"
+                           "CREATE TABLE prefetch_queue ("
+                           "image_id INTEGER PRIMARY KEY, "
+                           "state VARCHAR(12) NOT NULL, name TEXT, "
+                           "queued_at REAL NOT NULL);"
+                           "INSERT INTO prefetch_queue "
+                           "VALUES (1, 'queued', 'image', 0);")
+        conn.close()
+
+        cache = image_cache.ImageCache(self.options)
+        cache.queue_prefetch({'id': 2, 'name': 'image'}, priority=1)
+        self.assertEqual(cache.claim_prefetch_item(), 2)
+        self.assertEqual(cache.claim_prefetch_item(), 1)
+
+    def test_drain_with_concurrent_workers(self):
+        fetching = set()
+        concurrency = []
+
+        def fake_fetch(self, image_id):
+            fetching.add(image_id)
+            concurrency.append(len(fetching))
+            eventlet.sleep(0.01)
+            fetching.remove(image_id)
+
+        self.stubs.Set(prefetcher.Prefetcher, 'fetch_image_into_cache',
+                       fake_fetch)
+        for image_id in xrange(1, 7):
+            self.cache.queue_prefetch({'id': image_id, 'name': 'image'})
+
+        prefetcher.Prefetcher(self.options).drain()
+
+        self.assertEqual(max(concurrency), 3)
+        self.assertEqual(len(concurrency), 6)
+        self.assertEqual(list(self.cache.prefetch_entries()), [])
+
+    def test_bandwidth_limiter(self):
+        sleeps = []
+        self.stubs.Set(eventlet, 'sleep', sleeps.append)
+
+        limiter = prefetcher.BandwidthLimiter(100)
+        limiter.consume(50)
+        self.assertEqual(sleeps, [])
+        limiter.consume(100)
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(0.4 < sleeps[0] <= 0.5)
+
+        prefetcher.BandwidthLimiter(0).consume(10 ** 9)
+        self.assertEqual(len(sleeps), 1)
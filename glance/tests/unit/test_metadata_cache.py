@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the API server's image metadata cache"""
+
+import time
+import unittest
+
+import stubout
+
+from glance.api import metadata_cache
+from glance.common import context
+
+
+class FakeRegistry(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.images = {'1': {'id': 1, 'name': 'one', 'properties': {}},
+                       '2': {'id': 2, 'name': 'two', 'properties': {}}}
+
+    def fetcher(self, image_id):
+        def fetch():
+            self.calls += 1
+            return dict(self.images[image_id])
+        return fetch
+
+
+class TestImageMetaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.now = 1000.0
+        self.stubs.Set(time, 'time', lambda: self.now)
+        self.spawned = []
+        self.stubs.Set(metadata_cache.eventlet, 'spawn_n',
+                       lambda *args: self.spawned.append(args))
+        self.cache = metadata_cache.ImageMetaCache(2, ttl=10, stale_ttl=5)
+        self.registry = FakeRegistry()
+        self.context = context.RequestContext(auth_tok='token')
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def get(self, image_id, ctx=None):
+        return self.cache.get(ctx or self.context, image_id,
+                              self.registry.fetcher(image_id))
+
+    def test_hit_until_ttl(self):
+        self.assertEqual(self.get('1')['name'], 'one')
+        self.get('1')['name'] = 'changed by the caller'
+        self.assertEqual(self.get('1')['name'], 'one')
+        self.assertEqual(self.registry.calls, 1)
+
+        self.now += 16
+        self.get('1')
+        self.assertEqual(self.registry.calls, 2)
+
+    def test_entries_are_per_requester(self):
+        self.get('1')
+        self.get('1', context.RequestContext(auth_tok='other'))
+        self.assertEqual(self.registry.calls, 2)
+
+    def test_stale_entry_is_refreshed_in_background(self):
+        self.get('1')
+        self.registry.images['1']['name'] = 'renamed'
+        self.now += 12
+
+        self.assertEqual(self.get('1')['name'], 'one')
+        self.assertEqual(self.get('1')['name'], 'one')
+        self.assertEqual(len(self.spawned), 1)
+
+        func, key, fetch, generation = self.spawned[0]
+        func(key, fetch, generation)
+        self.assertEqual(self.get('1')['name'], 'renamed')
+        self.assertEqual(self.registry.calls, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.get('1')
+        self.get('2')
+        self.get('1')
+        self.get('2', context.RequestContext())
+        self.assertEqual(self.registry.calls, 3)
+
+        self.get('1')
+        self.assertEqual(self.registry.calls, 3)
+        self.get('2')
+        self.assertEqual(self.registry.calls, 4)
+
+    def test_invalidate(self):
+        self.get('1')
+        self.get('1', context.RequestContext(auth_tok='other'))
+        self.cache.invalidate(1)
+        self.get('1')
+        self.assertEqual(self.registry.calls, 3)
+
+    def test_refresh_started_before_invalidate_is_discarded(self):
+        self.get('1')
+        self.now += 12
+        self.get('1')
+        func, key, fetch, generation = self.spawned[0]
+        self.cache.invalidate('1')
+        self.registry.images['1']['name'] = 'renamed'
+        func(key, lambda: {'id': 1, 'name': 'read before the update'},
+             generation)
+
+        self.assertEqual(self.get('1')['name'], 'renamed')
+
+    def test_disabled_by_default(self):
+        self.assertEqual(metadata_cache.get_metadata_cache({}), None)
+        cache = metadata_cache.get_metadata_cache(
+            {'image_meta_cache_size': '100', 'image_meta_cache_ttl': '20'})
+        self.assertEqual((cache.max_size, cache.ttl, cache.stale_ttl),
+                         (100, 20, 0))
+
+        # Changes made by other processes are only seen once entries expire,
+        # so they are kept briefly by default
+        cache = metadata_cache.get_metadata_cache(
+            {'image_meta_cache_size': '100'})
+        self.assertEqual(cache.ttl, 5)
+
+    def test_disabled_with_workers(self):
+        options = {'image_meta_cache_size': '100', 'workers': '2'}
+        self.assertEqual(metadata_cache.get_metadata_cache(options), None)
+        options['workers'] = '0'
+        self.assertNotEqual(metadata_cache.get_metadata_cache(options), None)
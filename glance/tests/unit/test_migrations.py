@@ -32,6 +32,7 @@ import urlparse
 
 from migrate.versioning.repository import Repository
 from sqlalchemy import *
+from sqlalchemy.engine import reflection
 from sqlalchemy.pool import NullPool
 
 from glance.common import exception
@@ -256,3 +257,67 @@ class TestMigrations(unittest.TestCase):
         last_num_image_properties = conn.execute(sel).scalar()
 
         self.assertEqual(num_image_properties - 2, last_num_image_properties)
+
+    def test_listing_indexes_8_to_9_to_8(self):
+        """
+        Tests that the indexes used by the registry's listings are created
+        by the upgrade to 9, and dropped again by the downgrade to 8
+        """
+        for key, engine in self.engines.items():
+            options = {'sql_connection': TestMigrations.TEST_DATABASES[key]}
+            self._listing_indexes_8_to_9_to_8(engine, options)
+
+    def _listing_indexes_8_to_9_to_8(self, engine, options):
+        index_names = ['ix_images_deleted_created_at',
+                       'ix_images_deleted_updated_at',
+                       'ix_images_deleted_name',
+                       'ix_images_deleted_size',
+                       'ix_images_deleted_status',
+                       'ix_image_members_member_deleted',
+                       'ix_image_properties_name_value']
+
+        migration_api.version_control(options)
+        migration_api.upgrade(options, 9)
+        found = self._get_index_names(engine)
+        for name in index_names:
+            self.assertTrue(name in found,
+                            "%s not found in indexes: %s" % (name, found))
+
+        migration_api.downgrade(options, 8)
+        found = self._get_index_names(engine)
+        for name in index_names:
+            self.assertFalse(name in found,
+                             "%s still found in indexes: %s" % (name, found))
+
+    def test_property_index_9_to_10_to_9(self):
+        """
+        Tests that the upgrade to 10 replaces the (name, value) property
+        index with one also holding deleted and image_id, and that the
+        downgrade to 9 puts it back
+        """
+        for key, engine in self.engines.items():
+            options = {'sql_connection': TestMigrations.TEST_DATABASES[key]}
+            self._property_index_9_to_10_to_9(engine, options)
+
+    def _property_index_9_to_10_to_9(self, engine, options):
+        old_index = 'ix_image_properties_name_value'
+        new_index = 'ix_image_properties_name_value_deleted_image_id'
+
+        migration_api.version_control(options)
+        migration_api.upgrade(options, 10)
+        found = self._get_index_names(engine)
+        self.assertTrue(new_index in found)
+        self.assertFalse(old_index in found)
+
+        migration_api.downgrade(options, 9)
+        found = self._get_index_names(engine)
+        self.assertTrue(old_index in found)
+        self.assertFalse(new_index in found)
+
+    def _get_index_names(self, engine):
+        inspector = reflection.Inspector.from_engine(engine)
+        names = []
+        for table in ('images', 'image_members', 'image_properties'):
+            names.extend(index['name']
+                         for index in inspector.get_indexes(table))
+        return names
@@ -15,9 +15,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
 import logging
+import os
+import shutil
+import socket
+import tempfile
 import unittest
 
+import kombu.connection
+import stubout
+
 from glance.common import exception
 from glance.common import notifier
 
@@ -84,11 +92,16 @@ class TestRabbitNotifier(unittest.TestCase):
     """Test AMQP/Rabbit notifier works."""
 
     def setUp(self):
-        notifier.RabbitStrategy._send_message = self._send_message
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(notifier.RabbitStrategy, '_send_message',
+                       self._send_message)
         self.called = False
         options = {"notifier_strategy": "rabbit"}
         self.notifier = notifier.Notifier(options)
 
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
     def _send_message(self, message, priority):
         self.called = {
             "message": message,
@@ -121,3 +134,405 @@ class TestRabbitNotifier(unittest.TestCase):
 
         self.assertEquals("test_message", self.called["message"]["payload"])
         self.assertEquals("ERROR", self.called["message"]["priority"])
+
+
+class TestAsyncRabbitNotifier(unittest.TestCase):
+    """
+    Test the rabbit notifier publishes from its queue, against kombu's
+    in-memory broker
+    """
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(notifier.RabbitStrategy, 'RETRY_INTERVAL', 0)
+        self.topic = 'test_notifications_%s' % id(self)
+        self.options = {"notifier_strategy": "rabbit",
+                        "rabbit_notification_topic": self.topic,
+                        "rabbit_max_queue_size": 2,
+                        "rabbit_batch_size": 2}
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def make_notifier(self, **options):
+        self.options.update(options)
+        rabbit = notifier.Notifier(self.options)
+        self.strategy = rabbit.strategy
+        self.connection = kombu.connection.BrokerConnection(
+            transport='memory')
+        self.strategy.connection = self.connection
+        return rabbit
+
+    def get_payloads(self, priority):
+        queue = self.connection.SimpleQueue("%s.%s" % (self.topic, priority))
+        payloads = []
+        while queue.qsize():
+            message = queue.get(block=False)
+            payloads.append(message.payload['payload'])
+            message.ack()
+        queue.close()
+        return payloads
+
+    def test_publishes_in_background(self):
+        rabbit = self.make_notifier()
+        published = []
+        publish = self.strategy._publish
+
+        def recording_publish(message, priority):
+            published.append(message['payload'])
+            publish(message, priority)
+
+        self.stubs.Set(self.strategy, '_publish', recording_publish)
+        rabbit.info("test_event", 0)
+        rabbit.error("test_event", 1)
+        self.assertEqual([], published)
+        self.assertEqual(2, self.strategy.get_metrics()['queue_depth'])
+
+        self.assertTrue(self.strategy.flush(1))
+        self.assertEqual([0, 1], published)
+        self.assertEqual([0], self.get_payloads("INFO"))
+        self.assertEqual([1], self.get_payloads("ERROR"))
+        self.assertEqual(0, self.strategy.get_metrics()['queue_depth'])
+        self.assertEqual(2, self.strategy.get_metrics()['published'])
+
+    def test_reuses_channel(self):
+        rabbit = self.make_notifier()
+        channels = []
+        channel = self.connection.channel
+
+        def counting_channel():
+            channels.append(True)
+            return channel()
+
+        self.stubs.Set(self.connection, 'channel', counting_channel)
+        for i in xrange(5):
+            rabbit.info("test_event", i)
+            self.strategy.flush(1)
+        self.assertEqual(1, len(channels))
+        self.assertEqual(range(5), self.get_payloads("INFO"))
+
+    def test_commits_each_batch(self):
+        rabbit = self.make_notifier(rabbit_max_queue_size=10,
+                                    rabbit_batch_size=3)
+        calls = []
+        channel = self.connection.channel
+
+        def transactional_channel():
+            chan = channel()
+            chan.tx_select = lambda: calls.append('select')
+            chan.tx_commit = lambda: calls.append('commit')
+            return chan
+
+        self.stubs.Set(self.connection, 'channel', transactional_channel)
+        for i in xrange(5):
+            rabbit.info("test_event", i)
+        self.assertTrue(self.strategy.flush(1))
+        self.assertEqual(['select', 'commit', 'commit'], calls)
+        self.assertEqual(range(5), self.get_payloads("INFO"))
+
+    def test_rolled_back_batch_is_published_again(self):
+        rabbit = self.make_notifier()
+        self.stubs.Set(self.connection.transport, 'connection_errors',
+                       (socket.error,))
+        channel = self.connection.channel
+        published = []
+        failures = [socket.error('connection reset')]
+
+        def commit():
+            if failures:
+                del published[:]
+                raise failures.pop()
+
+        def transactional_channel():
+            chan = channel()
+            chan.tx_select = lambda: None
+            chan.tx_commit = commit
+            return chan
+
+        publish = self.strategy._publish
+
+        def recording_publish(message, priority):
+            publish(message, priority)
+            published.append(message['payload'])
+
+        self.stubs.Set(self.connection, 'channel', transactional_channel)
+        self.stubs.Set(self.strategy, '_publish', recording_publish)
+        rabbit.info("test_event", 0)
+        rabbit.info("test_event", 1)
+        self.assertTrue(self.strategy.flush(1))
+        self.assertEqual([0, 1], published)
+        self.assertEqual(2, self.strategy.get_metrics()['published'])
+
+    def test_overflow_drop_new(self):
+        rabbit = self.make_notifier(rabbit_overflow_policy='drop_new')
+        for i in xrange(3):
+            rabbit.info("test_event", i)
+        self.assertEqual(1, self.strategy.get_metrics()['dropped'])
+
+        self.strategy.flush(1)
+        self.assertEqual([0, 1], self.get_payloads("INFO"))
+
+    def test_overflow_drop_oldest(self):
+        rabbit = self.make_notifier(rabbit_overflow_policy='drop_oldest')
+        for i in xrange(3):
+            rabbit.info("test_event", i)
+        self.assertEqual(1, self.strategy.get_metrics()['dropped'])
+
+        self.strategy.flush(1)
+        self.assertEqual([1, 2], self.get_payloads("INFO"))
+
+    def test_drop_warnings_are_aggregated(self):
+        rabbit = self.make_notifier(rabbit_overflow_policy='drop_new')
+        warnings = []
+        self.stubs.Set(notifier.logger, 'warn', warnings.append)
+        for i in xrange(5):
+            rabbit.info("test_event", i)
+        self.assertEqual(3, self.strategy.get_metrics()['dropped'])
+        self.assertEqual(1, len(warnings))
+
+        self.strategy._drop_logged_at -= self.strategy.DROP_LOG_INTERVAL
+        rabbit.info("test_event", 5)
+        self.assertEqual(2, len(warnings))
+        self.assertTrue('dropped 3 message(s)' in warnings[1])
+
+    def test_overflow_block(self):
+        rabbit = self.make_notifier(rabbit_overflow_policy='block')
+        for i in xrange(5):
+            rabbit.info("test_event", i)
+        self.assertEqual(0, self.strategy.get_metrics()['dropped'])
+
+        self.strategy.flush(1)
+        self.assertEqual(range(5), self.get_payloads("INFO"))
+
+    def test_invalid_overflow_policy(self):
+        self.options['rabbit_overflow_policy'] = 'invalid_policy'
+        self.assertRaises(exception.InvalidNotifierOverflowPolicy,
+                          notifier.Notifier, self.options)
+
+    def test_retries_after_connection_error(self):
+        rabbit = self.make_notifier()
+        self.stubs.Set(self.connection.transport, 'connection_errors',
+                       (socket.error,))
+        failures = [socket.error('connection refused')]
+        publish = self.strategy._publish
+
+        def failing_publish(message, priority):
+            if failures:
+                raise failures.pop()
+            publish(message, priority)
+
+        self.stubs.Set(self.strategy, '_publish', failing_publish)
+        rabbit.info("test_event", 0)
+        self.strategy.flush(1)
+        self.assertEqual([0], self.get_payloads("INFO"))
+        self.assertEqual(0, self.strategy.get_metrics()['failed'])
+
+    def test_drops_unpublishable_message(self):
+        rabbit = self.make_notifier()
+        publish = self.strategy._publish
+
+        def failing_publish(message, priority):
+            if message['payload'] == 0:
+                raise ValueError('cannot serialize')
+            publish(message, priority)
+
+        self.stubs.Set(self.strategy, '_publish', failing_publish)
+        rabbit.info("test_event", 0)
+        rabbit.info("test_event", 1)
+        self.strategy.flush(1)
+        self.assertEqual([1], self.get_payloads("INFO"))
+        self.assertEqual(1, self.strategy.get_metrics()['failed'])
+
+
+class FakeStrategy(object):
+    """A strategy that records the messages it publishes, unless down"""
+
+    def __init__(self, options):
+        self.down = False
+        self.published = []
+
+    def publish(self, message, priority):
+        if self.down:
+            raise socket.error('connection refused')
+        self.published.append((priority, message['payload']))
+
+
+class TestSpoolingNotifier(unittest.TestCase):
+    """Test the spooling notifier spools messages and delivers them"""
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(notifier.Notifier, 'STRATEGIES',
+                       dict(notifier.Notifier.STRATEGIES, fake=FakeStrategy))
+        self.stubs.Set(notifier.SpoolingStrategy, 'RETRY_INTERVAL', 0.01)
+        self.stubs.Set(notifier.SpoolingStrategy, 'MAX_RETRY_INTERVAL', 0.01)
+        self.spool_dir = tempfile.mkdtemp()
+        self.options = {"notifier_strategy": "spool",
+                        "notifier_spool_strategy": "fake",
+                        "notifier_spool_dir": self.spool_dir}
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            spool.close()
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.spool_dir)
+
+    def make_notifier(self, **options):
+        self.options.update(options)
+        spooling = notifier.Notifier(self.options)
+        self.spools.append(spooling.strategy)
+        return spooling
+
+    def get_segments(self, slot=0):
+        path = os.path.join(self.spool_dir, str(slot))
+        return sorted(name for name in os.listdir(path)
+                      if name.endswith('.log'))
+
+    def test_delivers_in_background(self):
+        spooling = self.make_notifier()
+        spool = spooling.strategy
+        spooling.info("test_event", 0)
+        spooling.error("test_event", 1)
+        self.assertEqual([], spool.strategy.published)
+
+        self.assertTrue(spool.flush(1))
+        self.assertEqual([('INFO', 0), ('ERROR', 1)],
+                         spool.strategy.published)
+
+    def test_broker_down(self):
+        spooling = self.make_notifier()
+        spool = spooling.strategy
+        spool.strategy.down = True
+        for i in xrange(3):
+            spooling.info("test_event", i)
+        self.assertFalse(spool.flush(0.05))
+        self.assertEqual([], spool.strategy.published)
+
+        spool.strategy.down = False
+        self.assertTrue(spool.flush(1))
+        self.assertEqual([('INFO', 0), ('INFO', 1), ('INFO', 2)],
+                         spool.strategy.published)
+
+    def test_compacts_delivered_segments(self):
+        spooling = self.make_notifier(notifier_spool_segment_size=1)
+        spool = spooling.strategy
+        spool.strategy.down = True
+        for i in xrange(3):
+            spooling.info("test_event", i)
+        self.assertEqual(4, len(self.get_segments()))
+
+        spool.strategy.down = False
+        spool.flush(1)
+        self.assertEqual(range(3),
+                         [payload for priority, payload
+                          in spool.strategy.published])
+        self.assertEqual(1, len(self.get_segments()))
+
+    def test_resumes_after_restart(self):
+        spooling = self.make_notifier()
+        spooling.strategy.strategy.down = True
+        for i in xrange(3):
+            spooling.info("test_event", i)
+        spooling.strategy.close()
+
+        # A partly written message is skipped
+        segment = os.path.join(self.spool_dir, '0', self.get_segments()[-1])
+        with open(segment, 'a') as f:
+            f.write('{"priority": "INFO", "mess')
+
+        restarted = self.make_notifier()
+        restarted.info("test_event", 3)
+        restarted.strategy.flush(1)
+        self.assertEqual(range(4),
+                         [payload for priority, payload
+                          in restarted.strategy.strategy.published])
+        self.assertEqual(1, len(self.get_segments()))
+
+    def test_dead_letters_undeliverable_message(self):
+        spooling = self.make_notifier(notifier_spool_max_attempts=3)
+        spool = spooling.strategy
+        attempts = []
+        publish = spool.strategy.publish
+
+        def failing_publish(message, priority):
+            if message['payload'] == 0:
+                attempts.append(message)
+                raise ValueError('cannot serialize')
+            publish(message, priority)
+
+        self.stubs.Set(spool.strategy, 'publish', failing_publish)
+        spooling.info("test_event", 0)
+        spooling.info("test_event", 1)
+        self.assertTrue(spool.flush(1))
+        self.assertEqual([('INFO', 1)], spool.strategy.published)
+        self.assertEqual(3, len(attempts))
+
+        with open(os.path.join(self.spool_dir, '0', 'dead-letter')) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([0], [record['message']['payload']
+                               for record in records])
+
+    def test_skips_missing_segment(self):
+        spooling = self.make_notifier(notifier_spool_segment_size=1)
+        spool = spooling.strategy
+        spool.strategy.down = True
+        for i in xrange(3):
+            spooling.info("test_event", i)
+        os.unlink(os.path.join(self.spool_dir, '0', self.get_segments()[0]))
+
+        spool.strategy.down = False
+        self.assertTrue(spool.flush(1))
+        self.assertEqual([1, 2], [payload for priority, payload
+                                  in spool.strategy.published])
+
+    def test_syncs_full_segments_in_background(self):
+        synced = []
+        self.stubs.Set(os, 'fsync', synced.append)
+        spooling = self.make_notifier(notifier_spool_segment_size=1)
+        for i in xrange(3):
+            spooling.info("test_event", i)
+        self.assertEqual([], synced)
+
+        self.assertTrue(spooling.strategy.flush(1))
+        self.assertEqual(4, len(synced))
+
+    def test_adopts_orphaned_spools(self):
+        first = self.make_notifier()
+        second = self.make_notifier()
+        for spooling in (first, second):
+            spooling.strategy.strategy.down = True
+        first.info("test_event", 0)
+        second.info("test_event", 1)
+        first.strategy.close()
+        second.strategy.close()
+
+        # The spool of the second process is left without an owner
+        restarted = self.make_notifier()
+        restarted.info("test_event", 2)
+        self.assertTrue(restarted.strategy.flush(1))
+        self.assertEqual([0, 2, 1],
+                         [payload for priority, payload
+                          in restarted.strategy.strategy.published])
+        self.assertEqual([], self.get_segments(1))
+
+        # Spools with nothing left to deliver are not adopted
+        self.make_notifier().info("test_event", 3)
+        self.assertEqual('1', os.path.basename(self.spools[-1].path))
+
+    def test_processes_use_separate_spools(self):
+        first = self.make_notifier()
+        second = self.make_notifier()
+        first.info("test_event", 0)
+        second.info("test_event", 1)
+        self.assertNotEqual(first.strategy.path, second.strategy.path)
+
+        first.strategy.flush(1)
+        second.strategy.flush(1)
+        self.assertEqual([('INFO', 0)], first.strategy.strategy.published)
+        self.assertEqual([('INFO', 1)], second.strategy.strategy.published)
+
+    def test_cannot_spool_to_spool(self):
+        self.options['notifier_spool_strategy'] = 'spool'
+        self.assertRaises(exception.InvalidNotifierStrategy,
+                          notifier.Notifier, self.options)
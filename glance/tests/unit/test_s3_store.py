@@ -87,10 +87,18 @@ def stub_out_s3(stubs):
         def get_file(self):
             return self.data
 
+        def get_contents_as_string(self, headers=None):
+            range_header = headers['Range']
+            first, last = range_header[len('bytes='):].split('-')
+            data = self.bucket.keys[self.name].data.getvalue()
+            return data[int(first):int(last) + 1]
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
         """
+        key_class = FakeKey
+
         def __init__(self, name, keys=None):
             self.name = name
             self.keys = keys or {}
@@ -104,6 +112,16 @@ def stub_out_s3(stubs):
         def delete(self, key):
             del self.keys[key]
 
+        def delete_keys(self, keys):
+            result = FakeMultiDeleteResult()
+            for key in keys:
+                if key in self.keys:
+                    del self.keys[key]
+                    result.deleted.append(key)
+                else:
+                    result.errors.append(FakeDeleteError(key))
+            return result
+
         def get_key(self, key_name, **kwargs):
             key = self.keys.get(key_name)
             if not key:
@@ -115,6 +133,54 @@ def stub_out_s3(stubs):
             self.keys[key_name] = new_key
             return new_key
 
+        def initiate_multipart_upload(self, key_name):
+            return FakeMultiPartUpload(self, key_name)
+
+    class FakeMultiDeleteResult:
+        """
+        Acts like a ``boto.s3.multidelete.MultiDeleteResult``
+        """
+        def __init__(self):
+            self.deleted = []
+            self.errors = []
+
+    class FakeDeleteError:
+        """
+        Acts like a ``boto.s3.multidelete.Error``
+        """
+        def __init__(self, key):
+            self.key = key
+            self.code = 'NoSuchKey'
+            self.message = 'The specified key does not exist.'
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.id = 'upload-%s' % key_name
+            self.parts = {}
+            self.cancelled = False
+            uploads.append(self)
+
+        def upload_part_from_file(self, fp, part_num):
+            data = fp.read()
+            if data == 'fail' * (len(data) / 4):
+                raise IOError("part upload failed")
+            self.parts[part_num] = data
+
+        def complete_upload(self):
+            data = ''.join(self.parts[n] for n in sorted(self.parts))
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+
+        def cancel_upload(self):
+            self.cancelled = True
+
+    uploads = []
+
     fixture_buckets = {'glance': FakeBucket('glance')}
     b = fixture_buckets['glance']
     k = b.new_key('2')
@@ -135,6 +201,7 @@ def stub_out_s3(stubs):
               '__init__', fake_connection_constructor)
     stubs.Set(boto.s3.connection.S3Connection,
               'get_bucket', fake_get_bucket)
+    return uploads
 
 
 def format_s3_location(user, key, authurl, bucket, obj):
@@ -158,7 +225,7 @@ class TestStore(unittest.TestCase):
     def setUp(self):
         """Establish a clean test environment"""
         self.stubs = stubout.StubOutForTesting()
-        stub_out_s3(self.stubs)
+        self.uploads = stub_out_s3(self.stubs)
         self.store = Store(S3_OPTIONS)
 
     def tearDown(self):
@@ -195,6 +262,29 @@ class TestStore(unittest.TestCase):
                           self.store.get,
                           loc)
 
+    def test_get_parallel(self):
+        """Test that large images are read as concurrent ranged GETs"""
+        options = S3_OPTIONS.copy()
+        options.update({'s3_store_read_concurrency': '2',
+                        's3_store_read_chunk_size': '1'})
+        self.store = Store(options)
+        mb = 1024 * 1024
+        contents = 'a' * mb + 'b' * mb + 'c' * 10
+        location, size, checksum = self.store.add(
+            42, StringIO.StringIO(contents))
+
+        loc = get_location_from_uri(location)
+        chunks = list(self.store.get(loc))
+        self.assertEquals(chunks, ['a' * mb, 'b' * mb, 'c' * 10])
+
+        # Byte ranges of the image are split up the same way
+        data = ''.join(self.store.get(loc, offset=mb - 5, length=mb + 10))
+        self.assertEquals(data, 'a' * 5 + 'b' * mb + 'c' * 5)
+
+        # Images no larger than one range are read in a single GET
+        loc = get_location_from_uri("s3://user:key@auth_address/glance/2")
+        self.assertEquals(self.store.get(loc).getvalue(), "*" * FIVE_KB)
+
     def test_add(self):
         """Test that we can add an image via the s3 backend"""
         expected_image_id = 42
@@ -225,6 +315,55 @@ class TestStore(unittest.TestCase):
         self.assertEquals(expected_s3_contents, new_image_contents.getvalue())
         self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def test_add_multipart(self):
+        """Test that large images are streamed in as multipart uploads"""
+        options = S3_OPTIONS.copy()
+        options.update({'s3_store_multipart_upload': 'True',
+                        's3_store_multipart_chunk_size': '5',
+                        's3_store_multipart_concurrency': '2'})
+        self.store = Store(options)
+        part_size = 5 * 1024 * 1024
+        contents = 'a' * part_size + 'b' * part_size + 'c' * 10
+        image_s3 = StringIO.StringIO(contents)
+
+        location, size, checksum = self.store.add(42, image_s3)
+
+        self.assertEquals(size, len(contents))
+        self.assertEquals(checksum, hashlib.md5(contents).hexdigest())
+        self.assertEquals(len(self.uploads), 1)
+        self.assertEquals(sorted(self.uploads[0].parts), [1, 2, 3])
+        self.assertFalse(self.uploads[0].cancelled)
+
+        loc = get_location_from_uri(location)
+        self.assertEquals(self.store.get(loc).getvalue(), contents)
+
+    def test_add_multipart_small_image(self):
+        """Test that images smaller than a part are sent in one request"""
+        options = S3_OPTIONS.copy()
+        options['s3_store_multipart_upload'] = 'True'
+        self.store = Store(options)
+        contents = "*" * FIVE_KB
+
+        location, size, checksum = self.store.add(
+            42, StringIO.StringIO(contents))
+
+        self.assertEquals(size, FIVE_KB)
+        self.assertEquals(checksum, hashlib.md5(contents).hexdigest())
+        self.assertEquals(self.uploads, [])
+
+    def test_add_multipart_aborts_on_failure(self):
+        """Test that a failed part aborts the multipart upload"""
+        options = S3_OPTIONS.copy()
+        options.update({'s3_store_multipart_upload': 'True',
+                        's3_store_multipart_chunk_size': '5'})
+        self.store = Store(options)
+        part_size = 5 * 1024 * 1024
+        image_s3 = StringIO.StringIO('a' * part_size + 'fail' * 10)
+
+        self.assertRaises(IOError, self.store.add, 42, image_s3)
+        self.assertTrue(self.uploads[0].cancelled)
+        self.assertFalse(self.uploads[0].bucket.exists('42'))
+
     def test_add_host_variations(self):
         """
         Test that having http(s):// in the s3serviceurl in config
@@ -335,3 +474,17 @@ class TestStore(unittest.TestCase):
         self.assertRaises(exception.NotFound,
                           self.store.delete,
                           loc)
+
+    def test_delete_many(self):
+        """
+        Test that deleting several images reports, for each, whether it
+        was deleted
+        """
+        locs = [get_location_from_uri("s3://user:key@auth_address/glance/2"),
+                get_location_from_uri(
+                    "s3://user:key@auth_address/glance/noexist")]
+        results = self.store.delete_many(locs)
+
+        self.assertEqual(None, results[0])
+        self.assertTrue(isinstance(results[1], BackendException))
+        self.assertRaises(exception.NotFound, self.store.get, locs[0])
@@ -0,0 +1,209 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+import stubout
+
+from glance.common import exception
+from glance.registry import context
+from glance.registry.db import api as db_api
+from glance.registry.db import models
+from glance import store
+from glance.store import scrubber
+
+
+class TestScrubber(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.test_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.test_dir, 'checkpoint')
+        self.options = {'sql_connection': 'sqlite://',
+                        'verbose': False,
+                        'debug': False,
+                        'scrub_batch_size': 3,
+                        'scrub_store_concurrency': 2,
+                        'scrub_checkpoint_file': self.checkpoint_file,
+                        'filesystem_store_datadir': self.test_dir}
+        db_api.configure_db(self.options)
+        self.context = context.RequestContext(is_admin=True,
+                                              show_deleted=True)
+        self.deleted = []
+        self.failing = {}
+        self.stubs.Set(store, 'delete_many_from_backend', self.delete_many)
+        self.scrubber = scrubber.Scrubber(self.options)
+        self.pool = eventlet.greenpool.GreenPool(100)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        models.unregister_models(db_api._ENGINE)
+        models.register_models(db_api._ENGINE)
+        shutil.rmtree(self.test_dir)
+
+    def delete_many(self, locations):
+        eventlet.sleep(0)
+        results = []
+        for location in locations:
+            if location in self.failing:
+                results.append(self.failing[location])
+            else:
+                self.deleted.append(location)
+                results.append(None)
+        return results
+
+    def create_pending(self, count, scheme='file'):
+        """Creates images pending deletion, returning their ids"""
+        deleted_at = datetime.datetime.utcnow() - datetime.timedelta(1)
+        image_ids = []
+        for i in xrange(count):
+            image = db_api.image_create(self.context, {
+                    'status': 'pending_delete',
+                    'deleted': True,
+                    'deleted_at': deleted_at + datetime.timedelta(0, i),
+                    'location': '%s://image/%d' % (scheme, i)})
+            image_ids.append(image['id'])
+        return image_ids
+
+    def get_statuses(self, image_ids):
+        return [db_api.image_get(self.context, image_id)['status']
+                for image_id in image_ids]
+
+    def test_run_in_batches(self):
+        """
+        Tests that pending deletes are read and marked deleted a batch at
+        a time
+        """
+        image_ids = self.create_pending(7)
+        reads = []
+        updates = []
+        get_pending = db_api.image_get_all_pending_delete
+        update_many = db_api.image_update_many
+
+        def recording_get_pending(*args, **kwargs):
+            images = get_pending(*args, **kwargs)
+            reads.append(len(images))
+            return images
+
+        def recording_update_many(context, image_ids, values):
+            updates.append(len(image_ids))
+            return update_many(context, image_ids, values)
+
+        self.stubs.Set(db_api, 'image_get_all_pending_delete',
+                       recording_get_pending)
+        self.stubs.Set(db_api, 'image_update_many', recording_update_many)
+
+        self.scrubber.run(self.pool)
+        self.assertEqual([3, 3, 1], reads)
+        self.assertEqual([3, 3, 1], updates)
+        self.assertEqual(7, len(self.deleted))
+        self.assertEqual(['deleted'] * 7, self.get_statuses(image_ids))
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_store_concurrency(self):
+        """
+        Tests that each store's images in a batch are deleted with at most
+        scrub_store_concurrency bulk deletes, running at once
+        """
+        self.scrubber.batch_size = 10
+        self.create_pending(5, scheme='file')
+        self.create_pending(5, scheme='swift')
+        calls = {}
+        running = {}
+        most_running = {}
+
+        def delete_many(locations):
+            scheme = locations[0].split(':')[0]
+            calls.setdefault(scheme, []).append(len(locations))
+            running[scheme] = running.get(scheme, 0) + 1
+            most_running[scheme] = max(most_running.get(scheme, 0),
+                                       running[scheme])
+            eventlet.sleep(0.01)
+            running[scheme] -= 1
+            return [None] * len(locations)
+
+        self.stubs.Set(store, 'delete_many_from_backend', delete_many)
+        self.scrubber.run(self.pool)
+        self.assertEqual({'file': [3, 2], 'swift': [3, 2]}, calls)
+        self.assertEqual({'file': 2, 'swift': 2}, most_running)
+
+    def test_failed_bulk_delete(self):
+        """
+        Tests that the images are left pending when a whole bulk delete
+        fails
+        """
+        image_ids = self.create_pending(3)
+
+        def delete_many(locations):
+            raise Exception('store unavailable')
+
+        self.stubs.Set(store, 'delete_many_from_backend', delete_many)
+        self.scrubber.run(self.pool)
+        self.assertEqual(['pending_delete'] * 3,
+                         self.get_statuses(image_ids))
+
+    def test_failed_delete(self):
+        """
+        Tests that an image whose data could not be deleted is left
+        pending, while one whose data is already gone is marked deleted
+        """
+        image_ids = self.create_pending(4)
+        self.failing['file://image/1'] = Exception('store unavailable')
+        self.failing['file://image/2'] = exception.NotFound()
+
+        self.scrubber.run(self.pool)
+        self.assertEqual(['deleted', 'pending_delete', 'deleted', 'deleted'],
+                         self.get_statuses(image_ids))
+
+        del self.failing['file://image/1']
+        self.scrubber.run(self.pool)
+        self.assertEqual(['deleted'] * 4, self.get_statuses(image_ids))
+
+    def test_resume_from_checkpoint(self):
+        """
+        Tests that a scrubber stopped part way through a run carries on
+        after the last batch it finished
+        """
+        image_ids = self.create_pending(7)
+        self.failing['file://image/0'] = Exception('store unavailable')
+        delete_batch = self.scrubber._delete_batch
+        batches = []
+
+        def crashing_delete_batch(pool, images):
+            batches.append([image['id'] for image in images])
+            if len(batches) == 2:
+                raise KeyboardInterrupt()
+            return delete_batch(pool, images)
+
+        self.stubs.Set(self.scrubber, '_delete_batch', crashing_delete_batch)
+        self.assertRaises(KeyboardInterrupt, self.scrubber.run, self.pool)
+        self.assertTrue(os.path.exists(self.checkpoint_file))
+
+        # The image that failed in the first batch waits for the next run
+        scrubber.Scrubber(self.options).run(self.pool)
+        self.assertEqual(['pending_delete'] + ['deleted'] * 6,
+                         self.get_statuses(image_ids))
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+        del self.failing['file://image/0']
+        scrubber.Scrubber(self.options).run(self.pool)
+        self.assertEqual(['deleted'] * 7, self.get_statuses(image_ids))
@@ -15,8 +15,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import StringIO
+import hashlib
 import unittest
 
+import eventlet.tpool
+
 from glance import utils
 
 
@@ -106,3 +110,56 @@ class TestUtils(unittest.TestCase):
             result = utils.get_image_meta_from_headers(response)
             for k, v in expected.items():
                 self.assertEqual(v, result[k])
+
+    def test_chunkslice(self):
+        """Verifies byte ranges are cut correctly across chunk boundaries"""
+        chunks = ['abc', 'def', 'ghi']
+        self.assertEqual(''.join(utils.chunkslice(iter(chunks), 2, 5)),
+                         'cdefg')
+        self.assertEqual(''.join(utils.chunkslice(iter(chunks), 3)),
+                         'defghi')
+        self.assertEqual(''.join(utils.chunkslice(iter(chunks), 0, 3)),
+                         'abc')
+        self.assertEqual(''.join(utils.chunkslice(iter(chunks), 20)), '')
+
+    def test_make_range_header(self):
+        self.assertEqual(utils.make_range_header(10, 5), 'bytes=10-14')
+        self.assertEqual(utils.make_range_header(10), 'bytes=10-')
+
+    def test_checksumming_reader(self):
+        """
+        Verifies that the digests of data read through a
+        ChecksummingReader are those of the whole data
+        """
+        data = ''.join(chr(i % 256) for i in xrange(100000))
+        reader = utils.ChecksummingReader(StringIO.StringIO(data),
+                                          ['md5', 'sha256'])
+        self.assertEqual(data, ''.join(utils.chunkiter(reader, 4096)))
+        self.assertEqual({'md5': hashlib.md5(data).hexdigest(),
+                          'sha256': hashlib.sha256(data).hexdigest()},
+                         reader.hexdigests())
+
+    def test_checksumming_reader_hashes_blocks_in_tpool(self):
+        """
+        Verifies that the chunks the stores read are gathered into blocks
+        that are hashed on a native thread
+        """
+        data = ''.join(chr(i % 256) for i in xrange(3 * 1024 * 1024 + 100))
+        executed = []
+        execute = eventlet.tpool.execute
+
+        def counting_execute(func, *args):
+            executed.append(len(args[0]))
+            return execute(func, *args)
+
+        eventlet.tpool.execute = counting_execute
+        try:
+            reader = utils.ChecksummingReader(StringIO.StringIO(data),
+                                              ['md5', 'sha256'])
+            self.assertEqual(data, ''.join(utils.chunkiter(reader, 65536)))
+            self.assertEqual({'md5': hashlib.md5(data).hexdigest(),
+                              'sha256': hashlib.sha256(data).hexdigest()},
+                             reader.hexdigests())
+        finally:
+            eventlet.tpool.execute = execute
+        self.assertEqual([1024 * 1024] * 3, executed)
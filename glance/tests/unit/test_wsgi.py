@@ -15,7 +15,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import os
+import signal
+import StringIO
+import tempfile
 import unittest
+
+import eventlet
+from eventlet.green import httplib
 import webob
 
 from glance.common import wsgi
@@ -136,6 +144,31 @@ class JSONResponseSerializerTest(unittest.TestCase):
         self.assertEqual(response.content_type, 'application/json')
         self.assertEqual(response.body, '{"key": "value"}')
 
+    def test_default_streamed(self):
+        def items():
+            for i in range(3):
+                yield {"id": i}
+
+        fixture = {"items": items(), "count": lambda: 3,
+                   "more": lambda: None, "key": "value"}
+        response = webob.Response()
+        wsgi.JSONResponseSerializer().default(response, fixture)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.content_length, None)
+        self.assertEqual(json.loads(response.body),
+                         {"items": [{"id": 0}, {"id": 1}, {"id": 2}],
+                          "count": 3, "key": "value"})
+
+    def test_to_json_chunks(self):
+        serializer = wsgi.JSONResponseSerializer()
+        serializer.STREAM_CHUNK_SIZE = 20
+        fixture = {"items": ({"id": i} for i in range(10))}
+        chunks = list(serializer.to_json_chunks(fixture))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(''.join(chunks)),
+                         {"items": [{"id": i} for i in range(10)]})
+
 
 class JSONRequestDeserializerTest(unittest.TestCase):
     def test_has_body_no_content_length(self):
@@ -182,3 +215,147 @@ class JSONRequestDeserializerTest(unittest.TestCase):
         actual = wsgi.JSONRequestDeserializer().default(request)
         expected = {"body": {"key": "value"}}
         self.assertEqual(actual, expected)
+
+
+class FileWrapperTest(unittest.TestCase):
+    def test_iterates_in_blocks(self):
+        filelike = StringIO.StringIO('abcdefghij')
+        wrapper = wsgi.FileWrapper(filelike, blksize=4)
+        self.assertEqual(list(wrapper), ['abcd', 'efgh', 'ij'])
+
+    def test_close_closes_file(self):
+        filelike = StringIO.StringIO('abc')
+        wrapper = wsgi.FileWrapper(filelike)
+        wrapper.close()
+        self.assertTrue(filelike.closed)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.sighup = signal.getsignal(signal.SIGHUP)
+
+    def tearDown(self):
+        signal.signal(signal.SIGHUP, self.sighup)
+
+    def test_drains_without_workers(self):
+        started = eventlet.event.Event()
+
+        def app(environ, start_response):
+            started.send()
+            eventlet.sleep(0.1)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['done']
+
+        server = wsgi.Server(workers=0)
+        server.DRAIN_POLL_INTERVAL = 0.01
+        server.start(app, 0, host='127.0.0.1')
+        port = server.socket.getsockname()[1]
+
+        def request():
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/')
+            return conn.getresponse().read()
+
+        def hangup():
+            started.wait()
+            os.kill(os.getpid(), signal.SIGHUP)
+
+        client = eventlet.spawn(request)
+        eventlet.spawn_n(hangup)
+        server.wait()
+
+        # The request in progress completed before the server stopped
+        self.assertEqual(client.wait(), 'done')
+        self.assertFalse(server.running)
+
+    def test_crashing_workers_are_restarted_with_backoff(self):
+        server = wsgi.Server(workers=1)
+        server.MAX_RESTART_INTERVAL = 4
+        pids = iter(xrange(100, 200))
+        forked = []
+        delays = []
+
+        def fake_fork():
+            forked.append(pids.next())
+            return forked[-1]
+
+        def fake_wait():
+            # Each worker dies as soon as it starts
+            return forked[-1], 256
+
+        def fake_sleep(seconds):
+            delays.append(seconds)
+            if len(delays) == 5:
+                server.running = False
+
+        for module, name, stub in ((os, 'fork', fake_fork),
+                                   (os, 'wait', fake_wait),
+                                   (wsgi.time, 'sleep', fake_sleep)):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, stub)
+
+        server._run_child()
+        server._wait_on_children()
+
+        self.assertEqual([1, 2, 4, 4, 4], delays)
+        # No worker is started once the server stops
+        self.assertEqual(5, len(forked))
+        self.assertEqual({}, server.children)
+
+    def _serve(self, app):
+        server = wsgi.Server(workers=0)
+        server.start(app, 0, host='127.0.0.1')
+        self.addCleanup(server.server.kill)
+        return server.socket.getsockname()[1]
+
+    def _get(self, port):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        return response.getheader('content-length'), response.read()
+
+    def _file_app(self, data, content_length=True):
+        cache_file = tempfile.TemporaryFile()
+        cache_file.write(data)
+        cache_file.seek(0)
+
+        def app(environ, start_response):
+            headers = [('Content-Type', 'application/octet-stream')]
+            if content_length:
+                headers.append(('Content-Length', str(len(data))))
+            start_response('200 OK', headers)
+            return environ['wsgi.file_wrapper'](cache_file, 65536)
+
+        return app
+
+    def _count_sendfile(self):
+        calls = []
+        sendfile = wsgi._sendfile
+
+        def counting_sendfile(*args):
+            calls.append(args)
+            return sendfile(*args)
+
+        wsgi._sendfile = counting_sendfile
+        self.addCleanup(setattr, wsgi, '_sendfile', sendfile)
+        return calls
+
+    def test_file_wrapper_uses_sendfile(self):
+        if wsgi._sendfile is None:
+            return
+        calls = self._count_sendfile()
+        # Large enough to fill the socket buffer, so that the server has to
+        # wait for the client to read
+        data = ''.join(chr(i % 256) for i in xrange(256)) * 32768
+        port = self._serve(self._file_app(data))
+
+        self.assertEqual(self._get(port), (str(len(data)), data))
+        self.assertTrue(calls)
+
+    def test_file_wrapper_without_length_is_read(self):
+        calls = self._count_sendfile()
+        port = self._serve(self._file_app('a' * 100000,
+                                          content_length=False))
+
+        self.assertEqual(self._get(port), (None, 'a' * 100000))
+        self.assertEqual(calls, [])
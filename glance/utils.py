@@ -19,8 +19,11 @@
 A few utility routines used throughout Glance
 """
 import errno
+import hashlib
 import logging
 
+import eventlet
+import eventlet.tpool
 import xattr
 
 logger = logging.getLogger('glance.utils')
@@ -98,6 +101,16 @@ def bool_from_header_value(value):
     return False
 
 
+def make_range_header(offset, length=None):
+    """
+    Returns the value of an HTTP Range header for `length` bytes starting
+    at `offset`, or for everything from `offset` on if length is None
+    """
+    if length is None:
+        return 'bytes=%d-' % offset
+    return 'bytes=%d-%d' % (offset, offset + length - 1)
+
+
 def has_body(req):
     """
     Returns whether a Webob.Request object will possess an entity body.
@@ -121,6 +134,98 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+def chunkslice(chunks, offset=0, length=None):
+    """Return an iterator over a byte range of an iterator of chunks
+
+    Used for backends that cannot return part of an image themselves; the
+    leading `offset` bytes are read and discarded.
+
+    :param chunks: an iterator yielding strings
+    :param offset: number of leading bytes to skip
+    :param length: maximum number of bytes to yield, or None for all
+    """
+    for chunk in chunks:
+        if offset:
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            chunk = chunk[offset:]
+            offset = 0
+        if length is not None:
+            if len(chunk) >= length:
+                yield chunk[:length]
+                break
+            length -= len(chunk)
+        yield chunk
+
+
+class ChecksummingReader(object):
+    """
+    Wraps a file-like object, computing digests of everything read from it
+    in a single pass.
+
+    When more than one digest is computed, the chunks read are gathered
+    into blocks of at least `TPOOL_MIN_SIZE` bytes, and each block is hashed
+    on a native thread while the caller goes on to write out and read the
+    chunks of the next one, so hashing overlaps with I/O instead of adding
+    to it. A block is only hashed once the one before it has been, keeping
+    the digests in order. A single digest costs less than the round trip to
+    the thread pool, so is computed inline.
+
+    :param fp: a file-like object
+    :param algorithms: names of the hashlib algorithms to compute
+    """
+
+    TPOOL_MIN_SIZE = 1024 * 1024
+
+    def __init__(self, fp, algorithms):
+        self.fp = fp
+        self.digests = dict((name, hashlib.new(name)) for name in algorithms)
+        self._hashing = None
+        self._block = []
+        self._block_size = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if not data or not self.digests:
+            return data
+        if len(self.digests) == 1:
+            self._update(data)
+            return data
+        self._block.append(data)
+        self._block_size += len(data)
+        if self._block_size >= self.TPOOL_MIN_SIZE:
+            block = ''.join(self._block)
+            self._block = []
+            self._block_size = 0
+            self._wait()
+            self._hashing = eventlet.spawn(eventlet.tpool.execute,
+                                           self._update, block)
+        return data
+
+    def _update(self, data):
+        for digest in self.digests.values():
+            digest.update(data)
+
+    def _wait(self):
+        if self._hashing is not None:
+            hashing, self._hashing = self._hashing, None
+            hashing.wait()
+
+    def hexdigests(self):
+        """
+        Returns a mapping of each algorithm to the hex digest of the data
+        read so far
+        """
+        self._wait()
+        if self._block:
+            self._update(''.join(self._block))
+            self._block = []
+            self._block_size = 0
+        return dict((name, digest.hexdigest())
+                    for name, digest in self.digests.items())
+
+
 class PrettyTable(object):
     """Creates an ASCII art table for use in bin/glance
 